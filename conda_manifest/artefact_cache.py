@@ -0,0 +1,172 @@
+"""
+A cache of build artefacts (distributions), keyed by build fingerprint
+(see :mod:`conda_manifest.fingerprints`), which may be shared between
+build hosts. The cache is checked before building, and filled after.
+
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+
+class ArtefactCache(object):
+    """
+    The interface of an artefact cache. Subclasses implement the storage.
+
+    """
+    def get(self, key, target_dir):
+        """
+        Place the artefact stored for the given key into the target
+        directory, returning its path, or None if there is no (intact)
+        artefact for the key.
+
+        """
+        raise NotImplementedError()
+
+    def put(self, key, fname):
+        """Store the given artefact file for the given key."""
+        raise NotImplementedError()
+
+
+def sha256_file(fname):
+    hsh = hashlib.sha256()
+    with open(fname, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 16), b''):
+            hsh.update(chunk)
+    return hsh.hexdigest()
+
+
+class DirectoryArtefactCache(ArtefactCache):
+    """
+    An artefact cache in a directory, such as a local or NFS directory.
+
+    Each artefact is stored as ``<root>/<key[:2]>/<key>.tar.bz2`` with a
+    ``<key>.json`` alongside it holding the artefact's filename, size
+    and sha256. Files are written to a temporary name and renamed into
+    place, and the metadata is written last, so that a partially stored
+    artefact is never seen. Artefacts are verified on retrieval, and
+    corrupt ones are removed.
+
+    If ``max_bytes`` is given, the least recently used artefacts are
+    evicted once the cache exceeds that size.
+
+    """
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def _paths(self, key):
+        directory = os.path.join(self.root, key[:2])
+        return (os.path.join(directory, key + '.tar.bz2'),
+                os.path.join(directory, key + '.json'))
+
+    def _tmp_fname(self, fname):
+        return '{}.{}.tmp'.format(fname, uuid.uuid4().hex)
+
+    def _read_metadata(self, meta_path):
+        try:
+            with open(meta_path, 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _remove(self, key):
+        # Metadata first, so that the entry disappears atomically.
+        for path in self._paths(key)[::-1]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key, target_dir):
+        data_path, meta_path = self._paths(key)
+        metadata = self._read_metadata(meta_path)
+        if metadata is None:
+            return None
+        target = os.path.join(target_dir, metadata['fn'])
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        tmp_target = self._tmp_fname(target)
+        try:
+            shutil.copyfile(data_path, tmp_target)
+        except (IOError, OSError):
+            # The artefact has been evicted or lost.
+            if os.path.exists(tmp_target):
+                os.remove(tmp_target)
+            return None
+        if (os.path.getsize(tmp_target) != metadata['size'] or
+                sha256_file(tmp_target) != metadata['sha256']):
+            os.remove(tmp_target)
+            self._remove(key)
+            return None
+        os.rename(tmp_target, target)
+        # Mark the artefact as recently used.
+        os.utime(meta_path, None)
+        return target
+
+    def put(self, key, fname):
+        data_path, meta_path = self._paths(key)
+        directory = os.path.dirname(data_path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        tmp_data = self._tmp_fname(data_path)
+        shutil.copyfile(fname, tmp_data)
+        metadata = {'fn': os.path.basename(fname),
+                    'size': os.path.getsize(tmp_data),
+                    'sha256': sha256_file(tmp_data)}
+        os.rename(tmp_data, data_path)
+        tmp_meta = self._tmp_fname(meta_path)
+        with open(tmp_meta, 'w') as fh:
+            json.dump(metadata, fh)
+        os.rename(tmp_meta, meta_path)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def entries(self):
+        """
+        Return a list of (last used time, size, key) for every artefact
+        in the cache.
+
+        """
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for subdir in os.listdir(self.root):
+            directory = os.path.join(self.root, subdir)
+            if not os.path.isdir(directory):
+                continue
+            for fname in os.listdir(directory):
+                if not fname.endswith('.json'):
+                    continue
+                key = fname[:-len('.json')]
+                data_path, meta_path = self._paths(key)
+                try:
+                    last_used = os.stat(meta_path).st_mtime
+                    size = os.stat(data_path).st_size
+                except OSError:
+                    continue
+                entries.append((last_used, size, key))
+        return entries
+
+    def evict(self, max_bytes):
+        """
+        Remove the least recently used artefacts until the cache is no
+        larger than max_bytes. Returns the keys of the removed artefacts.
+
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, key in entries:
+            if total <= max_bytes:
+                break
+            self._remove(key)
+            total -= size
+            evicted.append(key)
+        return evicted
@@ -3,7 +3,6 @@ import yaml
 from conda_build_missing import build, find_all_recipes, sort_dependency_order
 import os
 
-from conda_build.config import config as conda_bld_config
 import conda_build
 import conda.api
 
@@ -23,7 +22,13 @@ import conda_manifest.config
 import conda.config
 from conda.api import get_index
 
-from conda_manifest.env_recipes import load_envs
+from conda_manifest.artefact_cache import DirectoryArtefactCache
+from conda_manifest.build_scheduler import BuildJob, run_jobs
+from conda_manifest.fingerprints import FingerprintStore, job_fingerprint
+from conda_manifest.env_recipes import load_envs, load_env_recipes
+from conda_manifest.index import (LayeredIndex, add_to_repodata,
+                                  source_index_cache)
+from conda_manifest.solver import Solver
 from conda_manifest.sources import load_sources
 
 
@@ -41,29 +46,10 @@ def resolve_index(src_indices, env_sources):
     Given the indices for all sources, produce an index with
     filtered packages based on the sources specification.
 
+    See :class:`conda_manifest.index.LayeredIndex`.
+
     """
-    pkg_names_handled = []
-    index = {}
-    for sources in env_sources:
-        pkgs_handled_at_this_level = []
-        for source in sources:
-            for tar_name, pkg_info in src_indices[source].items():
-                name = pkg_info['name']
-                if name in pkg_names_handled:
-                    continue
-                pkgs_handled_at_this_level.append(name)
-                if tar_name in index:
-                    raise ValueError('Conflicting package information for {} '
-                                     'from {} and {}.'
-                                     ''.format(tar_name,
-                                               index[tar_name]['channel'],
-                                               pkg_info['channel']))
-                index[tar_name] = pkg_info.copy()
-                # Put the source into the pkg_info.
-                index[tar_name]['source'] = source
-
-        pkg_names_handled.extend(pkgs_handled_at_this_level)
-    return index
+    return LayeredIndex(src_indices, env_sources)
 
 
 @contextmanager
@@ -81,39 +67,50 @@ def fixed_get_index(desired_index):
     conda.api.get_index = conda_build.build.get_index = orig_get_index
 
 
-@contextmanager
-def conda_build_croot_for_source(source_name):
-    """
-    Change the conda build build_root/croot for the lifetime of the context
-    manager.
-
+def compute_source_indices(env_sources, cache=None):
     """
-    orig_build_root = conda_bld_config.croot
-    conda_bld_config.croot = conda_manifest.config.src_distributions_dir(source_name)
-    conda_bld_config.bldpkgs_dir = os.path.join(conda_bld_config.croot,
-                                                conda.config.subdir)
-    yield
-    conda_bld_config.croot = orig_build_root
-    conda_bld_config.bldpkgs_dir = os.path.join(conda_bld_config.croot,
-                                                conda.config.subdir)
+    Generate a dictionary mapping source name to source index.
 
+    The indices come from the given
+    :class:`conda_manifest.index.SourceIndexCache` (by default, the one
+    shared by the whole process), so only distributions which are new or
+    have changed since they were last indexed are read.
 
-def compute_source_indices(env_sources):
-    """Generate a dictionary mapping source name to source index."""
+    """
+    if cache is None:
+        cache = source_index_cache()
     src_index = {}
     for sources in env_sources:
         for source_name in sources:
-            with conda_build_croot_for_source(source_name):
-                if os.path.exists(conda_bld_config.bldpkgs_dir):
-                    # Get hold of just the built packages.
-                    src_urls = [url_path(conda_bld_config.croot)]
-                    index = conda.api.get_index(src_urls, prepend=False)
-                    src_index[source_name] = index
-                else:
-                    src_index[source_name] = {}
+            src_index[source_name] = cache.get(source_name)
     return src_index
 
 
+def add_distribution(source_name, dist_path, src_index, index,
+                     update_repodata=False, cache=None):
+    """
+    Add a distribution which has just been built (or retrieved) for the
+    given source to the source's index, and to the environment's
+    :class:`conda_manifest.index.LayeredIndex`, reading only that
+    distribution. Returns whether the distribution is visible in the
+    environment's index.
+
+    Distributions which were built in a private conda-build root (see
+    :func:`conda_manifest.build_scheduler.build_job`), or which came from
+    elsewhere (e.g. an artefact cache), must also be added to the repodata
+    of their directory with ``update_repodata``.
+
+    """
+    if cache is None:
+        cache = source_index_cache()
+    tar_name = os.path.basename(dist_path)
+    pkg_info = cache.add(source_name, dist_path)
+    src_index[source_name][tar_name] = pkg_info
+    if update_repodata:
+        add_to_repodata(os.path.dirname(dist_path), tar_name, pkg_info)
+    return index.insert(tar_name, pkg_info, source_name)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Pull together the environment recipes "
                                      "directory.")
@@ -121,6 +118,19 @@ if __name__ == '__main__':
                         help="Location of sources.yaml")
     parser.add_argument("--envs", nargs='+', default=['env.specs/*.yaml'],
                         help="Glob pattern of environment yamls.")
+    parser.add_argument("--changed-only", action='store_true',
+                        help=("Only build the recipes which were added or "
+                              "changed by the last env_recipes run."))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="The number of builds to run concurrently.")
+    parser.add_argument("--artefact-cache",
+                        default=conda_manifest.config.ARTEFACT_CACHE,
+                        help=("A directory (e.g. on NFS) of build artefacts "
+                              "shared between build hosts."))
+    parser.add_argument("--artefact-cache-max-mb", type=int, default=None,
+                        help=("The size (in MB) beyond which the least "
+                              "recently used artefacts are evicted from the "
+                              "artefact cache."))
     if 1 or conda_manifest.config.DEBUG:
         args = parser.parse_args(['--envs', '../env.specs/lts.yaml',
                                   '--sources', '../sources.yaml'])
@@ -130,10 +140,17 @@ if __name__ == '__main__':
     sources = load_sources(args.sources)
     envs = load_envs(args.envs)
 
+    artefact_cache = None
+    if args.artefact_cache:
+        max_bytes = None
+        if args.artefact_cache_max_mb is not None:
+            max_bytes = args.artefact_cache_max_mb * 1024 * 1024
+        artefact_cache = DirectoryArtefactCache(args.artefact_cache,
+                                                max_bytes=max_bytes)
+
     for env in envs:
         env_sources = env['sources']
 
-        orig_build_root = conda_bld_config.croot
         channels = []
         for sources in env_sources:
             for source_name in sources:
@@ -150,7 +167,11 @@ if __name__ == '__main__':
 
         env_recipe_dir = conda_manifest.config.env_recipes_dir(env=env)
 
+        env_recipes = load_env_recipes(env_recipe_dir)
         metas = list(find_all_recipes([env_recipe_dir]))
+        if args.changed_only:
+            metas = [meta for meta in metas
+                     if os.path.basename(meta.path) in env_recipes['changed']]
         stdoutlog.debug('Found the following recipes:\n{}\n-------------------'
                         ''.format('\n'.join(meta.name() for meta in metas)))
 
@@ -158,36 +179,67 @@ if __name__ == '__main__':
         stdoutlog.debug('Metas sorted into the following order:\n{}\n---------'
                         ''.format('\n'.join(meta.name() for meta in metas)))
 
-        src_index = {}
-
         src_index = compute_source_indices(env_sources)
         index = resolve_index(src_index, env_sources)
-        r = conda.resolve.Resolve(index)
 
+        # The solver is created on demand, as it must be re-created
+        # whenever a distribution is added to the index. (That is cheap, as
+        # the index maintains its digest and name-keyed view as
+        # distributions are inserted.)
+        solvers = []
+
+        def solver():
+            if not solvers:
+                solvers.append(Solver(index))
+            return solvers[0]
+
+        # Plan the whole run up front.
+        version_matrices = vn_matrix.special_case_version_matrices(
+            metas, index, solver=solver())
+        jobs = []
         for meta in metas:
-            stdoutlog.debug('Starting to look at: ', meta.name())
-            with open(os.path.join(meta.path, 'source.json'), 'r') as fh:
-                source = json.load(fh)
-            source_name = source['name']
-            version_matrix = vn_matrix.special_case_version_matrix(meta, index)
-#            version_matrix = vn_matrix.filter_cases(version_matrix, index, env['packages'])
-            for case in vn_matrix.conda_special_versions(meta, index, version_matrix):
-                if meta.dist() + '.tar.bz2' not in src_index[source_name]:
-                    stdoutlog.info('Building {} from {}.\n'
-                                   ''.format(meta.name(), source_name))
-                    with conda_build_croot_for_source(source_name):
-                        print conda_bld_config.croot
-                        print conda.config.rc['channels']
-                        print 'BUILDING IN:', conda_bld_config.croot
-                        with conda_manifest.config.pipe_check_call(os.path.join(meta.path,
-                                                                               'build.{}.log'.format(conda.config.subdir))):
-#                            with fixed_get_index(index):
-                            build(meta, channels, test=True)
-#                            src_index = compute_source_indices(env_sources)
-#                            index = resolve_index(src_index, env_sources)
-#                            with fixed_get_index(index):
-#                                build(meta, channels, test=True)
-                        
-                else:
-                    stdoutlog.info('Not building {} from {}, as it has already been '
-                                   'built.\n'.format(meta.name(), source_name))
+            recipe = env_recipes['recipes'][os.path.basename(meta.path)]
+            source_name = recipe['source']
+            for case in version_matrices[meta]:
+                jobs.append(BuildJob(meta, source_name, case))
+
+        def report(result):
+            if result.status in ['built', 'cached']:
+                if add_distribution(result.job.source_name,
+                                    result.dist_path, src_index, index,
+                                    update_repodata=True):
+                    del solvers[:]
+
+            if result.status == 'built':
+                stdoutlog.info('Built {} from {}.\n'
+                               ''.format(result.job.meta.name(),
+                                         result.job.source_name))
+            elif result.status == 'cached':
+                stdoutlog.info('Retrieved {} from {} from the artefact '
+                               'cache.\n'.format(result.job.meta.name(),
+                                                  result.job.source_name))
+            elif result.status in ['exists', 'unchanged']:
+                stdoutlog.info('Not building {} from {}, as it has already '
+                               'been built.\n'
+                               ''.format(result.job.meta.name(),
+                                         result.job.source_name))
+            elif result.status == 'skipped':
+                stdoutlog.warn('Not building {} from {}, as a dependency '
+                               'failed to build.\n'
+                               ''.format(result.job.meta.name(),
+                                         result.job.source_name))
+
+        fingerprints = FingerprintStore(
+            conda_manifest.config.BUILD_FINGERPRINTS)
+        results = run_jobs(jobs, channels, processes=args.jobs,
+                           callback=report,
+                           fingerprint_fn=lambda job: job_fingerprint(
+                               job, solver()),
+                           fingerprints=fingerprints,
+                           artefact_cache=artefact_cache)
+        failures = [result for result in results
+                    if result.status in ['failed', 'skipped']]
+        if failures:
+            raise SystemExit('{} of {} builds failed or were skipped for {}.'
+                             ''.format(len(failures), len(results),
+                                       env['name']))
@@ -0,0 +1,335 @@
+"""
+Scheduling of recipe builds, such that independent builds can run at the
+same time.
+
+Each build job (a recipe from a source, for one case of its version
+matrix) runs in its own worker process, which is used for that job only.
+conda-build is configured through process-wide state (croot, CONDA_PY,
+CONDA_NPY, channels etc.), so this leaves the scheduling process
+untouched. conda-build's filesystem state (its work directory and its
+build and test prefixes) is shared by every process though, so each job
+also builds in a private conda-build root, and only the finished
+distribution is moved into the source's distributions directory.
+
+"""
+import collections
+from contextlib import contextmanager
+import multiprocessing
+import os
+import shutil
+import tempfile
+import traceback
+
+import conda.config
+
+import conda_manifest.config
+import conda_manifest.core_vn_matrix as vn_matrix
+from conda_manifest.records import match_spec
+
+
+#: A single build: the recipe (meta) from the named source, for a single
+#: case of the recipe's version matrix.
+BuildJob = collections.namedtuple('BuildJob', ['meta', 'source_name', 'case'])
+
+#: The outcome of a :class:`BuildJob`. ``status`` is one of
+#: ``'built'``, ``'exists'`` (the distribution had already been built),
+#: ``'unchanged'`` (an artefact has been built from identical inputs, see
+#: :mod:`conda_manifest.fingerprints`), ``'cached'`` (the artefact was
+#: retrieved from an :mod:`artefact cache <conda_manifest.artefact_cache>`),
+#: ``'failed'`` or ``'skipped'`` (a
+#: dependency failed). ``dist_path`` is the path of the distribution, where
+#: there is one, and ``fingerprint`` is the job's build fingerprint, where
+#: fingerprints are in use.
+BuildResult = collections.namedtuple('BuildResult',
+                                     ['job', 'status', 'dist_path', 'error',
+                                      'fingerprint'])
+
+#: The statuses of a :class:`BuildResult` which mean a distribution is
+#: available for the job.
+SUCCESSFUL = ('built', 'exists', 'unchanged', 'cached')
+
+
+class JobGraph(object):
+    """
+    The dependency DAG of a list of build jobs. Jobs are identified by
+    their position in the list.
+
+    A job depends on every job for every other recipe (in the list) which
+    its recipe depends upon, at build or run time.
+
+    """
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+        jobs_by_name = {}
+        for i, job in enumerate(self.jobs):
+            jobs_by_name.setdefault(job.meta.name(), []).append(i)
+
+        self.dependencies = {}
+        self.dependents = {i: set() for i in range(len(self.jobs))}
+        for i, job in enumerate(self.jobs):
+            meta = job.meta
+            names = set(match_spec(spec).name
+                        for spec in (tuple(meta.get_value('requirements/build', ())) +
+                                     tuple(meta.get_value('requirements/run', ()))))
+            names.discard(meta.name())
+            deps = set(dep for name in names
+                       for dep in jobs_by_name.get(name, ()))
+            self.dependencies[i] = deps
+            for dep in deps:
+                self.dependents[dep].add(i)
+
+        self._waiting_on = {i: set(deps)
+                            for i, deps in self.dependencies.items()}
+        self._unstarted = set(range(len(self.jobs)))
+
+    def ready(self):
+        """
+        Return the (sorted) jobs which are ready to run and have not yet
+        been started, marking them as started.
+
+        """
+        ready = sorted(i for i in self._unstarted if not self._waiting_on[i])
+        self._unstarted.difference_update(ready)
+        return ready
+
+    def abandon(self):
+        """
+        Return the (sorted) jobs which have not been started, and will
+        now never be started.
+
+        """
+        abandoned = sorted(self._unstarted)
+        self._unstarted.clear()
+        return abandoned
+
+    def completed(self, i):
+        """Record that the given job completed successfully."""
+        for dependent in self.dependents[i]:
+            self._waiting_on[dependent].discard(i)
+
+    def failed(self, i):
+        """
+        Record that the given job failed, returning the (sorted) jobs which
+        must now be skipped as they depend on it, directly or indirectly.
+
+        """
+        skipped = set()
+        todo = [i]
+        while todo:
+            for dependent in self.dependents[todo.pop()]:
+                if dependent in self._unstarted:
+                    self._unstarted.discard(dependent)
+                    skipped.add(dependent)
+                    todo.append(dependent)
+        return sorted(skipped)
+
+
+def dist_directory(source_name):
+    """The directory into which the given source's distributions are built."""
+    return os.path.join(conda_manifest.config.src_distributions_dir(source_name),
+                        conda.config.subdir)
+
+
+def configure_conda_build(croot, case, channels):
+    """
+    Configure conda-build (and conda) to build in the given conda-build
+    root, for the given case of a version matrix. The work directory and
+    the build and test prefixes are all within the root. This changes
+    process-wide state, so is only for use in a worker process.
+
+    """
+    import conda_build.config
+    import conda_build.source
+    config = conda_build.config.config
+    config.croot = croot
+    bldpkgs_dir = os.path.join(croot, conda.config.subdir)
+    # Newer conda-builds derive bldpkgs_dir from croot.
+    if not isinstance(getattr(type(config), 'bldpkgs_dir', None), property):
+        config.bldpkgs_dir = bldpkgs_dir
+    if not os.path.isdir(bldpkgs_dir):
+        os.makedirs(bldpkgs_dir)
+    # conda-build derives these from croot and envs_dirs once, on import.
+    conda_build.source.WORK_DIR = os.path.join(croot, 'work')
+    build_prefix = os.path.join(croot, '_build')
+    if hasattr(config, 'short_build_prefix'):
+        config.short_build_prefix = build_prefix
+        config.long_build_prefix = max(build_prefix,
+                                       (build_prefix + 8 * '_placehold')[:80],
+                                       key=len)
+    else:
+        config.build_prefix = build_prefix
+    config.test_prefix = os.path.join(croot, '_test')
+    for attr, value in vn_matrix.special_versions_config(case).items():
+        setattr(config, attr, value)
+    conda.config.rc['channels'] = list(channels)
+
+
+@contextmanager
+def private_croot(source_name):
+    """
+    A context manager for a temporary conda-build root for a single build
+    job, which is removed on exit. It is within the given source's
+    distributions directory, so that the built distribution can be moved
+    into :func:`dist_directory` with a rename.
+
+    """
+    parent = conda_manifest.config.src_distributions_dir(source_name)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    croot = tempfile.mkdtemp(prefix='.build-', dir=parent)
+    try:
+        yield croot
+    finally:
+        shutil.rmtree(croot, ignore_errors=True)
+
+
+def build_job(job, channels, rebuild=False):
+    """
+    Build the given job, returning a tuple of the status (``'built'`` or
+    ``'exists'``) and the path to the distribution in the source's
+    :func:`dist_directory`. An existing distribution is only rebuilt if
+    ``rebuild`` is True.
+
+    The build happens in a :func:`private_croot`, and changes process-wide
+    state (see :func:`configure_conda_build`), and so is run by
+    :func:`run_jobs` in a dedicated worker process. conda-build only
+    indexes the private root, so the distribution must be added to the
+    repodata of its directory by the caller.
+
+    """
+    import conda_build.build
+    from conda_build_missing import build
+
+    dist_dir = dist_directory(job.source_name)
+    with private_croot(job.source_name) as croot:
+        configure_conda_build(croot, job.case, channels)
+        meta = job.meta
+        # Re-render the recipe, as selectors may depend upon the case.
+        meta.parse_again()
+        built_path = conda_build.build.bldpkg_path(meta)
+        dist_path = os.path.join(dist_dir, os.path.basename(built_path))
+        if not rebuild and os.path.exists(dist_path):
+            return 'exists', dist_path
+        log_fname = os.path.join(meta.path,
+                                 'build.{}.log'.format(conda.config.subdir))
+        with conda_manifest.config.pipe_check_call(log_fname):
+            build(meta, channels, test=True)
+        if not os.path.isdir(dist_dir):
+            os.makedirs(dist_dir)
+        os.rename(built_path, dist_path)
+    return 'built', dist_path
+
+
+def _run_job(build_fn, job, args):
+    try:
+        status, dist_path = build_fn(job, *args)
+    except BaseException:
+        # SystemExit is commonly used by conda (build) to report failure.
+        return 'failed', None, traceback.format_exc()
+    return status, dist_path, None
+
+
+def run_jobs(jobs, channels, processes=1, build_fn=build_job,
+             callback=None, fingerprint_fn=None, fingerprints=None,
+             artefact_cache=None):
+    """
+    Run the given build jobs, at most ``processes`` at a time, such that
+    no job starts before the jobs it depends on (see :class:`JobGraph`)
+    have completed. Jobs which depend on a failed job are skipped.
+
+    Each job is run by ``build_fn(job, channels, rebuild)`` in a fresh
+    worker process. ``callback``, if given, is called in this process with
+    each :class:`BuildResult` as it becomes available.
+
+    If a ``fingerprint_fn`` (taking a job and returning its fingerprint)
+    and a :class:`~conda_manifest.fingerprints.FingerprintStore` are given,
+    each job's fingerprint is computed once the jobs it depends on have
+    completed. A job whose fingerprint has a recorded artefact is not run,
+    and otherwise the job is (re)built and its artefact recorded.
+
+    If an :class:`~conda_manifest.artefact_cache.ArtefactCache` is also
+    given, it is checked (by fingerprint) before a job is run, and built
+    artefacts are added to it.
+
+    Returns
+    -------
+    results - list
+        The :class:`BuildResult` of each job, in the order of ``jobs``.
+
+    """
+    graph = JobGraph(jobs)
+    results = [None] * len(graph.jobs)
+    job_fingerprints = {}
+    use_fingerprints = fingerprint_fn is not None and fingerprints is not None
+
+    def record(i, status, dist_path=None, error=None):
+        fingerprint = job_fingerprints.get(i)
+        result = BuildResult(graph.jobs[i], status, dist_path, error,
+                             fingerprint)
+        results[i] = result
+        if status == 'failed':
+            conda_manifest.config.stdout.warn(
+                'Failed to build {} from {} ({}):\n{}\n'
+                ''.format(result.job.meta.name(), result.job.source_name,
+                          result.job.case, error))
+        elif status in ['built', 'cached'] and fingerprint is not None:
+            fingerprints.record(fingerprint, dist_path)
+            if status == 'built' and artefact_cache is not None:
+                artefact_cache.put(fingerprint, dist_path)
+        if callback is not None:
+            callback(result)
+        if status in SUCCESSFUL:
+            graph.completed(i)
+        else:
+            for skipped in graph.failed(i):
+                record(skipped, 'skipped')
+
+    # A worker process per job (maxtasksperchild=1), so no job ever
+    # sees conda-build state configured for another.
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        running = {}
+        while True:
+            ready = graph.ready()
+            for i in ready:
+                job = graph.jobs[i]
+                if use_fingerprints:
+                    fingerprint = job_fingerprints[i] = fingerprint_fn(job)
+                    dist_path = fingerprints.lookup(fingerprint)
+                    if dist_path is not None:
+                        record(i, 'unchanged', dist_path)
+                        continue
+                    if artefact_cache is not None:
+                        dist_path = artefact_cache.get(
+                            fingerprint, dist_directory(job.source_name))
+                        if dist_path is not None:
+                            record(i, 'cached', dist_path)
+                            continue
+                running[i] = pool.apply_async(_run_job,
+                                              (build_fn, job,
+                                               (channels, use_fingerprints)))
+            if ready and not running:
+                # Jobs were unchanged, so others may now be ready.
+                continue
+            if not running:
+                break
+            done = [i for i, result in running.items() if result.ready()]
+            if not done:
+                next(iter(running.values())).wait(0.1)
+                continue
+            for i in sorted(done):
+                try:
+                    status, dist_path, error = running.pop(i).get()
+                except Exception:
+                    # e.g. the job could not be sent to the worker.
+                    status, dist_path = 'failed', None
+                    error = traceback.format_exc()
+                record(i, status, dist_path, error)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Anything left can never be started (a dependency cycle).
+    for i in graph.abandon():
+        record(i, 'failed', error='Dependency cycle between recipes.')
+    return results
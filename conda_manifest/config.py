@@ -24,6 +24,20 @@ def src_distributions_dir(source_name):
 
 
 GIT_CACHE = os.path.join(manager_root, 'cache', 'git_cache')
+RECIPE_CACHE = os.path.join(manager_root, 'cache', 'recipe_cache')
+INDEX_CACHE = os.path.join(manager_root, 'cache', 'index_cache')
+BUILD_FINGERPRINTS = os.path.join(manager_root, 'cache',
+                                  'build_fingerprints.json')
+#: The special packages, which form the dimensions of a recipe's version
+#: matrix (in the order in which they appear in each case), along with the
+#: conda-build config attribute which selects each one's version.
+SPECIAL_PACKAGES = (('python', 'CONDA_PY'),
+                    ('numpy', 'CONDA_NPY'),
+                    ('perl', 'CONDA_PERL'),
+                    ('r', 'CONDA_R'))
+
+#: A directory of build artefacts shared between build hosts (optional).
+ARTEFACT_CACHE = os.environ.get('CONDA_MANAGER_ARTEFACT_CACHE')
 
 # Override the conda logging handlers.
 import conda.fetch
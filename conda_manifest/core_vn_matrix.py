@@ -1,36 +1,50 @@
-import conda.resolve
-from conda.resolve import MatchSpec
-import conda_build.config
 import conda_manifest.config
+from conda_manifest.records import match_spec
+from conda_manifest.solver import Solver
 
 
-def conda_special_versions(meta, index, version_matrix=None):
+def special_versions_config(case):
     """
-    Returns a generator which configures conda build's PY and NPY versions
-    according to the given version matrix. If no version matrix is given, it
-    will be computed by :func:`special_case_version_matrix`.
+    Return a dictionary of the conda build config attributes (and their
+    values) which represent the given case of a version matrix.
 
     """
-    if version_matrix is None:
-        version_matrix = special_case_version_matrix(meta, index)
-
-    for case in version_matrix:
-        for pkg, version in case:
+    attrs = dict(conda_manifest.config.SPECIAL_PACKAGES)
+    config = {}
+    for pkg, version in case:
+        if pkg not in attrs:
+            raise NotImplementedError('Package {} not yet implemented.'
+                                      ''.format(pkg))
+        attr = attrs[pkg]
+        if attr in _INTEGER_CONFIG:
             version = int(version.replace('.', ''))
-            if pkg == 'python':
-                conda_build.config.config.CONDA_PY = version
-            elif pkg == 'numpy':
-                conda_build.config.config.CONDA_NPY = version
-            else:
-                raise NotImplementedError('Package {} not yet implemented.'
-                                          ''.format(pkg))
-        yield case
+        config[attr] = version
+    return config
+
+
+#: The conda-build config attributes which are integers (e.g. CONDA_PY=27),
+#: rather than version strings (e.g. CONDA_PERL='5.18').
+_INTEGER_CONFIG = ('CONDA_PY', 'CONDA_NPY')
+
 
+def special_packages():
+    """The names of the special packages, in the order of a case."""
+    return [name for name, _ in conda_manifest.config.SPECIAL_PACKAGES]
+
+
+def case_specs(case):
+    """
+    Return the conda specifications which pin the special packages to the
+    versions of the given case of a version matrix.
 
-def special_case_version_matrix(meta, index):
+    """
+    return ['{} {}.*'.format(pkg, version) for pkg, version in case]
+
+
+def special_case_version_matrix(meta, index, solver=None):
     """
     Return the non-orthogonal version matrix for special software within conda
-    (numpy, python).
+    (see ``conda_manifest.config.SPECIAL_PACKAGES``: python, numpy, perl, r).
 
     For example, supposing there was a numpy 1.8 & 1.9 for python 2.7,
     but only a numpy 1.9 for python 3.5, the matrix should be:
@@ -49,49 +63,92 @@ def special_case_version_matrix(meta, index):
     can be written provided that the process which handles the cases can handle
     an empty list.
 
-    .. note::
+    The special packages which a recipe depends upon, directly or through
+    other special packages (e.g. numpy depends upon python), form the
+    dimensions of its matrix. Cases are enumerated depth first, and a
+    partial case is pruned as soon as the versions it has chosen are not
+    compatible with one another, or cannot be installed along with the
+    recipe's other build requirements, so infeasible combinations are never
+    expanded.
+
+    A :class:`conda_manifest.solver.Solver` of the index may be given, so
+    that it (and its memoized results) may be shared between recipes.
+
+    """
+    if solver is None:
+        solver = Solver(index)
+    return _version_matrix(_requirement_specs(meta), index, solver)
 
-        This algorithm does not deal with PERL and R versions at this time.
 
+def special_case_version_matrices(metas, index, solver=None):
     """
-    r = conda.resolve.Resolve(index)
+    Return a dictionary mapping each of the given metas to its version
+    matrix (see :func:`special_case_version_matrix`).
+
+    Recipes whose build requirements have the same signature (the specs of
+    the special packages, and the names of the other requirements) have
+    the same version matrix, so each distinct matrix is only computed once.
+
+    """
+    if solver is None:
+        solver = Solver(index)
+    matrices = {}
+    result = {}
+    for meta in metas:
+        requirement_specs = _requirement_specs(meta)
+        signature = _signature(requirement_specs)
+        if signature not in matrices:
+            matrices[signature] = _version_matrix(requirement_specs, index,
+                                                  solver)
+        result[meta] = set(matrices[signature])
+    return result
+
+
+def _requirement_specs(meta):
     requirements = meta.get_value('requirements/build', [])
-    requirement_specs = {MatchSpec(spec).name: MatchSpec(spec)
-                         for spec in requirements}
+    return {match_spec(spec).name: match_spec(spec)
+            for spec in requirements}
+
+
+def _signature(requirement_specs):
+    """
+    The normalized signature of the given build requirements, which
+    determines their version matrix.
+
+    """
+    special = special_packages()
+    special_specs = tuple(sorted(
+        (name, ' '.join(spec.spec.split()))
+        for name, spec in requirement_specs.items()
+        if name in special))
+    return special_specs, frozenset(requirement_specs)
+
+
+def minor_vn(version_str):
+    """
+    Take an string of the form 1.8.2, into integer form 1.8
+    """
+    return '.'.join(version_str.split('.')[:2])
 
-    def minor_vn(version_str):
-        """
-        Take an string of the form 1.8.2, into integer form 1.8
-        """
-        return '.'.join(version_str.split('.')[:2])
+
+def _version_matrix(requirement_specs, index, solver):
+    special = special_packages()
+    candidates = _special_candidates(requirement_specs, index, solver,
+                                     special)
+    extra_specs = [name for name in requirement_specs
+                   if name not in candidates]
+    # Enumerate the dimensions which depend upon others (e.g. numpy) before
+    # those they depend upon (e.g. python), so that the dependencies of the
+    # chosen packages constrain the remaining dimensions.
+    order = [name for name in reversed(special) if name in candidates]
 
     cases = []
-    if 'numpy' in requirement_specs:
-        np_spec = requirement_specs.pop('numpy')
-        for numpy_pkg in r.get_pkgs(np_spec):
-            np_vn = minor_vn(index[numpy_pkg.fn]['version'])
-            numpy_deps = index[numpy_pkg.fn]['depends']
-            numpy_deps = {MatchSpec(spec).name: MatchSpec(spec)
-                          for spec in numpy_deps}
-            for python_pkg in r.get_pkgs(numpy_deps['python']):
-                # XXX Get the python spec here too...?
-                py_vn = minor_vn(index[python_pkg.fn]['version'])
-                cases.append((('python', py_vn),
-                              ('numpy', np_vn),
-                              ))
-    elif 'python' in requirement_specs:
-        py_spec = requirement_specs.pop('python')
-        for python_pkg in r.get_pkgs(py_spec):
-            py_vn = minor_vn(index[python_pkg.fn]['version'])
-            cases.append((('python', py_vn),
-                          ))
-
-    if 'perl' in requirement_specs:
-        raise NotImplementedError('PERL version matrix not yet implemented.')
-    if 'r' in requirement_specs:
-        raise NotImplementedError('R version matrix not yet implemented.')
-
-    cases = list(filter_cases(cases, index, requirement_specs.keys()))
+    if order:
+        for chosen in _enumerate_cases(order, candidates, extra_specs,
+                                       index, solver):
+            versions = {name: version for name, version, _ in chosen}
+            cases.append(tuple((name, versions[name])
+                               for name in special if name in versions))
 
     # Put an empty case in to allow simple iteration of the results.
     if not cases:
@@ -99,15 +156,97 @@ def special_case_version_matrix(meta, index):
     return set(cases)
 
 
-def filter_cases(cases, index, extra_specs=None):
-    r = conda.resolve.Resolve(index)
+def _special_candidates(requirement_specs, index, solver, special):
+    """
+    Return a dictionary mapping the name of each special package which the
+    requirements depend upon (directly, or through other special packages)
+    to a dictionary of its minor versions and the distributions of each.
+
+    """
+    candidates = {}
+    todo = [name for name in requirement_specs if name in special]
+    while todo:
+        name = todo.pop()
+        if name in candidates:
+            continue
+        by_version = candidates[name] = {}
+        for pkg in solver.get_pkgs(requirement_specs.get(name, name)):
+            pkg_info = index[pkg.fn]
+            by_version.setdefault(minor_vn(pkg_info['version']),
+                                  []).append(pkg.fn)
+            for dep in pkg_info.get('depends', ()):
+                dep_name = match_spec(dep).name
+                if dep_name in special and dep_name not in candidates:
+                    todo.append(dep_name)
+    return candidates
+
+
+def _enumerate_cases(order, candidates, extra_specs, index, solver,
+                     chosen=()):
+    """
+    Yield the feasible cases (as tuples of (name, version, distributions))
+    which extend the chosen (partial) case, choosing the versions of the
+    special packages in the given order.
+
+    """
+    if len(chosen) == len(order):
+        yield chosen
+        return
+    name = order[len(chosen)]
+    for version, fns in sorted(candidates[name].items()):
+        fns = [fn for fn in fns
+               if all(any(_compatible(fn, other_fn, index, solver)
+                          for other_fn in other_fns)
+                      for _, _, other_fns in chosen)]
+        if not fns:
+            continue
+        case = chosen + ((name, version, fns),)
+        specs = extra_specs + case_specs((pkg, pkg_version)
+                                         for pkg, pkg_version, _ in case)
+        try:
+            solver.solve(specs)
+        except SystemExit as err:
+            # Output the useful message along the lines of "the following
+            # packages conflict with each other".
+            conda_manifest.config.stdout.debug(str(err) + '\n')
+            continue
+        for full_case in _enumerate_cases(order, candidates, extra_specs,
+                                          index, solver, case):
+            yield full_case
+
+
+def _compatible(fn1, fn2, index, solver):
+    """
+    Whether each of the given distributions satisfies the other's
+    dependencies on it.
+
+    """
+    return (_satisfies(fn1, fn2, index, solver) and
+            _satisfies(fn2, fn1, index, solver))
+
+
+def _satisfies(dependent_fn, fn, index, solver):
+    name = index[fn]['name']
+    for dep in index[dependent_fn].get('depends', ()):
+        if match_spec(dep).name == name:
+            if fn not in set(pkg.fn for pkg in solver.get_pkgs(dep)):
+                return False
+    return True
+
+
+def filter_cases(cases, index, extra_specs=None, solver=None):
+    """
+    Yield the cases of a version matrix for which the given extra specs
+    can be satisfied from the index.
+
+    """
+    if solver is None:
+        solver = Solver(index)
+    extra_specs = list(extra_specs or [])
     for case in cases:
-        specs = ['{} {}.*'.format(pkg, version) for pkg, version in case]
         try:
-            specs = extra_specs + ['{} {}.*'.format(pkg, version)
-                                   for pkg, version in case]
-            print specs, index.keys()
-            r.solve(specs)
+            specs = extra_specs + case_specs(case)
+            solver.solve(specs)
             yield case
         except SystemExit as err:
             # Output the useful message along the lines of "the following
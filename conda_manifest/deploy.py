@@ -1,66 +1,56 @@
 import argparse
+import collections
+from contextlib import closing
 import conda_manifest.config
-import yaml
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
-from conda_manifest.env_recipes import load_envs
-from conda_manifest.sources import load_sources
-
-import conda.resolve
-
-
-from conda_manifest.build_recipes import compute_source_indices, fixed_get_index, resolve_index
+import shutil
+import sys
+import tarfile
+import threading
+import traceback
 
+import conda.config
+import conda.install as cinstall
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser("Deploy the given manifest.")
-    parser.add_argument("--sources", default='sources.yaml',
-                        help="Location of sources.yaml")
-    parser.add_argument("manifest", help="The manifest to deploy.")
-    parser.add_argument("prefix", help="Where to deploy the manifest.")
-    if 1 or conda_manifest.config.DEBUG:
-        args = parser.parse_args(['env_lts.manifest', '/downloads/foobar',
-                                  '--sources', '../sources.yaml'])
-    else:
-        args = parser.parse_args()
+from conda_manifest.file_store import FileStore
+from conda_manifest.relocate import link_dist, unlink_dist
+from conda_manifest.sources import load_sources
 
-    sources = load_sources(args.sources)
 
-    manifest = args.manifest
-    prefix = args.prefix
+def read_manifest(fname):
+    """
+    Read the given manifest, returning a dictionary mapping source name to
+    the (canonical names of the) distributions which come from that source.
 
+    """
     # Map source to a list of canonical package name.
     packages_by_source = {}
-    with open(args.manifest, 'r') as fh:
+    with open(fname, 'r') as fh:
         for line in fh:
             name, version, build_str, source = line.split()
             packages_by_source.setdefault(source, []).append('{}-{}-{}'.format(name, version, build_str))
-    print packages_by_source
+    return packages_by_source
 
-    import conda.install as ci
-    linked = ci.linked(prefix)
-    # TODO: Find out what the source of the linked package is!
-    print linked
 
-    import conda_manifest.config
-    import conda.install as cinstall
+def dist_tarball(source_name, dist):
+    """The tarball of the given distribution, built for the given source."""
+    src_distro_dir = conda_manifest.config.src_distributions_dir(source_name)
+    return os.path.join(src_distro_dir, conda.config.subdir,
+                        dist) + '.tar.bz2'
 
-    pkgs_dir = '/downloads/manager/pkgs'
-    root_env_dir = '/downloads/manager/envs'
-    prefix = os.path.join(root_env_dir, 'lts')
-    if not os.path.exists(pkgs_dir):
-        os.makedirs(pkgs_dir)
 
-    for_installation = [pkg
-                        for packages in packages_by_source.values()
-                        for pkg in packages]
+def check_distributions(packages_by_source):
+    """
+    Check that the tarballs of all of the given distributions exist,
+    raising an IOError if any of them doesn't.
 
-    # Extract the pkgs if they haven't already been extracted.
+    """
     for source_name, packages in packages_by_source.items():
-        src_distro_dir = conda_manifest.config.src_distributions_dir(source_name)
         for dist in packages:
-            dist_tar = os.path.join(src_distro_dir,
-                                    conda.config.subdir,
-                                    dist) + '.tar.bz2'
+            dist_tar = dist_tarball(source_name, dist)
             if not os.path.exists(dist_tar):
                 raise IOError('Could not find {} at ({})\n'
                               'It may be that the content is out of synch. '
@@ -70,26 +60,501 @@ if __name__ == '__main__':
                               'of the distributions \nhave come from the existing '
                               "recipes (particularly if a recipe's version has "
                               "been decreased).".format(dist, dist_tar))
-            src_pkgs = os.path.join(pkgs_dir, source_name)
-            if not os.path.exists(src_pkgs):
-                os.makedirs(src_pkgs)
-            if not cinstall.is_extracted(src_pkgs, dist):
-                placed_dist_file = os.path.join(src_pkgs, dist + '.tar.bz2')
-                if not os.path.exists(placed_dist_file):
-                    import shutil
-                    shutil.copy(dist_tar, placed_dist_file)
-                cinstall.extract(src_pkgs, dist)
-                # Tidy up immediately by removing the distribution.
-                os.remove(placed_dist_file)
-
-    # Remove any packages which are no longer needed.
-    for dist in ci.linked(prefix):
-        if dist not in for_installation:
-            cinstall.unlink(prefix, dist)
-
-    # Install the packages.
-    for source_name, packages in packages_by_source.items():
-        src_distro_dir = conda_manifest.config.src_distributions_dir(source)
+
+
+def extract_dist(tarball, pkgs_dir, dist, store_dir=None):
+    """
+    Extract the given distribution tarball, in place, into the given
+    package cache as conda would (see :func:`conda.install.extract`),
+    without first copying the tarball into the cache.
+
+    The distribution is extracted into a temporary directory which is then
+    renamed, so the cache never holds a partially extracted distribution.
+    If a store_dir is given, the files are extracted as hardlinks to the
+    :class:`conda_manifest.file_store.FileStore` there.
+
+    """
+    path = os.path.join(pkgs_dir, dist)
+    tmp_path = os.path.join(pkgs_dir, '.{}.{}.tmp'.format(dist, os.getpid()))
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    try:
+        if store_dir is not None:
+            os.makedirs(tmp_path)
+            FileStore(store_dir).extract(tarball, tmp_path)
+        else:
+            with closing(tarfile.open(tarball, 'r:bz2')) as tar:
+                tar.extractall(path=tmp_path)
+        if sys.platform.startswith('linux') and os.getuid() == 0:
+            # When extracting as root, tar will by default restore ownership
+            # of extracted files. However, we want root to be the owner.
+            for root, dirs, files in os.walk(tmp_path):
+                for fn in files:
+                    os.lchown(os.path.join(root, fn), 0, 0)
+        if os.path.exists(path):
+            if cinstall.is_extracted(pkgs_dir, dist):
+                # Extracted by somebody else in the meantime.
+                return
+            # The remains of an interrupted extraction.
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+
+
+def _extract_dist(args):
+    extract_dist(*args)
+
+
+def source_pkgs_dir(pkgs_dir, source_name):
+    """The package cache, within pkgs_dir, of the given source."""
+    return os.path.join(pkgs_dir, source_name)
+
+
+def file_store_dir(pkgs_dir):
+    """The file store, within pkgs_dir, shared by all of the sources."""
+    return os.path.join(pkgs_dir, '.store')
+
+
+def extract_distributions(packages_by_source, pkgs_dir, processes=1,
+                          use_store=True):
+    """
+    Extract each of the given distributions, straight from the directory
+    of their source's distributions, into the source's package cache
+    (within pkgs_dir), if they haven't already been extracted. Returns the
+    distributions which were extracted.
+
+    Decompression is CPU bound, so up to ``processes`` distributions are
+    extracted concurrently in a pool of processes.
+
+    With use_store, the package caches are hardlinks to a single file
+    store (see :func:`file_store_dir`), so each distinct file is stored
+    once, whichever sources and distributions it is found in.
+
+    """
+    store_dir = file_store_dir(pkgs_dir) if use_store else None
+    tasks = []
+    for source_name, packages in sorted(packages_by_source.items()):
+        src_pkgs = source_pkgs_dir(pkgs_dir, source_name)
+        if not os.path.exists(src_pkgs):
+            os.makedirs(src_pkgs)
         for dist in packages:
-            src_pkgs = os.path.join(pkgs_dir, source_name)
-            cinstall.link(src_pkgs, prefix, dist)
+            if not cinstall.is_extracted(src_pkgs, dist):
+                tasks.append((dist_tarball(source_name, dist), src_pkgs,
+                              dist, store_dir))
+
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            pool.map(_extract_dist, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            _extract_dist(task)
+    return [task[2] for task in tasks]
+
+
+#: The changes needed to deploy a manifest to a prefix. ``add`` maps each
+#: distribution to be linked to its source, ``remove`` is the set of
+#: distributions to be unlinked and ``keep`` the set of distributions which
+#: are already linked.
+DeployPlan = collections.namedtuple('DeployPlan', ['add', 'remove', 'keep'])
+
+
+def plan_deploy(packages_by_source, linked):
+    """
+    Plan the deployment of the given distributions (by source) to a prefix
+    in which the given distributions are currently linked.
+
+    """
+    wanted = {dist: source_name
+              for source_name, packages in packages_by_source.items()
+              for dist in packages}
+    linked = set(linked)
+    add = {dist: source_name for dist, source_name in wanted.items()
+           if dist not in linked}
+    return DeployPlan(add, linked - set(wanted), linked & set(wanted))
+
+
+def dist_files(pkgs_dir, dist):
+    """The files of the given extracted distribution."""
+    with open(os.path.join(pkgs_dir, dist, 'info', 'files'), 'r') as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+
+def has_link_scripts(dist, files):
+    """Whether the given distribution has pre/post link scripts."""
+    name = dist.rsplit('-', 2)[0]
+    scripts = set('{}/.{}-{}-link.{}'.format(bin_dir, name, when, ext)
+                  for bin_dir, ext in [('bin', 'sh'), ('Scripts', 'bat')]
+                  for when in ['pre', 'post'])
+    return bool(scripts.intersection(files))
+
+
+def link_batches(dists, files):
+    """
+    Group the given distributions (in order) into batches which may be
+    linked concurrently: the distributions of a batch have disjoint sets of
+    files, and none has link scripts. Distributions with link scripts are
+    each in a batch of their own, after all of the others.
+
+    """
+    batches = []
+    batch_files = []
+    scripted = []
+    for dist in dists:
+        if has_link_scripts(dist, files[dist]):
+            scripted.append([dist])
+            continue
+        these_files = set(files[dist])
+        for batch, used in zip(batches, batch_files):
+            if used.isdisjoint(these_files):
+                batch.append(dist)
+                used.update(these_files)
+                break
+        else:
+            batches.append([dist])
+            batch_files.append(these_files)
+    return batches + scripted
+
+
+class DeployJournal(object):
+    """
+    An append-only journal of the steps of a deploy to a prefix. While a
+    deploy is in progress the journal exists, so an interrupted deploy can
+    be detected, and then resumed or rolled back.
+
+    Each line of the journal is a JSON object. The first is the plan, and
+    each of the others records the beginning or the end of the linking
+    or unlinking of a distribution.
+
+    """
+    FNAME = '.conda-manager-deploy.journal'
+
+    def __init__(self, prefix):
+        self.fname = os.path.join(prefix, self.FNAME)
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.fname)
+
+    def _append(self, entry):
+        with self._lock:
+            with open(self.fname, 'a') as fh:
+                fh.write(json.dumps(entry) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+
+    def start(self, plan):
+        directory = os.path.dirname(self.fname)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._append({'add': plan.add, 'remove': sorted(plan.remove)})
+
+    def record(self, action, dist, source_name, state):
+        """
+        Record that the action (``'link'`` or ``'unlink'``) of the given
+        distribution has reached the given state (``'begin'`` or
+        ``'done'``).
+
+        """
+        self._append({'action': action, 'dist': dist,
+                      'source': source_name, 'state': state})
+
+    def steps(self):
+        """
+        Return the (action, dist, source_name, done) of each step which was
+        begun, in the order in which they were begun.
+
+        """
+        steps = collections.OrderedDict()
+        with open(self.fname, 'r') as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line which was being written when interrupted.
+                    continue
+                if 'action' not in entry:
+                    continue
+                key = (entry['action'], entry['dist'])
+                done = entry['state'] == 'done'
+                steps[key] = (entry['action'], entry['dist'],
+                              entry['source'], done)
+        return list(steps.values())
+
+    def finish(self):
+        os.remove(self.fname)
+
+
+def find_extracted(pkgs_dir, dist):
+    """
+    Return the package cache (a source's directory within pkgs_dir) in
+    which the given distribution has been extracted, or None.
+
+    """
+    if not os.path.isdir(pkgs_dir):
+        return None
+    for source_name in sorted(os.listdir(pkgs_dir)):
+        src_pkgs = source_pkgs_dir(pkgs_dir, source_name)
+        if cinstall.is_extracted(src_pkgs, dist):
+            return src_pkgs
+
+
+def _remove_partial_link(prefix, src_pkgs, dist):
+    """Remove the files of a distribution whose linking was interrupted."""
+    if cinstall.is_linked(prefix, dist):
+        unlink_dist(prefix, dist)
+    elif src_pkgs is not None and cinstall.is_extracted(src_pkgs, dist):
+        for fname in dist_files(src_pkgs, dist):
+            path = os.path.join(prefix, fname)
+            if os.path.lexists(path):
+                os.remove(path)
+
+
+def rollback(prefix, pkgs_dir):
+    """
+    Roll back the interrupted deploy to the given prefix, undoing each of
+    its steps (including any which was interrupted) in reverse order.
+
+    """
+    journal = DeployJournal(prefix)
+    if not journal.exists():
+        conda_manifest.config.stdout.info('There is no interrupted deploy to '
+                                          '{} to roll back.\n'.format(prefix))
+        return
+    for action, dist, source_name, done in reversed(journal.steps()):
+        if action == 'link':
+            _remove_partial_link(prefix,
+                                 source_pkgs_dir(pkgs_dir, source_name),
+                                 dist)
+        else:
+            src_pkgs = find_extracted(pkgs_dir, dist)
+            if src_pkgs is None:
+                raise IOError('Unable to restore {}, as it is not in the '
+                              'package cache.'.format(dist))
+            link_dist(src_pkgs, prefix, dist)
+    journal.finish()
+
+
+def _recover(prefix, pkgs_dir, journal):
+    # Tidy up any links which were interrupted, so that the deploy can be
+    # planned from the distributions which are fully linked.
+    for action, dist, source_name, done in journal.steps():
+        if action == 'link' and not done:
+            _remove_partial_link(prefix,
+                                 source_pkgs_dir(pkgs_dir, source_name),
+                                 dist)
+    journal.finish()
+
+
+def execute_plan(plan, prefix, pkgs_dir, journal, threads=4):
+    """
+    Make the changes of the given plan to the prefix, recording each step
+    in the journal. Distributions are unlinked one at a time, and then
+    linked concurrently in batches (see :func:`link_batches`), with the
+    files of each distribution also linked concurrently (see
+    :func:`conda_manifest.relocate.link_dist`).
+
+    """
+    journal.start(plan)
+    for dist in sorted(plan.remove):
+        journal.record('unlink', dist, None, 'begin')
+        unlink_dist(prefix, dist)
+        journal.record('unlink', dist, None, 'done')
+
+    def link(dist):
+        source_name = plan.add[dist]
+        journal.record('link', dist, source_name, 'begin')
+        try:
+            link_dist(source_pkgs_dir(pkgs_dir, source_name), prefix, dist,
+                      pool=file_pool)
+        except SystemExit as err:
+            # conda reports failures to link with sys.exit, which would end
+            # a pool's worker thread without a result (so that the pool
+            # never returns). The journal is left for a resume or rollback.
+            raise RuntimeError('Failed to link {} into {}: {}'
+                               ''.format(dist, prefix, err))
+        journal.record('link', dist, source_name, 'done')
+
+    to_link = sorted(plan.add)
+    files = {dist: dist_files(source_pkgs_dir(pkgs_dir, plan.add[dist]),
+                              dist)
+             for dist in to_link}
+    batches = link_batches(to_link, files)
+    # conda creates the directories it links into as it goes, which races
+    # between concurrent links, so create them all up front.
+    directories = set(os.path.dirname(os.path.join(prefix, fname))
+                      for dist_fnames in files.values()
+                      for fname in dist_fnames)
+    directories.add(os.path.join(prefix, 'conda-meta'))
+    for directory in sorted(directories):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    pool = ThreadPool(threads) if threads > 1 else None
+    file_pool = ThreadPool(threads) if threads > 1 else None
+    try:
+        for batch in batches:
+            if pool is not None and len(batch) > 1:
+                pool.map(link, batch)
+            else:
+                for dist in batch:
+                    link(dist)
+    finally:
+        for a_pool in [pool, file_pool]:
+            if a_pool is not None:
+                a_pool.close()
+                a_pool.join()
+    journal.finish()
+
+
+def deploy_to_prefix(packages_by_source, prefix, pkgs_dir, threads=4):
+    """
+    Deploy the given (already extracted) distributions (by source) to the
+    prefix, linking and unlinking only the distributions which differ from
+    those already linked.
+
+    If a previous deploy to the prefix was interrupted, it is resumed.
+    Returns the :class:`DeployPlan` which was executed.
+
+    """
+    journal = DeployJournal(prefix)
+    if journal.exists():
+        conda_manifest.config.stdout.info('Resuming the interrupted deploy '
+                                          'to {}.\n'.format(prefix))
+        _recover(prefix, pkgs_dir, journal)
+    plan = plan_deploy(packages_by_source, cinstall.linked(prefix))
+    execute_plan(plan, prefix, pkgs_dir, journal, threads=threads)
+    return plan
+
+
+def deploy(packages_by_source, prefix, pkgs_dir, processes=1, threads=4,
+           use_store=True):
+    """
+    Deploy the given distributions (by source) to the prefix, extracting
+    them into the package cache as necessary. See
+    :func:`deploy_to_prefix`.
+
+    """
+    check_distributions(packages_by_source)
+    extract_distributions(packages_by_source, pkgs_dir, processes=processes,
+                          use_store=use_store)
+    return deploy_to_prefix(packages_by_source, prefix, pkgs_dir,
+                            threads=threads)
+
+
+#: The outcome of deploying to a prefix: the executed :class:`DeployPlan`,
+#: or the error (traceback) if the deploy failed.
+PrefixResult = collections.namedtuple('PrefixResult',
+                                      ['prefix', 'plan', 'error'])
+
+
+def deploy_prefixes(packages_by_source, prefixes, pkgs_dir, processes=1,
+                    threads=4, use_store=True):
+    """
+    Deploy the given distributions (by source) to each of the prefixes.
+
+    The distributions are checked and extracted into the shared package
+    cache once, and then all of the prefixes are deployed to concurrently.
+    Returns a :class:`PrefixResult` for each prefix: a failure to deploy
+    to one prefix does not prevent the deploys to the others.
+
+    """
+    check_distributions(packages_by_source)
+    extract_distributions(packages_by_source, pkgs_dir, processes=processes,
+                          use_store=use_store)
+
+    def deploy_one(prefix):
+        try:
+            plan = deploy_to_prefix(packages_by_source, prefix, pkgs_dir,
+                                    threads=threads)
+        except (Exception, SystemExit):
+            # conda reports failures to link (e.g. of a link script) with
+            # sys.exit, which would otherwise end the pool's worker thread
+            # without a result, so that the pool never returns.
+            return PrefixResult(prefix, None, traceback.format_exc())
+        return PrefixResult(prefix, plan, None)
+
+    if len(prefixes) > 1:
+        pool = ThreadPool(len(prefixes))
+        try:
+            return pool.map(deploy_one, prefixes)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return [deploy_one(prefix) for prefix in prefixes]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Deploy the given manifest to one or "
+                                     "more prefixes.")
+    parser.add_argument("--sources", default='sources.yaml',
+                        help="Location of sources.yaml")
+    parser.add_argument("--pkgs-dir", default='/downloads/manager/pkgs',
+                        help=("The package cache to extract distributions "
+                              "into."))
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help=("The number of distributions to extract "
+                              "concurrently."))
+    parser.add_argument("--rollback", action='store_true',
+                        help=("Roll back an interrupted deploy to the "
+                              "prefixes, rather than resuming it."))
+    parser.add_argument("--no-store", action='store_true',
+                        help=("Extract distributions without sharing their "
+                              "files through the package cache's file "
+                              "store."))
+    parser.add_argument("--prune-store", action='store_true',
+                        help=("Remove the files from the file store which "
+                              "are no longer used by any package cache."))
+    parser.add_argument("manifest", help="The manifest to deploy.")
+    parser.add_argument("prefixes", nargs='+', metavar='prefix',
+                        help="Where to deploy the manifest.")
+    if 1 or conda_manifest.config.DEBUG:
+        args = parser.parse_args(['env_lts.manifest',
+                                  '/downloads/manager/envs/lts',
+                                  '--sources', '../sources.yaml'])
+    else:
+        args = parser.parse_args()
+
+    sources = load_sources(args.sources)
+
+    pkgs_dir = args.pkgs_dir
+
+    packages_by_source = read_manifest(args.manifest)
+    conda_manifest.config.stdout.debug('{}\n'.format(packages_by_source))
+
+    if not os.path.exists(pkgs_dir):
+        os.makedirs(pkgs_dir)
+
+    if args.rollback:
+        for prefix in args.prefixes:
+            rollback(prefix, pkgs_dir)
+    else:
+        results = deploy_prefixes(packages_by_source, args.prefixes,
+                                  pkgs_dir, processes=args.jobs,
+                                  use_store=not args.no_store)
+        for result in results:
+            if result.error is not None:
+                conda_manifest.config.stdout.warn(
+                    'Failed to deploy to {}:\n{}\n'.format(result.prefix,
+                                                           result.error))
+            else:
+                plan = result.plan
+                conda_manifest.config.stdout.info(
+                    'Linked {}, unlinked {} and kept {} distributions in '
+                    '{}.\n'.format(len(plan.add), len(plan.remove),
+                                   len(plan.keep), result.prefix))
+        failed = [result.prefix for result in results
+                  if result.error is not None]
+        if failed:
+            raise SystemExit('Failed to deploy to: {}'
+                             ''.format(', '.join(failed)))
+
+    if args.prune_store:
+        removed = FileStore(file_store_dir(pkgs_dir)).prune()
+        conda_manifest.config.stdout.info('Removed {} unused files from the '
+                                          'file store.\n'.format(removed))
@@ -1,15 +1,15 @@
+import collections
 import yaml
 import os
 import glob
+import multiprocessing
 
 import shutil
 import json
 
-from conda.resolve import Resolve, MatchSpec
-from copy import deepcopy
-
-from conda_build_missing import find_all_recipes
-
+import conda_manifest.config
+from conda_manifest.recipe_cache import find_all_recipes
+from conda_manifest.records import match_spec
 from conda_manifest.sources import load_sources
 
 
@@ -28,6 +28,103 @@ def load_envs(environment_globs):
     return envs
 
 
+class RecipeIndex(object):
+    """
+    An index of the metas (recipes) that each source provides, keyed by
+    package name.
+
+    Parameters
+    ----------
+    source_metas - dict mapping source name to list of conda metas
+        The metas (recipes) that each source provides.
+
+    """
+    def __init__(self, source_metas):
+        self._index = {}
+        for source, metas in source_metas.items():
+            by_name = self._index[source] = {}
+            for meta in metas:
+                by_name.setdefault(meta.name(), []).append(meta)
+
+    def metas(self, source, name):
+        """The metas for the given package name in the given source."""
+        return self._index[source].get(name, ())
+
+    def closure(self, env_sources, env_specs):
+        """
+        Return the :class:`RecipeClosure` of the given env specs. See
+        :func:`filter_packages` for a description of the arguments.
+
+        """
+        return RecipeClosure(self, env_sources, env_specs)
+
+
+class RecipeClosure(object):
+    """
+    The dependency closure of a set of env specs over a
+    :class:`RecipeIndex`, as described by :func:`filter_packages`.
+
+    Attributes
+    ----------
+    where_from - dict
+        A dictionary mapping package name, to a list of
+        (src_name, meta) pairs (the result of :func:`filter_packages`).
+    dependencies - dict
+        A dictionary mapping package name, to the set of the names of
+        the packages its recipes depend upon (at build or run time).
+    reverse_dependencies - dict
+        A dictionary mapping package name, to the set of the names of
+        the packages whose recipes depend upon it.
+
+    """
+    def __init__(self, recipe_index, env_sources, env_specs):
+        self.where_from = where_from = {}
+        self.dependencies = dependencies = {}
+        self.reverse_dependencies = reverse_dependencies = {}
+        visited = set()
+        specs = list(env_specs)
+        while specs:
+            package = specs.pop()
+            name = match_spec(package).name
+            if name in visited:
+                continue
+            visited.add(name)
+            for sources in env_sources:
+                for source in sources:
+                    # n.b. all sources here should have an equal standing
+                    # on whether a package is included, so no breaks
+                    # within this loop.
+                    for meta in recipe_index.metas(source, name):
+                        all_deps = (tuple(meta.get_value('requirements/run', ())) +
+                                    tuple(meta.get_value('requirements/build', ())))
+                        # Put any unvisited deps in as specs.
+                        for dep in all_deps:
+                            dep_name = match_spec(dep).name
+                            dependencies.setdefault(name, set()).add(dep_name)
+                            reverse_dependencies.setdefault(
+                                dep_name, set()).add(name)
+                            if dep_name not in visited:
+                                specs.append(dep)
+                        where_from.setdefault(name, []).append((source, meta))
+                if name in where_from:
+                    break
+
+    def dependents(self, name):
+        """
+        The names of all of the packages which depend, directly or
+        indirectly, on the given package.
+
+        """
+        result = set()
+        todo = [name]
+        while todo:
+            for dependent in self.reverse_dependencies.get(todo.pop(), ()):
+                if dependent not in result:
+                    result.add(dependent)
+                    todo.append(dependent)
+        return result
+
+
 def filter_packages(env_sources, env_specs, source_metas):
     """
     Figure out which packages are needed, given the env specs, and
@@ -46,7 +143,9 @@ def filter_packages(env_sources, env_specs, source_metas):
         The specification for the environment. These will be cast to
         MatchSpecs, as per usual conda specifications.
     source_metas - dict mapping source name to list of conda metas
-        The metas (recipes) that each source provides.
+        The metas (recipes) that each source provides. A
+        :class:`RecipeIndex` may be given instead, which avoids
+        re-indexing the metas when filtering for many environments.
 
     Returns
     -------
@@ -56,40 +155,53 @@ def filter_packages(env_sources, env_specs, source_metas):
         traversed, and every dependency which is resolvable will have
         been resolved. If a dependency is listed for which there is no source,
         the algorithm will continue without the missing dependency.
+        See :class:`RecipeClosure` for a richer form of the result.
 
     """
-    source_meta_names = {src: [meta.name() for meta in metas]
-                         for src, metas in source_metas.items()}
-    where_from = {}
-    specs = deepcopy(env_specs)
-    while specs:
-        package = specs.pop()
-        name = MatchSpec(package).name
-        for sources in env_sources:
-            if name in where_from:
-                break
-            for source in sources:
-                # n.b. all sources here should have an equal standing on
-                # whether a package is included, so no breaks within this loop.
-
-                if name in source_meta_names[source]:
-                    metas = [meta for meta in source_metas[source]
-                             if meta.name() == name]
-                    for meta in metas:
-                        all_deps = (tuple(meta.get_value('requirements/run', ())) +
-                                    tuple(meta.get_value('requirements/build', ())))
-                        # Put any missing deps in as specs.
-                        for dep in all_deps:
-                            dep_name = MatchSpec(dep).name
-                            if dep_name not in where_from:
-                                specs.append(dep)
-                        where_from.setdefault(name, []).append((source, meta))
-    return where_from
+    if not isinstance(source_metas, RecipeIndex):
+        source_metas = RecipeIndex(source_metas)
+    return source_metas.closure(env_sources, env_specs).where_from
+
+
+#: The changes made to an environment's recipe directory by
+#: :func:`create_env_recipes`. Each is a sorted list of recipe link names.
+RecipeChanges = collections.namedtuple('RecipeChanges',
+                                       ['added', 'removed', 'retargeted',
+                                        'unchanged'])
+
+
+#: The name of the file, within an environment's recipe directory, which
+#: records the source and location of each of the recipes.
+ENV_RECIPES_STATE = 'env_recipes.json'
+
+
+def load_env_recipes(location):
+    """
+    Load the state of the given environment recipe directory, as written
+    by :func:`create_env_recipes`. This is a dictionary with the keys:
+
+     * ``recipes`` - mapping recipe link name to a dictionary with the
+       ``source`` name and the ``path`` of the recipe in that source.
+     * ``changed`` - the names of the recipe links which were added or
+       retargeted by the most recent :func:`create_env_recipes`.
+
+    """
+    fname = os.path.join(location, ENV_RECIPES_STATE)
+    if not os.path.exists(fname):
+        return {'recipes': {}, 'changed': []}
+    with open(fname, 'r') as fh:
+        return json.load(fh)
 
 
 def create_env_recipes(pkgs, location):
     """
-    Create a clean directory of all the recipes in the source metas.
+    Synchronise a directory of links to all the recipes in the source
+    metas.
+
+    Only the links which differ from those already in the directory are
+    added, removed or retargeted, so that unchanged recipes are left
+    untouched. The source of each recipe is recorded in the directory
+    (see :func:`load_env_recipes`), rather than in the recipe itself.
 
     Parameters
     ----------
@@ -98,42 +210,105 @@ def create_env_recipes(pkgs, location):
         pkgs is a dictionary mapping package name to an iterable of
         (src_name, meta) pairs.
     target_location - str
-        Where the clean directory of recipes should be placed. If the
-        directory already exists, it will be emptied before proceeding.
+        Where the directory of recipes should be placed. Anything in the
+        directory which is not one of the recipes will be removed.
 
-    """
-    if os.path.exists(location):
-        shutil.rmtree(location)
-    os.mkdir(location)
+    Returns
+    -------
+    changes - :class:`RecipeChanges`
 
-    # Turn this information into a single place for all of the recipes.
+    """
+    desired = {}
     for pkg_name, sources in pkgs.items():
         for src_name, meta in sources:
-            link_locn = os.path.join(location, '{}_{}'.format(src_name,
-                                                              meta.dist()))
-            if os.path.exists(link_locn):
+            link_name = '{}_{}'.format(src_name, meta.dist())
+            if link_name in desired:
                 raise ValueError('{} has multiple recipes for {}'
                                  ''.format(src_name, meta.dist()))
-            os.symlink(meta.path, link_locn)
-            with open(os.path.join(link_locn, 'source.json'), 'w') as fh:
-                # TODO: Make this repeatable information (full URL, tag etc.)
-                json.dump({'name': src_name}, fh)
+            desired[link_name] = {'source': src_name, 'path': meta.path}
+
+    if not os.path.isdir(location):
+        if os.path.lexists(location):
+            os.remove(location)
+        os.mkdir(location)
 
+    added, removed, retargeted, unchanged = [], [], [], []
+    for name in os.listdir(location):
+        if name == ENV_RECIPES_STATE or name in desired:
+            continue
+        path = os.path.join(location, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        removed.append(name)
 
-def source_metas(sources):
+    for link_name, recipe in desired.items():
+        link_locn = os.path.join(location, link_name)
+        if os.path.islink(link_locn):
+            if os.readlink(link_locn) == recipe['path']:
+                unchanged.append(link_name)
+                continue
+            # Replace the link atomically.
+            tmp_link = link_locn + '.tmp'
+            if os.path.lexists(tmp_link):
+                os.remove(tmp_link)
+            os.symlink(recipe['path'], tmp_link)
+            os.rename(tmp_link, link_locn)
+            retargeted.append(link_name)
+        else:
+            if os.path.isdir(link_locn):
+                shutil.rmtree(link_locn)
+            elif os.path.lexists(link_locn):
+                os.remove(link_locn)
+            os.symlink(recipe['path'], link_locn)
+            added.append(link_name)
+
+    changes = RecipeChanges(*[sorted(names) for names in
+                              [added, removed, retargeted, unchanged]])
+    state_fname = os.path.join(location, ENV_RECIPES_STATE)
+    with open(state_fname + '.tmp', 'w') as fh:
+        # TODO: Make this repeatable information (full URL, tag etc.)
+        json.dump({'recipes': desired,
+                   'changed': sorted(changes.added + changes.retargeted)},
+                  fh, indent=2, sort_keys=True)
+    os.rename(state_fname + '.tmp', state_fname)
+    return changes
+
+
+def _find_source_recipes(source_dir):
+    return list(find_all_recipes([source_dir]))
+
+
+def source_metas(sources, jobs=1):
     """
     Given the sources, return a dictionary of all conda recipes
-    keyed by source name.
+    keyed by source name. Parsed recipes are cached between runs (see
+    :mod:`conda_manifest.recipe_cache`), and up to ``jobs`` sources are
+    scanned concurrently in a pool of processes.
+
+    The result is independent of any environment, so should be computed
+    once and shared between all of the environments being handled.
 
     """
     # Map source name to location of source.
     source_dict = {source_name: os.path.join(conda_manifest.config.build_root,
                                              source_name)
                    for source_name, source in sources.items()}
+    source_names = sorted(source_dict)
+    source_dirs = [source_dict[src] for src in source_names]
     # Map source name to all metas within the source.
-    source_metas = {src: list(find_all_recipes([source_dict[src]]))
-                    for src in sources}
-    return source_metas
+    if jobs > 1 and len(source_dirs) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(source_dirs)))
+        try:
+            all_metas = pool.map(_find_source_recipes, source_dirs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        all_metas = [_find_source_recipes(source_dir)
+                     for source_dir in source_dirs]
+    return dict(zip(source_names, all_metas))
 
 
 if __name__ == '__main__':
@@ -147,6 +322,9 @@ if __name__ == '__main__':
                         help="Location of sources.yaml")
     parser.add_argument("--envs", nargs='+', default=['env.specs/*.yaml'],
                         help="Glob pattern of environment yamls.")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="The number of processes to scan sources with.")
     if 1 or conda_manifest.config.DEBUG:
         args = parser.parse_args(['--envs', '../env.specs/*.yaml',
                                   '--sources', '../sources.yaml'])
@@ -159,10 +337,13 @@ if __name__ == '__main__':
     envs = load_envs(args.envs)
 
     with conda_manifest.config.managed_stdout():
+        recipe_index = RecipeIndex(source_metas(sources, jobs=args.jobs))
         for env in envs:
             env_recipe_dir = conda_manifest.config.env_recipes_dir(env=env)
             print("Creating {}'s environment recipes in {}"
                   "".format(env['name'], env_recipe_dir))
             pkgs = filter_packages(env['sources'], env['packages'],
-                                   source_metas(sources))
-            create_env_recipes(pkgs, env_recipe_dir)
+                                   recipe_index)
+            changes = create_env_recipes(pkgs, env_recipe_dir)
+            print('  {} added, {} removed, {} retargeted, {} unchanged'
+                  ''.format(*[len(names) for names in changes]))
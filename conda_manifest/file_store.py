@@ -0,0 +1,263 @@
+"""
+A content-addressed store of the files of extracted distributions, shared
+by all of the sources' package caches within a pkgs dir.
+
+Each distinct file (by sha256 and mode) is stored once, as
+``<root>/objects/<sha256[:2]>/<sha256>-<mode>``, and the extracted
+distributions are materialized as hardlinks to the stored files. A file
+which is identical in several distributions (e.g. in successive builds of
+a package), or in the same distribution built for several sources,
+therefore takes up space only once, and the prefixes which are linked from
+the package caches share its inode.
+
+The hardlinks share the stored file's modification time, so that of a
+tarball's member is generally not kept (the stored file has the time at
+which it was first stored): conda-build gives the files of every build new
+modification times, which would otherwise prevent them from being shared.
+The exception is Python source files (see :func:`keeps_mtime`), as a
+``.pyc`` file is only valid for the modification time of its source:
+these keep their member's modification time, as with
+:meth:`tarfile.TarFile.extractall`, and it is part of their stored file's
+identity (``<sha256>-<mode>-<mtime>``).
+
+The members of each distribution tarball which has been extracted are
+recorded (keyed by the tarball's sha256), so that a tarball which has
+already been extracted (for another source, say) is materialized straight
+from the store, without being decompressed.
+
+As with conda's hardlinked package cache, stored files must never be
+modified in place.
+
+"""
+from contextlib import closing
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import uuid
+
+from conda_manifest.artefact_cache import sha256_file
+
+
+#: Files up to this size are read into memory, and only written to the
+#: store if they aren't already stored. Larger files are streamed.
+CHUNK_SIZE = 1024 * 1024
+
+
+def keeps_mtime(name):
+    """
+    Whether the modification time of the tarball member of the given name
+    must be kept when it is extracted through a :class:`FileStore`.
+
+    """
+    return name.endswith('.py')
+
+
+class FileStore(object):
+    """
+    The store of files rooted at the given directory, which must be on the
+    same filesystem as the package caches that are extracted from it.
+
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _makedirs(self, directory):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def object_path(self, sha256, mode, mtime=None):
+        name = '{}-{:o}'.format(sha256, mode)
+        if mtime is not None:
+            name = '{}-{}'.format(name, mtime)
+        return os.path.join(self.root, 'objects', sha256[:2], name)
+
+    def manifest_path(self, tarball_sha256):
+        return os.path.join(self.root, 'dists', tarball_sha256 + '.json')
+
+    def _tmp_path(self):
+        tmp_dir = os.path.join(self.root, 'tmp')
+        self._makedirs(tmp_dir)
+        return os.path.join(tmp_dir, uuid.uuid4().hex)
+
+    def _store(self, tmp_fname, sha256, mode, mtime):
+        path = self.object_path(sha256, mode, mtime)
+        if os.path.exists(path):
+            os.remove(tmp_fname)
+        else:
+            self._makedirs(os.path.dirname(path))
+            os.chmod(tmp_fname, mode)
+            if mtime is not None:
+                os.utime(tmp_fname, (mtime, mtime))
+            os.rename(tmp_fname, path)
+        return path
+
+    def add(self, fh, mode, mtime=None):
+        """
+        Add the content of the given file object, with the given mode and
+        optionally modification time (an integer), to the store, returning
+        (sha256, path of the stored file).
+
+        """
+        data = fh.read(CHUNK_SIZE)
+        more = fh.read(CHUNK_SIZE)
+        hsh = hashlib.sha256(data)
+        if not more:
+            sha256 = hsh.hexdigest()
+            path = self.object_path(sha256, mode, mtime)
+            if os.path.exists(path):
+                return sha256, path
+            tmp_fname = self._tmp_path()
+            with open(tmp_fname, 'wb') as out:
+                out.write(data)
+            return sha256, self._store(tmp_fname, sha256, mode, mtime)
+
+        tmp_fname = self._tmp_path()
+        try:
+            with open(tmp_fname, 'wb') as out:
+                while data:
+                    out.write(data)
+                    data, more = more, fh.read(CHUNK_SIZE)
+                    hsh.update(data)
+        except Exception:
+            os.remove(tmp_fname)
+            raise
+        sha256 = hsh.hexdigest()
+        return sha256, self._store(tmp_fname, sha256, mode, mtime)
+
+    def _link(self, path, target):
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copy2(path, target)
+
+    def _extract(self, tarball, target):
+        """
+        Extract the tarball into the target directory, adding its files to
+        the store. Returns the members of the tarball, or None if it has
+        members which can't be materialized from the store.
+
+        """
+        members = []
+        dirs = []
+        with closing(tarfile.open(tarball, 'r:bz2')) as tar:
+            for member in tar:
+                path = os.path.join(target, member.name)
+                mode, mtime = member.mode & 0o7777, int(member.mtime)
+                if member.isdir():
+                    self._makedirs(path)
+                    dirs.append((path, mode, mtime))
+                    if members is not None:
+                        members.append(['dir', member.name, mode, mtime])
+                    continue
+                self._makedirs(os.path.dirname(path))
+                if member.isfile():
+                    if not keeps_mtime(member.name):
+                        mtime = None
+                    with closing(tar.extractfile(member)) as fh:
+                        sha256, stored = self.add(fh, mode, mtime)
+                    self._link(stored, path)
+                    entry = ['file', member.name, sha256, mode, mtime]
+                elif member.issym():
+                    os.symlink(member.linkname, path)
+                    entry = ['symlink', member.name, member.linkname]
+                elif member.islnk():
+                    os.link(os.path.join(target, member.linkname), path)
+                    entry = ['link', member.name, member.linkname]
+                else:
+                    tar.extract(member, target)
+                    entry = None
+                if entry is None:
+                    members = None
+                elif members is not None:
+                    members.append(entry)
+        self._set_dir_attrs(dirs)
+        return members
+
+    def _set_dir_attrs(self, dirs):
+        # As tarfile.extractall, set the modes and modification times of
+        # directories last (once their content has been created).
+        for path, mode, mtime in reversed(dirs):
+            os.utime(path, (mtime, mtime))
+            os.chmod(path, mode)
+
+    def _materialize(self, members, target):
+        """
+        Materialize the given members into the target directory from the
+        store. Returns False if any of the stored files is missing.
+
+        """
+        dirs = []
+        for member in members:
+            kind, name = member[:2]
+            path = os.path.join(target, name)
+            if kind == 'dir':
+                self._makedirs(path)
+                dirs.append((path, member[2], member[3]))
+                continue
+            self._makedirs(os.path.dirname(path))
+            if kind == 'file':
+                stored = self.object_path(*member[2:])
+                if not os.path.exists(stored):
+                    return False
+                self._link(stored, path)
+            elif kind == 'symlink':
+                os.symlink(member[2], path)
+            elif kind == 'link':
+                os.link(os.path.join(target, member[2]), path)
+        self._set_dir_attrs(dirs)
+        return True
+
+    def extract(self, tarball, target):
+        """
+        Extract the given distribution tarball into the (new) target
+        directory, as hardlinks to the store. Returns whether the tarball
+        had to be decompressed.
+
+        """
+        tarball_sha256 = sha256_file(tarball)
+        manifest = self.manifest_path(tarball_sha256)
+        try:
+            with open(manifest, 'r') as fh:
+                members = json.load(fh)
+        except (IOError, ValueError):
+            members = None
+        if members is not None:
+            if self._materialize(members, target):
+                return False
+            # Stored files have been pruned since the tarball was last
+            # extracted, so start again.
+            shutil.rmtree(target)
+
+        members = self._extract(tarball, target)
+        if members is not None:
+            self._makedirs(os.path.dirname(manifest))
+            tmp_fname = self._tmp_path()
+            with open(tmp_fname, 'w') as fh:
+                json.dump(members, fh)
+            os.rename(tmp_fname, manifest)
+        return True
+
+    def prune(self):
+        """
+        Remove the stored files which are no longer linked from anywhere
+        (i.e. which have only one link), returning the number removed.
+
+        """
+        removed = 0
+        objects_dir = os.path.join(self.root, 'objects')
+        if not os.path.isdir(objects_dir):
+            return removed
+        for bucket in os.listdir(objects_dir):
+            bucket_dir = os.path.join(objects_dir, bucket)
+            for fname in os.listdir(bucket_dir):
+                path = os.path.join(bucket_dir, fname)
+                if os.lstat(path).st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+        return removed
@@ -0,0 +1,90 @@
+"""
+Content-addressed fingerprints of builds, so that a build can be skipped
+when none of its inputs have changed since its artefact was built.
+
+"""
+import hashlib
+import json
+import os
+
+import conda_manifest.core_vn_matrix as vn_matrix
+from conda_manifest.recipe_cache import recipe_hash
+
+
+def build_fingerprint(recipe_hash, source_name, case, build_dists):
+    """
+    Compute the fingerprint of a build from all of its inputs: the hash of
+    the recipe's files, the name of the source, the version matrix case
+    and the distributions which satisfy the build requirements.
+
+    """
+    inputs = {'recipe': recipe_hash,
+              'source': source_name,
+              'case': sorted(list(item) for item in case),
+              'build_dists': sorted(build_dists)}
+    content = json.dumps(inputs, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def resolve_build_dists(meta, case, resolver):
+    """
+    Return the (sorted) distributions which satisfy the build requirements
+    of the given meta for the given case, using the given
+    :class:`conda_manifest.solver.Solver` (or :class:`conda.resolve.Resolve`).
+    If the requirements cannot be satisfied, the (sorted) requirement specs
+    are returned instead.
+
+    """
+    specs = (list(meta.get_value('requirements/build', [])) +
+             vn_matrix.case_specs(case))
+    try:
+        return sorted(resolver.solve(specs))
+    except (SystemExit, RuntimeError):
+        return sorted(specs)
+
+
+def job_fingerprint(job, resolver):
+    """The fingerprint of a :class:`~conda_manifest.build_scheduler.BuildJob`."""
+    return build_fingerprint(recipe_hash(job.meta.path), job.source_name,
+                             job.case,
+                             resolve_build_dists(job.meta, job.case, resolver))
+
+
+class FingerprintStore(object):
+    """
+    A persistent record of the artefact built for each build fingerprint.
+
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        try:
+            with open(fname, 'r') as fh:
+                self._artefacts = json.load(fh)
+        except (IOError, ValueError):
+            self._artefacts = {}
+
+    def lookup(self, fingerprint):
+        """
+        Return the path of the artefact recorded for the given fingerprint,
+        or None if there is no such artefact (or it no longer exists).
+
+        """
+        dist_path = self._artefacts.get(fingerprint)
+        if dist_path is not None and os.path.exists(dist_path):
+            return dist_path
+
+    def record(self, fingerprint, dist_path):
+        """Record the artefact built for the given fingerprint."""
+        self._artefacts[fingerprint] = dist_path
+        # Forget the artefacts which no longer exist.
+        self._artefacts = {fp: path for fp, path in self._artefacts.items()
+                           if os.path.exists(path)}
+        self._save()
+
+    def _save(self):
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.fname + '.tmp', 'w') as fh:
+            json.dump(self._artefacts, fh, indent=2, sort_keys=True)
+        os.rename(self.fname + '.tmp', self.fname)
@@ -0,0 +1,449 @@
+"""
+Package index handling for the conda-manager: combining the indices of
+the built distributions of each source into a single index for an
+environment.
+
+"""
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+from contextlib import closing
+import hashlib
+import json
+import os
+import tarfile
+
+import conda.config
+from conda.utils import url_path
+
+import conda_manifest.config
+from conda_manifest.records import PackageRecord, SlottedMapping
+
+
+_DELETED = object()
+
+
+class SourcedPackageInfo(SlottedMapping):
+    """
+    A view of a package's info (a record from a source's index) with the
+    name of the source added, without copying the underlying record.
+
+    Modifications are held by the view, and are never written through to
+    the underlying record (which may be shared between many indices).
+
+    """
+    __slots__ = ('info', 'overrides')
+
+    def __init__(self, info, source):
+        self.info = info
+        self.overrides = {'source': source}
+
+    @property
+    def source(self):
+        return self['source']
+
+    def __getitem__(self, key):
+        value = self.overrides.get(key, self.info.get(key, _DELETED))
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.info:
+            self.overrides[key] = _DELETED
+        else:
+            del self.overrides[key]
+
+    def __iter__(self):
+        for key in self.info:
+            if self.overrides.get(key) is not _DELETED:
+                yield key
+        for key, value in self.overrides.items():
+            if key not in self.info and value is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        """Return a plain dictionary copy of the record."""
+        return dict(self.items())
+
+    def __reduce__(self):
+        return (_unpickle_view, (self.info, self.overrides))
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.copy())
+
+
+MutableMapping.register(SourcedPackageInfo)
+
+
+def _unpickle_view(info, overrides):
+    view = SourcedPackageInfo(info, None)
+    view.overrides = overrides
+    return view
+
+
+class LayeredIndex(dict):
+    """
+    The index of an environment, mapping distribution filename to
+    package info, given the index of each source and the environment's
+    layering of sources.
+
+    Sources at the same level have equal standing, whereas a package
+    name provided by any source at one level shadows all packages of that
+    name at later levels. Each value is a :class:`SourcedPackageInfo`
+    which adds the ``source`` of the package to the source index's record
+    without copying it.
+
+    The digest of the index (see :func:`index_digest`) and its name-keyed
+    view are maintained as entries are set, deleted and inserted, so that
+    they needn't be recomputed from the whole index as it changes.
+
+    Parameters
+    ----------
+    src_indices - dict
+        A dictionary mapping source name to the index of the source's
+        built distributions.
+    env_sources - list of lists of sources
+        The names of the sources, in their levels of precedence.
+
+    """
+    def __init__(self, src_indices, env_sources):
+        super(LayeredIndex, self).__init__()
+        self.env_sources = env_sources
+        self._source_levels = {source: level
+                               for level, sources in enumerate(env_sources)
+                               for source in sources}
+        # Map package name to the level which provides it.
+        self._name_levels = {}
+        #: Map package name to the (set of) tarballs which provide it.
+        self.by_name = {}
+        self._digest = 0
+        for level, sources in enumerate(env_sources):
+            for source in sources:
+                for tar_name, pkg_info in src_indices[source].items():
+                    name = pkg_info['name']
+                    if self._name_levels.get(name, level) < level:
+                        continue
+                    self._name_levels[name] = level
+                    if tar_name in self:
+                        self._conflict(tar_name, pkg_info)
+                    self[tar_name] = SourcedPackageInfo(pkg_info, source)
+
+    @property
+    def digest(self):
+        """The digest of the index's content (see :func:`index_digest`)."""
+        return _format_digest(self._digest)
+
+    def __setitem__(self, tar_name, pkg_info):
+        if tar_name in self:
+            del self[tar_name]
+        super(LayeredIndex, self).__setitem__(tar_name, pkg_info)
+        self._digest ^= entry_digest(tar_name, pkg_info)
+        self.by_name.setdefault(pkg_info['name'], set()).add(tar_name)
+
+    def __delitem__(self, tar_name):
+        pkg_info = self[tar_name]
+        super(LayeredIndex, self).__delitem__(tar_name)
+        self._digest ^= entry_digest(tar_name, pkg_info)
+        tar_names = self.by_name[pkg_info['name']]
+        tar_names.discard(tar_name)
+        if not tar_names:
+            del self.by_name[pkg_info['name']]
+
+    def _conflict(self, tar_name, pkg_info):
+        raise ValueError('Conflicting package information for {} '
+                         'from {} and {}.'
+                         ''.format(tar_name, self[tar_name].get('channel'),
+                                   pkg_info.get('channel')))
+
+    def insert(self, tar_name, pkg_info, source):
+        """
+        Insert a package from the given source (such as one which has just
+        been built) into the index, respecting the precedence of the
+        sources: if the package's name is provided at a higher level, the
+        package is not added, and if it was only provided at lower levels,
+        the packages from those levels are removed.
+
+        Returns whether the package was added.
+
+        """
+        level = self._source_levels[source]
+        name = pkg_info['name']
+        name_level = self._name_levels.get(name, level)
+        if name_level < level:
+            return False
+        if tar_name in self and self[tar_name]['source'] != source:
+            self._conflict(tar_name, pkg_info)
+        if name_level > level:
+            for shadowed in list(self.by_name.get(name, ())):
+                del self[shadowed]
+        self._name_levels[name] = level
+        self[tar_name] = SourcedPackageInfo(pkg_info, source)
+        return True
+
+    def __reduce__(self):
+        # The items must be restored without recomputing the maintained
+        # state (which pickle would otherwise restore after the items).
+        return (_unpickle_layered_index, (dict(self), self.__dict__))
+
+    def to_dict(self):
+        """
+        Return a plain (and JSON serialisable) copy of the index, such as
+        is needed to write repodata.
+
+        """
+        return {tar_name: dict(pkg_info)
+                for tar_name, pkg_info in self.items()}
+
+
+def _unpickle_layered_index(items, state):
+    index = LayeredIndex({}, [])
+    index.__dict__.update(state)
+    dict.update(index, items)
+    return index
+
+
+def entry_digest(tar_name, pkg_info):
+    """
+    Return the digest (as an integer) of a single entry of an index. The
+    md5 of the distribution is used where it is known, otherwise the
+    distribution's package info is.
+
+    """
+    content = pkg_info.get('md5')
+    if content is None:
+        content = json.dumps(dict(pkg_info), sort_keys=True, default=list)
+    digest = hashlib.sha1('{}:{}'.format(tar_name, content).encode('utf-8'))
+    return int(digest.hexdigest(), 16)
+
+
+def _format_digest(digest):
+    return '{:040x}'.format(digest)
+
+
+def index_digest(index):
+    """
+    Return a digest which identifies the content of the given index.
+
+    The digests of the entries (see :func:`entry_digest`) are combined
+    with XOR, so the digest doesn't depend on the order of the entries,
+    and may be updated as entries are added and removed (as it is by
+    :class:`LayeredIndex`).
+
+    """
+    digest = 0
+    for tar_name, pkg_info in index.items():
+        digest ^= entry_digest(tar_name, pkg_info)
+    return _format_digest(digest)
+
+
+def index_by_name(index):
+    """
+    Return a dictionary mapping package name to the (sorted) tarball names
+    of the given index which provide the package.
+
+    """
+    by_name = {}
+    for tar_name, pkg_info in index.items():
+        by_name.setdefault(pkg_info['name'], []).append(tar_name)
+    for tar_names in by_name.values():
+        tar_names.sort()
+    return by_name
+
+
+def _dependency_names(pkg_info):
+    deps = list(pkg_info.get('depends', ()))
+    for feature_deps in pkg_info.get('with_features_depends', {}).values():
+        deps.extend(feature_deps)
+    return [dep.split()[0] for dep in deps]
+
+
+def prune_index(index, specs, by_name=None):
+    """
+    Return the subset of the given index (as a dictionary) which is
+    reachable from the given specs, through the dependencies of every
+    package of each reachable name.
+
+    Every version of every package which could take part in a solution
+    of the specs is retained, so solving the specs against the pruned
+    index gives the same solution as solving them against the whole
+    index. The name-keyed view of the index (see :func:`index_by_name`)
+    may be given, where it is already known.
+
+    """
+    if by_name is None:
+        by_name = index_by_name(index)
+    pruned = {}
+    seen = set()
+    todo = [spec.split()[0] for spec in specs]
+    while todo:
+        name = todo.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for tar_name in by_name.get(name, ()):
+            pkg_info = pruned[tar_name] = index[tar_name]
+            todo.extend(dep_name for dep_name in _dependency_names(pkg_info)
+                        if dep_name not in seen)
+    return pruned
+
+
+def read_index_json(tarball):
+    """Read the info/index.json from the given distribution tarball."""
+    with closing(tarfile.open(tarball, 'r:bz2')) as tar:
+        fh = tar.extractfile('info/index.json')
+        return json.loads(fh.read().decode('utf-8'))
+
+
+def md5_file(fname):
+    hsh = hashlib.md5()
+    with open(fname, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 16), b''):
+            hsh.update(chunk)
+    return hsh.hexdigest()
+
+
+class SourceIndexCache(object):
+    """
+    A persistent cache of the index of each source's built distributions.
+
+    The index of a source is stored on disk along with the size and
+    modification time of each distribution. When the index of a source is
+    requested, only the distributions which have been added or changed
+    since they were last seen are read, and those which have been removed
+    are dropped. Indices are also held in memory, so that they are shared
+    between all of the environments handled by a process.
+
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        #: Mapping source name to {tar_name: [size, mtime, pkg_info]}.
+        self._entries = {}
+
+    def source_dir(self, source_name):
+        """The directory of the given source's built distributions."""
+        return os.path.join(
+            conda_manifest.config.src_distributions_dir(source_name),
+            conda.config.subdir)
+
+    def cache_fname(self, source_name):
+        return os.path.join(self.cache_dir, source_name + '.json')
+
+    def _load(self, source_name):
+        entries = self._entries.get(source_name)
+        if entries is None:
+            try:
+                with open(self.cache_fname(source_name), 'r') as fh:
+                    entries = json.load(fh)
+            except (IOError, ValueError):
+                entries = {}
+            for entry in entries.values():
+                entry[2] = PackageRecord(entry[2])
+            self._entries[source_name] = entries
+        return entries
+
+    def _save(self, source_name):
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        fname = self.cache_fname(source_name)
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_fname, 'w') as fh:
+            json.dump(self._entries[source_name], fh,
+                      separators=(',', ':'), default=dict)
+        os.rename(tmp_fname, fname)
+
+    def _entry(self, tarball):
+        stat = os.stat(tarball)
+        pkg_info = read_index_json(tarball)
+        pkg_info['md5'] = md5_file(tarball)
+        pkg_info['size'] = stat.st_size
+        pkg_info['channel'] = url_path(os.path.dirname(tarball)) + '/'
+        return [stat.st_size, stat.st_mtime, PackageRecord(pkg_info)]
+
+    def add(self, source_name, tarball):
+        """
+        Add (or update) a single distribution of the given source in the
+        cache, such as one which has just been built, reading only that
+        distribution. Returns the distribution's package info.
+
+        """
+        entries = self._load(source_name)
+        entry = entries[os.path.basename(tarball)] = self._entry(tarball)
+        self._save(source_name)
+        return entry[2]
+
+    def get(self, source_name):
+        """
+        Return the index (mapping tarball name to package info) of the
+        given source's built distributions.
+
+        """
+        source_dir = self.source_dir(source_name)
+        entries = self._load(source_name)
+        if os.path.isdir(source_dir):
+            tar_names = set(fname for fname in os.listdir(source_dir)
+                            if fname.endswith('.tar.bz2'))
+        else:
+            tar_names = set()
+
+        modified = False
+        for tar_name in set(entries) - tar_names:
+            del entries[tar_name]
+            modified = True
+        for tar_name in tar_names:
+            tarball = os.path.join(source_dir, tar_name)
+            entry = entries.get(tar_name)
+            stat = os.stat(tarball)
+            if (entry is None or entry[0] != stat.st_size or
+                    entry[1] != stat.st_mtime):
+                entries[tar_name] = self._entry(tarball)
+                modified = True
+        if modified:
+            self._save(source_name)
+
+        return {tar_name: entry[2] for tar_name, entry in entries.items()}
+
+
+def add_to_repodata(dist_dir, tar_name, pkg_info):
+    """
+    Add a single package to the repodata of the given directory of
+    distributions, without re-indexing the other distributions.
+
+    """
+    from conda_build.index import write_repodata
+    fname = os.path.join(dist_dir, 'repodata.json')
+    try:
+        with open(fname, 'r') as fh:
+            repodata = json.load(fh)
+    except (IOError, ValueError):
+        repodata = {'info': {}, 'packages': {}}
+    pkg_info = dict(pkg_info)
+    for key in ['channel', 'source']:
+        pkg_info.pop(key, None)
+    repodata['packages'][tar_name] = pkg_info
+    write_repodata(repodata, dist_dir)
+
+
+_source_index_cache = None
+
+
+def source_index_cache():
+    """The :class:`SourceIndexCache` shared by the whole process."""
+    global _source_index_cache
+    if _source_index_cache is None:
+        _source_index_cache = SourceIndexCache(
+            conda_manifest.config.INDEX_CACHE)
+    return _source_index_cache
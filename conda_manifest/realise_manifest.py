@@ -1,14 +1,129 @@
 import argparse
 import conda_manifest.config
+import multiprocessing
 import yaml
 import os
 from conda_manifest.env_recipes import load_envs
+from conda_manifest.index import prune_index, source_index_cache
 from conda_manifest.sources import load_sources
 
+import conda.config
 import conda.resolve
 
 
-from conda_manifest.build_recipes import compute_source_indices, fixed_get_index, resolve_index
+from conda_manifest.build_recipes import fixed_get_index, resolve_index
+
+
+def env_layering(env):
+    """The (hashable) source layering of the given environment."""
+    return tuple(tuple(sources) for sources in env['sources'])
+
+
+def shared_indices(envs, cache=None):
+    """
+    Return the index of each of the given environments.
+
+    Each distinct source's index is loaded (from the given
+    :class:`conda_manifest.index.SourceIndexCache`, by default the one
+    shared by the whole process) only once, and environments with
+    identical source layering share the same index.
+
+    """
+    if cache is None:
+        cache = source_index_cache()
+    src_index = {}
+    indices = {}
+    result = []
+    for env in envs:
+        layering = env_layering(env)
+        if layering not in indices:
+            for sources in layering:
+                for source_name in sources:
+                    if source_name not in src_index:
+                        src_index[source_name] = cache.get(source_name)
+            indices[layering] = resolve_index(src_index, env['sources'])
+        result.append(indices[layering])
+    return result
+
+
+#: The (index, specs) problems being solved by :func:`solve_envs`. They are
+#: inherited by forked worker processes, rather than pickled for each one.
+_problems = []
+
+
+def _solve(i):
+    index, specs = _problems[i]
+    # A LayeredIndex maintains its name-keyed view.
+    index = prune_index(index, specs, getattr(index, 'by_name', None))
+    try:
+        return sorted(conda.resolve.Resolve(index).solve(list(specs))), None
+    except (SystemExit, RuntimeError) as err:
+        # A SystemExit must not escape a pool's worker process.
+        return None, str(err)
+
+
+def solve_envs(envs, indices, processes=1):
+    """
+    Solve the package specifications of each of the given environments
+    against the corresponding index, returning a list of (distributions,
+    error) pairs.
+
+    Each environment is solved against only the part of its index which is
+    reachable from its specifications (see
+    :func:`conda_manifest.index.prune_index`). Environments with the same
+    index and specifications are only solved once, and up to ``processes``
+    environments are solved concurrently in a pool of (forked) processes.
+
+    """
+    global _problems
+    problem_ids = {}
+    problems = []
+    env_problems = []
+    for env, index in zip(envs, indices):
+        key = (id(index), frozenset(env['packages']))
+        if key not in problem_ids:
+            problem_ids[key] = len(problems)
+            problems.append((index, env['packages']))
+        env_problems.append(problem_ids[key])
+
+    _problems = problems
+    try:
+        if processes > 1 and len(problems) > 1:
+            pool = multiprocessing.Pool(min(processes, len(problems)))
+            try:
+                solutions = pool.map(_solve, range(len(problems)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            solutions = [_solve(i) for i in range(len(problems))]
+    finally:
+        _problems = []
+    return [solutions[i] for i in env_problems]
+
+
+def write_manifest(fname, index, dists):
+    """Write the manifest of the given distributions of the index."""
+    lines = []
+    for pkg_name in dists:
+        pkg = index[pkg_name]
+        lines.append(('{pkg[name]: <20} {pkg[version]: <12} '
+                      '{pkg[build]: <12} {pkg[source]}'.format(pkg=pkg)))
+
+    with open(fname, 'w') as fh:
+        fh.write('\n'.join(lines))
+
+
+def write_env_repodata(env, index):
+    """Write the repodata of the given environment's index."""
+    repodata_dir = 'indices/index_for_{env[name]}/{plat}'.format(env=env,
+                                                                 plat=conda.config.subdir)
+
+    if not os.path.exists(repodata_dir):
+        os.makedirs(repodata_dir)
+    from conda_build.index import write_repodata
+    index = {'info': {}, 'packages': index.to_dict()}
+    write_repodata(index, repodata_dir)
 
 
 if __name__ == '__main__':
@@ -21,6 +136,9 @@ if __name__ == '__main__':
                         help=("The output file for the environment manifest. "
                               "Uses python string formatting, with env being "
                               "passed as a named argument."))
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help=("The number of environments to solve "
+                              "concurrently."))
     if 1 or conda_manifest.config.DEBUG:
         args = parser.parse_args(['--envs', '../env.specs/lts.yaml',
                                   '--sources', '../sources.yaml'])
@@ -30,27 +148,18 @@ if __name__ == '__main__':
     sources = load_sources(args.sources)
     envs = load_envs(args.envs)
 
-    for env in envs:
-        src_index = compute_source_indices(env['sources'])
-        index = resolve_index(src_index, env['sources'])
-
-        r = conda.resolve.Resolve(index)
-        full_list_of_packages = sorted(r.solve(env['packages']))
-        lines = []
-        for pkg_name in full_list_of_packages:
-            pkg = index[pkg_name]
-            lines.append(('{pkg[name]: <20} {pkg[version]: <12} '
-                          '{pkg[build]: <12} {pkg[source]}'.format(pkg=pkg)))
-
-        with open(args.outfile.format(env=env), 'w') as fh:
-            fh.write('\n'.join(lines))
-
-        repodata_dir = 'indices/index_for_{env[name]}/{plat}'.format(env=env,
-                                                                     plat=conda.config.subdir)
+    indices = shared_indices(envs)
+    solutions = solve_envs(envs, indices, processes=args.jobs)
 
-        if not os.path.exists(repodata_dir):
-            os.makedirs(repodata_dir)
-        from conda_build.index import write_repodata
-        index = {'info': {}, 'packages': index}
-        write_repodata(index, repodata_dir)
+    failed = []
+    for env, index, (dists, error) in zip(envs, indices, solutions):
+        if error is not None:
+            conda_manifest.config.stdout.warn('Unable to realise {}:\n{}\n'
+                                              ''.format(env['name'], error))
+            failed.append(env['name'])
+            continue
+        write_manifest(args.outfile.format(env=env), index, dists)
+        write_env_repodata(env, index)
 
+    if failed:
+        raise SystemExit('Unable to realise: {}'.format(', '.join(failed)))
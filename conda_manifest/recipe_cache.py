@@ -0,0 +1,161 @@
+"""
+A persistent cache of parsed conda recipes, so that only the recipes
+which have changed since the last run need to be re-read and re-rendered.
+
+"""
+import fnmatch
+import hashlib
+import os
+import pickle
+import tempfile
+
+import conda.config
+import conda_build.config
+
+import conda_manifest.config
+
+
+#: Files within a recipe directory which are written by the conda-manager
+#: itself, and so do not contribute to the recipe's hash.
+IGNORED_RECIPE_FILES = ('source.json', '*.log')
+
+
+def recipe_hash(recipe_dir):
+    """
+    Compute a hash of the content of all of the files which make up the
+    recipe in the given directory (excluding any nested recipes).
+
+    """
+    hsh = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(recipe_dir):
+        dirnames[:] = sorted(
+            name for name in dirnames
+            if not name.startswith('.') and
+            not os.path.exists(os.path.join(dirpath, name, 'meta.yaml')))
+        for fname in sorted(filenames):
+            if any(fnmatch.fnmatch(fname, pattern)
+                   for pattern in IGNORED_RECIPE_FILES):
+                continue
+            path = os.path.join(dirpath, fname)
+            hsh.update(os.path.relpath(path, recipe_dir).encode('utf-8'))
+            hsh.update(b'\0')
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1 << 16), b''):
+                    hsh.update(chunk)
+            hsh.update(b'\0')
+    return hsh.hexdigest()
+
+
+def find_recipe_dirs(directory):
+    """
+    Yield every directory (below and including the given one) which
+    contains a meta.yaml, following symlinks and skipping hidden
+    directories.
+
+    """
+    for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+        dirnames[:] = sorted(name for name in dirnames
+                             if not name.startswith('.'))
+        if 'meta.yaml' in filenames:
+            yield dirpath
+
+
+def render_context():
+    """
+    The configuration which affects how a recipe is rendered (selectors
+    and jinja). Cached recipes are only valid for the same context.
+
+    """
+    config = conda_build.config.config
+    return (conda.config.subdir, config.CONDA_PY, config.CONDA_NPY)
+
+
+def _load_metadata(recipe_dir):
+    from conda_build.metadata import MetaData
+    return MetaData(recipe_dir)
+
+
+class RecipeCache(object):
+    """
+    An on-disk cache of parsed recipes (conda_build MetaData), keyed by
+    recipe path and the hash of the recipe's files.
+
+    Each directory searched has its own cache file within ``cache_dir``,
+    so that directories may be searched concurrently by separate
+    processes.
+
+    """
+    def __init__(self, cache_dir, loader=_load_metadata, context=None):
+        self.cache_dir = cache_dir
+        self.loader = loader
+        if context is None:
+            context = render_context()
+        self.context = context
+
+    def cache_fname(self, directory):
+        directory = os.path.abspath(directory)
+        key = hashlib.sha1(directory.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def _read(self, fname):
+        try:
+            with open(fname, 'rb') as fh:
+                cached = pickle.load(fh)
+        except Exception:
+            # A missing, old or corrupt cache is simply rebuilt.
+            return {}
+        if cached.get('context') != self.context:
+            return {}
+        return cached['recipes']
+
+    def _write(self, fname, recipes):
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        fh = tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False)
+        with fh:
+            pickle.dump({'context': self.context, 'recipes': recipes}, fh,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(fh.name, fname)
+
+    def find_all_recipes(self, directory):
+        """
+        Return a list of the metas of all of the recipes in the given
+        directory, only parsing those recipes which are new or have
+        changed since the last search. Recipes which no longer exist are
+        evicted from the cache.
+
+        """
+        fname = self.cache_fname(directory)
+        cached = self._read(fname)
+        recipes = {}
+        metas = []
+        modified = False
+        for recipe_dir in find_recipe_dirs(directory):
+            hsh = recipe_hash(recipe_dir)
+            entry = cached.get(recipe_dir)
+            if entry is None or entry[0] != hsh:
+                entry = (hsh, self.loader(recipe_dir))
+                modified = True
+            recipes[recipe_dir] = entry
+            metas.append(entry[1])
+        if modified or set(recipes) != set(cached):
+            self._write(fname, recipes)
+        return metas
+
+
+def find_all_recipes(directories, cache_dir=None):
+    """
+    A caching equivalent of :func:`conda_build_missing.find_all_recipes`.
+    Yields the metas of every recipe found within the given directories.
+
+    """
+    if cache_dir is None:
+        cache_dir = conda_manifest.config.RECIPE_CACHE
+    cache = RecipeCache(cache_dir)
+    for directory in directories:
+        for meta in cache.find_all_recipes(directory):
+            yield meta
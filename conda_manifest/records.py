@@ -0,0 +1,191 @@
+"""
+Compact, shared representations of the specs and package information which
+are used many times over when handling large indices.
+
+"""
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+try:
+    # Python 2.
+    intern = intern
+except NameError:
+    from sys import intern
+
+from conda.resolve import MatchSpec
+
+
+_match_specs = {}
+
+
+def match_spec(spec):
+    """
+    Return the (shared) :class:`conda.resolve.MatchSpec` of the given spec
+    string, parsing each distinct spec only once.
+
+    """
+    try:
+        return _match_specs[spec]
+    except KeyError:
+        return _match_specs.setdefault(spec, MatchSpec(spec))
+
+
+def _intern(value):
+    try:
+        return intern(str(value))
+    except (TypeError, UnicodeError):
+        # Python 2 can only intern (ascii) byte strings.
+        return value
+
+
+_STRING_TYPES = (str, type(u''))
+
+_MISSING = object()
+
+_NO_DEFAULT = object()
+
+
+class SlottedMapping(object):
+    """
+    The mapping methods of :class:`collections.MutableMapping`, for classes
+    which define ``__slots__``. (On Python 2 the ABC itself has no
+    ``__slots__``, so its subclasses would all have a ``__dict__``.)
+    Subclasses implement ``__getitem__``, ``__setitem__``, ``__delitem__``,
+    ``__iter__`` and ``__len__``, and are registered as
+    :class:`collections.MutableMapping`.
+
+    """
+    __slots__ = ()
+
+    __hash__ = None
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def pop(self, key, default=_NO_DEFAULT):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is _NO_DEFAULT:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, 'keys'):
+            other = [(key, other[key]) for key in other.keys()]
+        for key, value in list(other) + list(kwargs.items()):
+            self[key] = value
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+
+class PackageRecord(SlottedMapping):
+    """
+    The package information (as found in a distribution's
+    ``info/index.json``) of an index entry.
+
+    The commonly used items are held in slots, with their strings interned
+    so that they are shared between all records (and all environments'
+    indices). The remaining items are held in a dictionary.
+
+    """
+    __slots__ = ('name', 'version', 'build', 'build_number', 'depends',
+                 '_extra')
+
+    _FIELDS = ('name', 'version', 'build', 'build_number', 'depends')
+
+    #: Items (other than the slots) whose values are interned.
+    _INTERNED = ('channel', 'platform', 'arch', 'subdir', 'license',
+                 'features', 'track_features')
+
+    def __init__(self, pkg_info):
+        for field in self._FIELDS:
+            setattr(self, field, _MISSING)
+        self._extra = {}
+        for key, value in pkg_info.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._FIELDS:
+            value = getattr(self, key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key == 'depends':
+            value = tuple(_intern(dep) for dep in value)
+        elif key in self._FIELDS or key in self._INTERNED:
+            if isinstance(value, _STRING_TYPES):
+                value = _intern(value)
+        if key in self._FIELDS:
+            setattr(self, key, value)
+        else:
+            self._extra[_intern(key)] = value
+
+    def __delitem__(self, key):
+        if key in self._FIELDS:
+            if getattr(self, key) is _MISSING:
+                raise KeyError(key)
+            setattr(self, key, _MISSING)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for field in self._FIELDS:
+            if getattr(self, field) is not _MISSING:
+                yield field
+        for key in self._extra:
+            yield key
+
+    def __len__(self):
+        return (sum(getattr(self, field) is not _MISSING
+                    for field in self._FIELDS) + len(self._extra))
+
+    def __reduce__(self):
+        return PackageRecord, (dict(self),)
+
+    def __repr__(self):
+        return 'PackageRecord({!r})'.format(dict(self))
+
+
+MutableMapping.register(PackageRecord)
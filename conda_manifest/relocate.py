@@ -0,0 +1,231 @@
+"""
+Linking of an extracted distribution into a prefix, giving the same result
+as :func:`conda.install.link`.
+
+conda copies each file which contains the build prefix's placeholder, and
+then replaces the placeholder in the copy, reading the whole file into
+memory (see :func:`conda.install.update_prefix`). Here, the placeholder is
+instead found by scanning a memory map of the extracted file, and the
+relocated file is written straight into the prefix as it is scanned. Files
+which don't contain the placeholder are hardlinked. The files of a
+distribution may be linked concurrently, in a pool of threads.
+
+conda passes the environment of a distribution's link scripts to them by
+modifying ``os.environ`` (see :func:`conda.install.run_script`), so the
+scripts of concurrent links (e.g. to several prefixes) are run one at a
+time.
+
+"""
+import mmap
+import os
+import shutil
+import sys
+import threading
+
+import conda.install as cinstall
+from conda.lock import Locked
+
+
+#: The size of the chunks in which unchanged content is copied.
+CHUNK_SIZE = 1024 * 1024
+
+#: Held while conda runs a link (or unlink) script, as it sets the
+#: script's environment in the process' environment.
+script_lock = threading.RLock()
+
+
+def _copy_range(mm, out, start, end):
+    for pos in range(start, end, CHUNK_SIZE):
+        out.write(mm[pos:min(pos + CHUNK_SIZE, end)])
+
+
+def _replace_text(mm, out, placeholder, new_prefix):
+    # Equivalent to data.replace(placeholder, new_prefix).
+    pos = 0
+    while True:
+        start = mm.find(placeholder, pos)
+        if start < 0:
+            break
+        _copy_range(mm, out, pos, start)
+        out.write(new_prefix)
+        pos = start + len(placeholder)
+    _copy_range(mm, out, pos, len(mm))
+
+
+def _replace_binary(mm, out, placeholder, new_prefix):
+    # Equivalent to conda.install.binary_replace: each null terminated
+    # string containing the placeholder has it replaced, and is padded with
+    # nulls to keep its length (and so every offset in the file) unchanged.
+    pos = 0
+    while True:
+        start = mm.find(placeholder, pos)
+        if start < 0:
+            break
+        end = mm.find(b'\0', start + len(placeholder))
+        if end < 0:
+            # No string is terminated after this point, so there are no
+            # further matches.
+            break
+        string = mm[start:end + 1]
+        padding = ((len(placeholder) - len(new_prefix)) *
+                   string.count(placeholder))
+        if padding < 0:
+            raise cinstall.PaddingError(placeholder, new_prefix, padding)
+        _copy_range(mm, out, pos, start)
+        out.write(string.replace(placeholder, new_prefix) + b'\0' * padding)
+        pos = end + 1
+    _copy_range(mm, out, pos, len(mm))
+
+
+def hardlink(src, dst):
+    """Hardlink src to dst, falling back to a copy where that fails."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def copy(src, dst):
+    """Copy src to dst, copying relative symlinks as symlinks (as conda)."""
+    if os.path.islink(src) and not os.readlink(src).startswith('/'):
+        os.symlink(os.readlink(src), dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def relocate(src, dst, placeholder, new_prefix, mode='text'):
+    """
+    Create dst from src with the placeholder prefix replaced by the new
+    prefix, exactly as :func:`conda.install.update_prefix` would. If src
+    doesn't contain the placeholder, dst is hardlinked to it.
+
+    Returns whether the placeholder was replaced.
+
+    """
+    if mode == 'text':
+        replace = _replace_text
+    elif mode == 'binary':
+        replace = _replace_binary
+    else:
+        raise ValueError('Invalid mode: {}'.format(mode))
+    placeholder = placeholder.encode('utf-8')
+    new_prefix = new_prefix.encode('utf-8')
+
+    with open(src, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            mm = None
+        else:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mm is None or mm.find(placeholder) < 0:
+                hardlink(src, dst)
+                return False
+            try:
+                with open(dst, 'wb') as out:
+                    replace(mm, out, placeholder, new_prefix)
+            except Exception:
+                os.remove(dst)
+                raise
+        finally:
+            if mm is not None:
+                mm.close()
+    shutil.copymode(src, dst)
+    return True
+
+
+def run_script(prefix, dist, action, env_prefix=None):
+    """:func:`conda.install.run_script`, holding the :data:`script_lock`."""
+    with script_lock:
+        return cinstall.run_script(prefix, dist, action, env_prefix)
+
+
+def has_script(prefix, dist, action):
+    """Whether the given distribution has a script for the action."""
+    # As conda.install.run_script.
+    if sys.platform == 'win32':
+        bin_dir, ext = 'Scripts', 'bat'
+    else:
+        bin_dir, ext = 'bin', 'sh'
+    return os.path.isfile(os.path.join(prefix, bin_dir, '.{}-{}.{}'.format(
+        dist.rsplit('-', 2)[0], action, ext)))
+
+
+def unlink_dist(prefix, dist):
+    """
+    Unlink the given distribution from the prefix, with
+    :func:`conda.install.unlink`, holding the :data:`script_lock` if the
+    distribution has a pre-unlink script.
+
+    """
+    if has_script(prefix, dist, 'pre-unlink'):
+        with script_lock:
+            cinstall.unlink(prefix, dist)
+    else:
+        cinstall.unlink(prefix, dist)
+
+
+def link_file(source_dir, prefix, fname, has_prefix_files, no_link):
+    """Link a single file of an extracted distribution into the prefix."""
+    src = os.path.join(source_dir, fname)
+    dst = os.path.join(prefix, fname)
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if fname in has_prefix_files:
+        placeholder, mode = has_prefix_files[fname]
+        if os.path.islink(src):
+            copy(src, dst)
+            cinstall.update_prefix(dst, prefix, placeholder, mode)
+        else:
+            relocate(src, dst, placeholder, prefix, mode)
+    elif fname in no_link or os.path.islink(src):
+        copy(src, dst)
+    else:
+        hardlink(src, dst)
+
+
+def link_dist(pkgs_dir, prefix, dist, pool=None):
+    """
+    Link the given extracted distribution into the prefix, giving the same
+    result as :func:`conda.install.link`. The files are linked in the given
+    thread pool, where there is one.
+
+    """
+    source_dir = os.path.join(pkgs_dir, dist)
+    if not run_script(source_dir, dist, 'pre-link', prefix):
+        sys.exit('Error: pre-link failed: {}'.format(dist))
+
+    info_dir = os.path.join(source_dir, 'info')
+    files = list(cinstall.yield_lines(os.path.join(info_dir, 'files')))
+    has_prefix_files = cinstall.read_has_prefix(os.path.join(info_dir,
+                                                             'has_prefix'))
+    no_link = cinstall.read_no_link(info_dir)
+
+    def link_one(fname):
+        link_file(source_dir, prefix, fname, has_prefix_files, no_link)
+
+    with Locked(prefix), Locked(pkgs_dir):
+        # Create the directories up front, rather than racing to create
+        # them from each thread.
+        for directory in sorted(set(os.path.dirname(os.path.join(prefix, f))
+                                    for f in files)):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        try:
+            if pool is not None:
+                pool.map(link_one, files)
+            else:
+                for fname in files:
+                    link_one(fname)
+        except cinstall.PaddingError:
+            sys.exit("ERROR: placeholder too short in: {}\n".format(dist))
+
+        cinstall.mk_menus(prefix, files, remove=False)
+        if not run_script(prefix, dist, 'post-link'):
+            sys.exit("Error: post-link failed for: {}".format(dist))
+
+        meta_dict = {'url': cinstall.read_url(pkgs_dir, dist),
+                     'files': files,
+                     'link': {'source': source_dir,
+                              'type': cinstall.link_name_map.get(
+                                  cinstall.LINK_HARD)}}
+        cinstall.create_meta(prefix, dist, info_dir, meta_dict)
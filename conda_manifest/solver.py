@@ -0,0 +1,133 @@
+"""
+A long-lived, memoizing wrapper around :class:`conda.resolve.Resolve`.
+
+Constructing a :class:`conda.resolve.Resolve` is expensive for a large
+index, and the same queries (the packages matching a spec, the solution of
+a set of specs) are repeated for many of the recipes of an environment. A
+:class:`Solver` is constructed once per index, and memoizes those queries.
+The memoized results are keyed by the digest of the index, so they may be
+shared between solvers for identical indices. Specs are solved against
+only the part of the index which is reachable from them (see
+:func:`conda_manifest.index.prune_index`).
+
+"""
+import collections
+import threading
+
+import conda.resolve
+from conda_manifest.index import index_by_name, index_digest, prune_index
+from conda_manifest.records import match_spec
+
+
+class LRUCache(object):
+    """A thread-safe mapping which holds at most ``maxsize`` items."""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+#: The memoized results shared by all solvers, unless they are given their
+#: own cache.
+_shared_cache = LRUCache(4096)
+
+
+class Solver(object):
+    """
+    Memoizes :meth:`get_pkgs` and :meth:`solve` of a
+    :class:`conda.resolve.Resolve` of the given index.
+
+    The index must not be changed during the lifetime of the solver: a new
+    solver should be constructed for the changed index instead. Where the
+    index maintains its digest and name-keyed view (as a
+    :class:`conda_manifest.index.LayeredIndex` does), constructing a
+    solver doesn't visit the whole index.
+
+    """
+    def __init__(self, index, cache=None):
+        self.index = index
+        self.digest = getattr(index, 'digest', None)
+        if self.digest is None:
+            self.digest = index_digest(index)
+        self._by_name = getattr(index, 'by_name', None)
+        if self._by_name is None:
+            self._by_name = index_by_name(index)
+        self._resolve = None
+        if cache is None:
+            cache = _shared_cache
+        self._cache = cache
+
+    @property
+    def resolve(self):
+        """The :class:`conda.resolve.Resolve` of the whole index."""
+        if self._resolve is None:
+            self._resolve = conda.resolve.Resolve(self.index)
+        return self._resolve
+
+    def _get_pkgs(self, spec):
+        # Only the packages of the spec's name can match it, so there is no
+        # need to resolve the whole index.
+        spec = match_spec(spec)
+        index = {tar_name: self.index[tar_name]
+                 for tar_name in self._by_name.get(spec.name, ())}
+        return conda.resolve.Resolve(index).get_pkgs(spec)
+
+    def _solve(self, specs):
+        index = prune_index(self.index, specs, self._by_name)
+        return conda.resolve.Resolve(index).solve(specs)
+
+    def get_pkgs(self, spec):
+        """
+        Return the packages which match the given spec (a string or a
+        :class:`conda.resolve.MatchSpec`).
+
+        """
+        spec = getattr(spec, 'spec', spec)
+        key = (self.digest, 'get_pkgs', spec)
+        pkgs = self._cache.get(key)
+        if pkgs is None:
+            pkgs = self._cache[key] = tuple(self._get_pkgs(spec))
+        return list(pkgs)
+
+    def solve(self, specs):
+        """
+        Return the distributions which satisfy the given specs. If the
+        specs cannot be satisfied, the exception raised by
+        :meth:`conda.resolve.Resolve.solve` is raised (again, for repeated
+        calls).
+
+        """
+        key = (self.digest, 'solve', frozenset(specs))
+        result = self._cache.get(key)
+        if result is None:
+            try:
+                result = tuple(self._solve(list(specs)))
+            except (SystemExit, RuntimeError) as err:
+                result = err
+            self._cache[key] = result
+        if isinstance(result, BaseException):
+            raise result
+        return list(result)
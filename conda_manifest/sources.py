@@ -1,75 +1,454 @@
+import collections
 import conda
+import hashlib
+import json
 import yaml
 import os
 import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
 
 import shutil
 
 import conda.plan
 import conda_build.config
+from conda_build.external import find_executable
 
 import conda
+import conda_manifest.config
 
 
 def load_sources(sources_yaml):
+    """
+    Load the sources.yaml, a mapping of source name to source. A source
+    is either a local directory (``fn``) or a git repository
+    (``git_url``, with an optional ``git_rev``). Git sources may also
+    define:
+
+     * ``git_depth`` - the depth of a shallow clone.
+     * ``git_filter`` - a partial clone filter, such as ``blob:none``.
+     * ``git_sparse`` - a list of the paths (recipe directories) to check
+       out, rather than the whole tree.
+
+    """
     with open(sources_yaml, 'r') as fh:
         return yaml.safe_load(fh)
 
 
-def fetch_sources(sources, sources_root):
+def git_options(source):
+    """
+    Return the keyword arguments for :func:`git_source` which represent
+    the clone options of the given git source.
+
+    """
+    sparse_paths = source.get('git_sparse') or None
+    if isinstance(sparse_paths, str):
+        sparse_paths = [sparse_paths]
+    return {'depth': source.get('git_depth'),
+            'filter_spec': source.get('git_filter'),
+            'sparse_paths': sparse_paths}
+
+
+def uses_git_cache(depth=None, filter_spec=None, sparse_paths=None):
+    """
+    Whether a git source with the given clone options (see
+    :func:`git_options`) is cloned from its mirror in the git cache.
+    Shallow, partial and sparse clones are instead cloned directly from
+    the source's URL, as the mirror holds every ref and all history.
+
+    """
+    return not (depth or filter_spec or sparse_paths)
+
+
+#: The outcome of fetching a single source. ``error`` is None on success,
+#: and ``changed`` says whether the source's fingerprint differs from that
+#: recorded by the previous fetch (a source which failed to fetch has no
+#: fingerprint, and is not reported as changed).
+FetchResult = collections.namedtuple('FetchResult',
+                                     ['name', 'target', 'error',
+                                      'fingerprint', 'changed'])
+
+
+def fetch_source(source_name, source, sources_root, refreshed=None):
+    """
+    Fetch a single source (an entry of sources.yaml) into the
+    sources root, returning the target directory.
+
+    An existing target is refreshed in place where possible: git
+    checkouts are fetched and reset to ``git_rev``, and ``fn`` sources
+    are synchronised so that only changed files are rewritten.
+
+    See :func:`update_git_cache` for the meaning of ``refreshed``.
+
+    """
+    target = os.path.join(sources_root, source_name)
+    if source.get('git_url') is not None:
+        git_url = source['git_url']
+        git_rev = source.get('git_rev', None)
+        options = git_options(source)
+        if uses_git_cache(**options):
+            origin = git_cache_repo(git_url, conda_manifest.config.GIT_CACHE)
+        else:
+            origin = git_url
+        if os.path.exists(target) and not is_git_checkout_of(target, origin):
+            shutil.rmtree(target)
+        if os.path.exists(target):
+            if origin != git_url:
+                update_git_cache(git_url, conda_manifest.config.GIT_CACHE,
+                                 refreshed=refreshed)
+            refresh_git_checkout(target, git_rev=git_rev,
+                                 depth=options['depth'],
+                                 sparse_paths=options['sparse_paths'])
+        else:
+            git_source(git_url, conda_manifest.config.GIT_CACHE, target,
+                       git_rev=git_rev, refreshed=refreshed, **options)
+    else:
+        fname = os.path.expanduser(source['fn'])
+        if not os.path.exists(fname):
+            raise IOError('Source does not exist {}'.format(source))
+        sync_tree(fname, target)
+    return target
+
+
+def fetch_sources(sources, sources_root, jobs=1):
     """
     Fetch the given sources to the given location.
 
+    Up to ``jobs`` sources are fetched concurrently (fetching is dominated
+    by git and filesystem IO, so threads are sufficient). A failure to
+    fetch one source does not prevent the others from being fetched.
+    Each git cache repository is updated at most once per call, however
+    many sources (revisions) make use of it.
+
+    The fingerprint of each successfully fetched source is recorded in
+    the sources root (see :func:`load_fingerprints`), and is compared with
+    the previously recorded fingerprint to determine whether the source
+    has changed.
+
+    Returns
+    -------
+    results - dict
+        A dictionary mapping source name to :class:`FetchResult`.
+
     """
-    for source_name, source in sources.items():
+    refreshed = set()
+    previous = load_fingerprints(sources_root)
+
+    def fetch(item):
+        source_name, source = item
         target = os.path.join(sources_root, source_name)
-        if os.path.exists(target):
-            shutil.rmtree(target)
-        if source.get('git_url') is not None:
-            fname = git_source(source['git_url'],
-                               conda_manifest.config.GIT_CACHE,
-                               target,
-                               git_rev=source.get('git_rev', None))
+        try:
+            target = fetch_source(source_name, source, sources_root,
+                                  refreshed=refreshed)
+            fingerprint = source_fingerprint(source, target)
+        except Exception as err:
+            conda_manifest.config.stdout.warn('Failed to fetch {}: {}\n'
+                                              ''.format(source_name, err))
+            return FetchResult(source_name, target, err, None, False)
+        return FetchResult(source_name, target, None, fingerprint,
+                           fingerprint != previous.get(source_name))
+
+    items = sorted(sources.items())
+    if jobs > 1 and len(items) > 1:
+        pool = ThreadPool(min(jobs, len(items)))
+        try:
+            results = pool.map(fetch, items)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [fetch(item) for item in items]
+    results = {result.name: result for result in results}
+
+    fingerprints = dict(previous)
+    for name, result in results.items():
+        if result.error is None:
+            fingerprints[name] = result.fingerprint
         else:
-            fname = os.path.expanduser(source['fn'])
-            if not os.path.exists(fname):
-                raise IOError('Source does not exist {}'.format(source))
-            shutil.copytree(fname, target)
+            # The target may be in a partial state, so make sure it is
+            # treated as changed next time.
+            fingerprints.pop(name, None)
+    write_fingerprints(sources_root, fingerprints)
+    return results
 
 
-from conda_build.external import find_executable
+def _fingerprints_fname(sources_root):
+    return os.path.join(sources_root, '.fingerprints.json')
+
+
+def load_fingerprints(sources_root):
+    """
+    Return the dictionary mapping source name to fingerprint, as recorded
+    by the last :func:`fetch_sources` into the given sources root.
 
+    """
+    fname = _fingerprints_fname(sources_root)
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, 'r') as fh:
+        return json.load(fh)
+
+
+def write_fingerprints(sources_root, fingerprints):
+    if not os.path.exists(sources_root):
+        os.makedirs(sources_root)
+    fname = _fingerprints_fname(sources_root)
+    with open(fname + '.tmp', 'w') as fh:
+        json.dump(fingerprints, fh, indent=2, sort_keys=True)
+    os.rename(fname + '.tmp', fname)
+
+
+def source_fingerprint(source, target):
+    """
+    Compute a fingerprint of a fetched source. For git sources this is
+    derived from the checked out commit (and those of any submodules),
+    otherwise it is derived from the path, size and modification time of
+    every file in the tree (which :func:`sync_tree` preserves from the
+    original).
 
-def git_source(git_url, cache_dir, target_directory, git_rev=None):
+    """
+    hsh = hashlib.sha1()
+    if source.get('git_url') is not None:
+        git = find_executable('git')
+        for cmd in (['rev-parse', 'HEAD'],
+                    ['submodule', 'status', '--recursive']):
+            output = subprocess.check_output([git] + cmd, cwd=target)
+            hsh.update(output)
+    else:
+        for dirpath, dirnames, filenames in os.walk(target):
+            dirnames.sort()
+            for fname in sorted(filenames):
+                path = os.path.join(dirpath, fname)
+                stat = os.stat(path)
+                hsh.update('{}\0{}\0{}\n'.format(
+                    os.path.relpath(path, target), stat.st_size,
+                    int(stat.st_mtime)).encode('utf-8'))
+    return hsh.hexdigest()
+
+
+def sync_tree(source_dir, target_dir):
+    """
+    Make target_dir a copy of source_dir, only writing those files whose
+    size or modification time differ, and removing anything in target_dir
+    which is not in source_dir. Symlinks in the source are followed, as
+    with :func:`shutil.copytree`. Returns whether anything was changed.
+
+    """
+    changed = False
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+        changed = True
+    for dirpath, dirnames, filenames in os.walk(source_dir, followlinks=True):
+        target_dirpath = os.path.join(target_dir,
+                                      os.path.relpath(dirpath, source_dir))
+        existing = set(os.listdir(target_dirpath))
+        for name in set(dirnames) | set(filenames):
+            existing.discard(name)
+            target = os.path.join(target_dirpath, name)
+            if name in dirnames:
+                if os.path.isdir(target) and not os.path.islink(target):
+                    continue
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.mkdir(target)
+                changed = True
+                continue
+            src_stat = os.stat(os.path.join(dirpath, name))
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                target_stat = os.lstat(target)
+                if (target_stat.st_size == src_stat.st_size and
+                        int(target_stat.st_mtime) == int(src_stat.st_mtime)):
+                    continue
+                os.remove(target)
+            shutil.copy2(os.path.join(dirpath, name), target)
+            changed = True
+        for name in existing:
+            target = os.path.join(target_dirpath, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            else:
+                os.remove(target)
+            changed = True
+    return changed
+
+
+# A lock per git cache repository, so that sources which share a cache
+# are never fetching into it at the same time.
+_cache_locks = {}
+_cache_locks_lock = threading.Lock()
+
+
+def _cache_lock(cache_repo):
+    with _cache_locks_lock:
+        return _cache_locks.setdefault(cache_repo, threading.Lock())
+
+
+def git_cache_repo(git_url, cache_dir):
+    """
+    The location of the cache (mirror) repository for the given git URL.
+    There is exactly one cache repository per URL, no matter how many
+    revisions of it are in use.
+
+    """
+    git_dn = git_url.split(':')[-1].replace('/', '_')
+    return os.path.join(cache_dir, git_dn)
+
+
+def update_git_cache(git_url, cache_dir, refreshed=None):
+    """
+    Create, or fetch into, the mirror of the given git resource in the
+    cache directory, returning the location of the mirror.
+
+    If ``refreshed`` is given, it is a set of the cache repositories which
+    have already been updated (e.g. during this run of
+    :func:`fetch_sources`). Those are not fetched again, and the mirror
+    is added to the set once updated.
+
+    """
+    git = find_executable('git')
+    cache_repo = git_cache_repo(git_url, cache_dir)
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Another fetch may have created it in the meantime.
+            if not os.path.isdir(cache_dir):
+                raise
+    with _cache_lock(cache_repo):
+        if refreshed is not None and cache_repo in refreshed:
+            return cache_repo
+        if os.path.isdir(cache_repo):
+            subprocess.check_call([git, 'fetch'], cwd=cache_repo)
+        else:
+            subprocess.check_call([git, 'clone', '--mirror', git_url,
+                                   cache_repo])
+        if refreshed is not None:
+            refreshed.add(cache_repo)
+    return cache_repo
+
+
+def git_source(git_url, cache_dir, target_directory, git_rev=None,
+               refreshed=None, depth=None, filter_spec=None,
+               sparse_paths=None):
     """
     Clone the given git resource into the target directory.
     Caching the git repository in the cache directory.
 
+    The cache holds a single mirror per URL. The target directory is a
+    ``--shared`` clone of that mirror (borrowing its objects rather than
+    copying them), checked out at ``git_rev``. See
+    :func:`update_git_cache` for the meaning of ``refreshed``.
+
+    If a ``depth`` (shallow clone) or ``filter_spec`` (partial clone, e.g.
+    ``blob:none``) is given, or ``sparse_paths`` (only those paths are
+    checked out), the mirror is bypassed and the target is cloned directly
+    from git_url (see :func:`uses_git_cache`). A shallow clone requires
+    ``git_rev`` to be a branch or tag.
+
     This is an adaptation of conda_build.source.git_source.
 
     """
     git = find_executable('git')
-    git_dn = git_url
-    if git_rev:
-        git_dn += '_{}'.format(git_rev)
-    git_dn = git_dn.split(':')[-1].replace('/', '_')
-    cache_repo = os.path.join(cache_dir, git_dn)
-    if not os.path.exists(os.path.dirname(cache_repo)):
-        os.makedirs(os.path.dirname(cache_repo))
-    if os.path.isdir(cache_repo):
-        subprocess.check_call([git, 'fetch'], cwd=cache_repo)
+    direct = not uses_git_cache(depth, filter_spec, sparse_paths)
+    if direct:
+        origin = git_url
     else:
-        subprocess.check_call([git, 'clone', '--mirror', git_url, cache_repo])
+        origin = update_git_cache(git_url, cache_dir, refreshed=refreshed)
 
     if os.path.exists(target_directory):
         raise IOError('{} already exists. Remove first.'.format(target_directory))
 
-    subprocess.check_call([git, 'clone', '--recursive', cache_repo, target_directory])
-    if git_rev:
+    cmd = [git, 'clone', '--no-checkout']
+    if direct:
+        if depth:
+            cmd.extend(['--depth', str(depth)])
+            if git_rev:
+                cmd.extend(['--branch', git_rev])
+        if filter_spec:
+            cmd.extend(['--filter', filter_spec])
+    else:
+        cmd.append('--shared')
+    subprocess.check_call(cmd + [origin, target_directory])
+    if sparse_paths:
+        subprocess.check_call([git, 'sparse-checkout', 'set'] +
+                              list(sparse_paths), cwd=target_directory)
+    if git_rev and not depth:
         subprocess.check_call([git, 'checkout', git_rev], cwd=target_directory)
+    else:
+        subprocess.check_call([git, 'checkout', '-f', 'HEAD'],
+                              cwd=target_directory)
+    _update_submodules(target_directory, depth)
     return target_directory
 
 
+def _update_submodules(target_directory, depth=None):
+    git = find_executable('git')
+    cmd = [git, 'submodule', 'update', '--init', '--recursive']
+    if depth:
+        cmd.extend(['--depth', str(depth)])
+    subprocess.check_call(cmd, cwd=target_directory)
+
+
+def is_git_checkout_of(target_directory, origin):
+    """Whether target_directory is a clone of the given origin."""
+    if not os.path.isdir(os.path.join(target_directory, '.git')):
+        return False
+    git = find_executable('git')
+    try:
+        url = subprocess.check_output([git, 'config', '--get',
+                                       'remote.origin.url'],
+                                      cwd=target_directory)
+    except subprocess.CalledProcessError:
+        return False
+    return url.decode('utf-8').strip() == origin
+
+
+def refresh_git_checkout(target_directory, git_rev=None, depth=None,
+                         sparse_paths=None):
+    """
+    Update an existing checkout (as created by :func:`git_source`) in
+    place, by fetching from its origin and resetting the working tree to
+    ``git_rev`` (or the origin's HEAD if not given). Local modifications
+    to tracked files are discarded. ``depth`` and ``sparse_paths`` have
+    the same meaning as for :func:`git_source`.
+
+    """
+    git = find_executable('git')
+    cmd = [git, 'fetch', '--prune']
+    if depth:
+        cmd.extend(['--depth', str(depth)])
+    subprocess.check_call(cmd + ['origin'], cwd=target_directory)
+
+    if sparse_paths:
+        subprocess.check_call([git, 'sparse-checkout', 'set'] +
+                              list(sparse_paths), cwd=target_directory)
+    elif os.path.exists(os.path.join(target_directory, '.git', 'info',
+                                     'sparse-checkout')):
+        subprocess.check_call([git, 'sparse-checkout', 'disable'],
+                              cwd=target_directory)
+
+    def verify(ref):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call([git, 'rev-parse', '--verify', '--quiet',
+                                    ref + '^{commit}'],
+                                   cwd=target_directory, stdout=devnull) == 0
+
+    if git_rev is None:
+        subprocess.check_call([git, 'reset', '--hard', 'origin/HEAD'],
+                              cwd=target_directory)
+    elif verify('origin/' + git_rev):
+        # A branch - (re)point the local branch at the remote one.
+        subprocess.check_call([git, 'checkout', '-f', '-B', git_rev,
+                               'origin/' + git_rev], cwd=target_directory)
+    else:
+        # A tag or commit.
+        subprocess.check_call([git, 'checkout', '-f', git_rev],
+                              cwd=target_directory)
+    _update_submodules(target_directory, depth)
+
+
 if __name__ == '__main__':
     import conda_manifest.config
     import argparse
@@ -77,6 +456,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--sources", default='sources.yaml',
                         help="Location of sources.yaml")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="The number of sources to fetch concurrently.")
     if 1 or conda_manifest.config.DEBUG:
         args = parser.parse_args(['--sources', '../sources.yaml'])
     else:
@@ -85,4 +466,12 @@ if __name__ == '__main__':
     sources = load_sources(args.sources)
 
     with conda_manifest.config.managed_stdout():
-        fetch_sources(sources, conda_manifest.config.build_root)
+        results = fetch_sources(sources, conda_manifest.config.build_root,
+                                jobs=args.jobs)
+
+    failed = sorted(name for name, result in results.items() if result.error)
+    for name in sorted(results):
+        print('{: <20} {}'.format(name, 'FAILED' if results[name].error
+                                  else 'ok'))
+    if failed:
+        raise SystemExit('Failed to fetch: {}'.format(', '.join(failed)))
@@ -1,4 +1,9 @@
 import collections
+import io
+import json
+import os
+import tarfile
+
 import conda.config
 
 
@@ -42,3 +47,28 @@ class DummyIndex(dict):
                         build=build_string, subdir=conda.config.subdir,
                         depends=tuple(depends), **extra_items)
         self['{}-{}-{}.tar.bz2'.format(name, version, build_string)] = pkg_info
+
+
+def write_dist(directory, name, version, files=None, build='0',
+               info_files=None):
+    """
+    Write a distribution tarball containing the given files (a dictionary
+    of path to bytes) and additional info files (likewise), returning its
+    filename.
+
+    """
+    files = files or {}
+    dist = '{}-{}-{}'.format(name, version, build)
+    info = dict(name=name, version=version, build=build, build_number=0,
+                depends=[])
+    contents = dict(files)
+    contents.update(info_files or {})
+    contents['info/index.json'] = json.dumps(info).encode('utf-8')
+    contents['info/files'] = '\n'.join(sorted(files)).encode('utf-8')
+    fname = os.path.join(directory, dist + '.tar.bz2')
+    with tarfile.open(fname, 'w:bz2') as tar:
+        for path, content in sorted(contents.items()):
+            tarinfo = tarfile.TarInfo(path)
+            tarinfo.size = len(content)
+            tar.addfile(tarinfo, io.BytesIO(content))
+    return fname
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from conda_manifest.artefact_cache import DirectoryArtefactCache
+
+
+class Test_DirectoryArtefactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = DirectoryArtefactCache(os.path.join(self.tmpdir, 'cache'))
+        self.target_dir = os.path.join(self.tmpdir, 'linux-64')
+        self.dist = self.write_dist('a-1.0-0.tar.bz2', 'a' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_dist(self, fn, content):
+        fname = os.path.join(self.tmpdir, fn)
+        with open(fname, 'w') as fh:
+            fh.write(content)
+        return fname
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get('abcd', self.target_dir))
+
+    def test_round_trip(self):
+        self.cache.put('abcd', self.dist)
+        result = self.cache.get('abcd', self.target_dir)
+        self.assertEqual(result, os.path.join(self.target_dir,
+                                              'a-1.0-0.tar.bz2'))
+        with open(result) as fh:
+            self.assertEqual(fh.read(), 'a' * 100)
+        # No temporary files are left behind.
+        self.assertEqual(os.listdir(self.target_dir), ['a-1.0-0.tar.bz2'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir,
+                                                        'cache', 'ab'))),
+                         ['abcd.json', 'abcd.tar.bz2'])
+
+    def test_corrupt(self):
+        self.cache.put('abcd', self.dist)
+        with open(os.path.join(self.tmpdir, 'cache', 'ab',
+                               'abcd.tar.bz2'), 'w') as fh:
+            fh.write('b' * 100)
+        self.assertIsNone(self.cache.get('abcd', self.target_dir))
+        self.assertEqual(os.listdir(self.target_dir), [])
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_eviction(self):
+        self.cache.put('aaaa', self.dist)
+        self.cache.put('bbbb', self.write_dist('b-1.0-0.tar.bz2', 'b' * 100))
+        self.cache.put('cccc', self.write_dist('c-1.0-0.tar.bz2', 'c' * 100))
+        # Make aaaa the least recently used, then use it.
+        for age, key in [(30, 'aaaa'), (20, 'bbbb'), (10, 'cccc')]:
+            meta = os.path.join(self.tmpdir, 'cache', key[:2], key + '.json')
+            mtime = time.time() - age
+            os.utime(meta, (mtime, mtime))
+        self.cache.get('aaaa', self.target_dir)
+        self.assertEqual(self.cache.evict(200), ['bbbb'])
+        self.assertEqual(sorted(key for _, _, key in self.cache.entries()),
+                         ['aaaa', 'cccc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
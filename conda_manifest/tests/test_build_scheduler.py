@@ -0,0 +1,183 @@
+from functools import partial
+import os
+import shutil
+import tempfile
+import unittest
+
+from conda_manifest.artefact_cache import ArtefactCache
+from conda_manifest.build_scheduler import (BuildJob, JobGraph, run_jobs,
+                                            configure_conda_build,
+                                            private_croot)
+import conda_manifest.config
+from conda_manifest.fingerprints import FingerprintStore
+from conda_manifest.tests import DummyPackage
+
+
+def fake_build(job, channels, rebuild):
+    # Runs in a worker process, so must be importable.
+    if job.meta.name() == 'b':
+        raise SystemExit('b failed to build')
+    return 'built', '{}-{}.tar.bz2'.format(job.meta.name(), job.case)
+
+
+def fake_build_into(directory, job, channels, rebuild):
+    dist_path = os.path.join(directory, job.meta.name() + '.tar.bz2')
+    with open(dist_path, 'w') as fh:
+        fh.write(job.meta.name())
+    return 'built', dist_path
+
+
+def configured_paths(job, channels, rebuild):
+    # Reports where conda-build would build the job, and what it would see
+    # there.
+    import conda_build.config
+    import conda_build.source
+    with private_croot(job.source_name) as croot:
+        configure_conda_build(croot, job.case, channels)
+        config = conda_build.config.config
+        paths = [conda_build.source.WORK_DIR, config.build_prefix,
+                 config.test_prefix, config.bldpkgs_dir]
+        for path in paths[:3]:
+            os.makedirs(path)
+        return 'built', (croot, paths, os.listdir(config.bldpkgs_dir))
+
+
+class DictArtefactCache(ArtefactCache):
+    def __init__(self):
+        self.artefacts = {}
+
+    def get(self, key, target_dir):
+        return self.artefacts.get(key)
+
+    def put(self, key, fname):
+        self.artefacts[key] = fname
+
+
+class Test_JobGraph(unittest.TestCase):
+    def setUp(self):
+        pkgs = [DummyPackage('a', [], ['b']),
+                DummyPackage('b', ['c']),
+                DummyPackage('c'),
+                DummyPackage('d', ['c >1.0'])]
+        self.jobs = [BuildJob(pkg, 'src', ()) for pkg in pkgs]
+
+    def test_dependencies(self):
+        graph = JobGraph(self.jobs)
+        self.assertEqual(graph.dependencies, {0: set([1]), 1: set([2]),
+                                              2: set(), 3: set([2])})
+
+    def test_ready_order(self):
+        graph = JobGraph(self.jobs)
+        self.assertEqual(graph.ready(), [2])
+        self.assertEqual(graph.ready(), [])
+        graph.completed(2)
+        self.assertEqual(graph.ready(), [1, 3])
+        graph.completed(1)
+        self.assertEqual(graph.ready(), [0])
+
+    def test_failure_skips_dependents(self):
+        graph = JobGraph(self.jobs)
+        graph.ready()
+        self.assertEqual(graph.failed(2), [0, 1, 3])
+        self.assertEqual(graph.ready(), [])
+        self.assertEqual(graph.abandon(), [])
+
+    def test_all_cases_are_dependencies(self):
+        jobs = [BuildJob(DummyPackage('a', ['b']), 'src', ()),
+                BuildJob(DummyPackage('b'), 'src', (('python', '2.7'),)),
+                BuildJob(DummyPackage('b'), 'src', (('python', '3.5'),))]
+        self.assertEqual(JobGraph(jobs).dependencies[0], set([1, 2]))
+
+    def test_cycle(self):
+        jobs = [BuildJob(DummyPackage('a', ['b']), 'src', ()),
+                BuildJob(DummyPackage('b', ['a']), 'src', ())]
+        graph = JobGraph(jobs)
+        self.assertEqual(graph.ready(), [])
+        self.assertEqual(graph.abandon(), [0, 1])
+
+
+class Test_run_jobs(unittest.TestCase):
+    def test_results(self):
+        pkgs = [DummyPackage('a', [], ['b']),
+                DummyPackage('b', ['c']),
+                DummyPackage('c'),
+                DummyPackage('d', ['c'])]
+        jobs = [BuildJob(pkg, 'src', ()) for pkg in pkgs]
+        seen = []
+        results = run_jobs(jobs, [], processes=2, build_fn=fake_build,
+                           callback=seen.append)
+        self.assertEqual([result.status for result in results],
+                         ['skipped', 'failed', 'built', 'built'])
+        self.assertEqual(results[2].dist_path, 'c-().tar.bz2')
+        self.assertIn('b failed to build', results[1].error)
+        self.assertEqual(sorted(seen), sorted(results))
+
+    def test_fingerprints(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        store = FingerprintStore(os.path.join(tmpdir, 'fingerprints.json'))
+        jobs = [BuildJob(DummyPackage('a', ['b']), 'src', ()),
+                BuildJob(DummyPackage('b'), 'src', ())]
+        versions = {'a': 1, 'b': 1}
+
+        def fingerprint(job):
+            return '{}-{}'.format(job.meta.name(), versions[job.meta.name()])
+
+        def run():
+            results = run_jobs(jobs, [], build_fn=partial(fake_build_into, tmpdir),
+                               fingerprint_fn=fingerprint,
+                               fingerprints=store)
+            return [result.status for result in results]
+
+        self.assertEqual(run(), ['built', 'built'])
+        self.assertEqual(run(), ['unchanged', 'unchanged'])
+        versions['a'] = 2
+        self.assertEqual(run(), ['built', 'unchanged'])
+
+    def test_artefact_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        jobs = [BuildJob(DummyPackage('a', ['b']), 'src', ()),
+                BuildJob(DummyPackage('b'), 'src', ())]
+        cache = DictArtefactCache()
+
+        def run(host):
+            store = FingerprintStore(os.path.join(tmpdir, host + '.json'))
+            results = run_jobs(jobs, [], build_fn=partial(fake_build_into,
+                                                          tmpdir),
+                               fingerprint_fn=lambda job: job.meta.name(),
+                               fingerprints=store, artefact_cache=cache)
+            return [result.status for result in results]
+
+        self.assertEqual(run('host1'), ['built', 'built'])
+        self.assertEqual(sorted(cache.artefacts), ['a', 'b'])
+        # A second host gets the artefacts from the cache.
+        self.assertEqual(run('host2'), ['cached', 'cached'])
+
+    def test_private_croots(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        orig = conda_manifest.config.src_distributions_dir
+        conda_manifest.config.src_distributions_dir = partial(os.path.join,
+                                                              tmpdir)
+        self.addCleanup(setattr, conda_manifest.config,
+                        'src_distributions_dir', orig)
+
+        jobs = [BuildJob(DummyPackage(name), 'src', ()) for name in 'abc']
+        results = run_jobs(jobs, [], processes=3, build_fn=configured_paths)
+        croots = set()
+        for result in results:
+            croot, paths, built = result.dist_path
+            self.assertEqual(os.path.dirname(croot),
+                             os.path.join(tmpdir, 'src'))
+            for path in paths:
+                self.assertEqual(os.path.commonprefix([croot, path]), croot)
+            self.assertEqual(built, [])
+            croots.add(croot)
+        self.assertEqual(len(croots), 3)
+        # The private roots are removed once the jobs are done.
+        self.assertEqual(os.listdir(os.path.join(tmpdir, 'src')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
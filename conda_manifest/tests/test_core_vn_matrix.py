@@ -1,7 +1,9 @@
 import unittest
 
 import conda.config
-from conda_manifest.core_vn_matrix import special_case_version_matrix
+from conda_manifest.core_vn_matrix import (special_case_version_matrix,
+                                           special_case_version_matrices,
+                                           special_versions_config)
 from conda_manifest.tests import DummyPackage, DummyIndex
 
 
@@ -101,6 +103,91 @@ class Test_special_case_version_matrix(unittest.TestCase):
                                 ])
                          )
 
+    def test_perl(self):
+        a = DummyPackage('pkgA', ['perl'])
+        self.index.add_pkg('perl', '5.18.2')
+        self.index.add_pkg('perl', '5.20.1')
+        r = special_case_version_matrix(a, self.index)
+        self.assertEqual(r, set([(('perl', '5.18'),),
+                                 (('perl', '5.20'),)]))
+
+    def test_r_and_python(self):
+        # An R package depending upon python for some versions of R only.
+        a = DummyPackage('pkgA', ['r-rpy'])
+        self.index.add_pkg('r-rpy', '1.0', 'r31', depends=['r 3.1*',
+                                                         'python <3'])
+        self.index.add_pkg('r-rpy', '1.0', 'r32', depends=['r 3.2*',
+                                                         'python'])
+        self.index.add_pkg('r', '3.1.0')
+        self.index.add_pkg('r', '3.2.1')
+        self.index.add_pkg('python', '2.7.2')
+        self.index.add_pkg('python', '3.5.0')
+        # The recipe doesn't depend upon the special packages directly.
+        r = special_case_version_matrix(a, self.index)
+        self.assertEqual(r, set([()]))
+
+        a = DummyPackage('pkgA', ['r', 'python', 'r-rpy'])
+        r = special_case_version_matrix(a, self.index)
+        self.assertEqual(r, set([(('python', '2.7'), ('r', '3.1')),
+                                 (('python', '2.7'), ('r', '3.2')),
+                                 (('python', '3.5'), ('r', '3.2'))]))
+
+    def test_incompatible_dimensions_pruned(self):
+        a = DummyPackage('pkgA', ['numpy', 'perl'])
+        self.index.add_pkg('numpy', '1.8.0', 'py27', depends=['python <3'])
+        self.index.add_pkg('python', '2.7.2')
+        self.index.add_pkg('python', '3.5.0')
+        self.index.add_pkg('perl', '5.18.2', depends=['python >=3'])
+        self.index.add_pkg('perl', '5.20.1')
+        r = special_case_version_matrix(a, self.index)
+        self.assertEqual(r, set([(('python', '2.7'), ('numpy', '1.8'),
+                                  ('perl', '5.20'))]))
+
+
+class Test_special_versions_config(unittest.TestCase):
+    def test_all(self):
+        case = (('python', '2.7'), ('numpy', '1.8'), ('perl', '5.20'),
+                ('r', '3.2'))
+        self.assertEqual(special_versions_config(case),
+                         {'CONDA_PY': 27, 'CONDA_NPY': 18,
+                          'CONDA_PERL': '5.20', 'CONDA_R': '3.2'})
+
+    def test_unknown(self):
+        with self.assertRaises(NotImplementedError):
+            special_versions_config((('ruby', '2.1'),))
+
+
+class Test_special_case_version_matrices(unittest.TestCase):
+    def setUp(self):
+        self.index = DummyIndex()
+        self.index.add_pkg('oldschool', '1.8.0', 'py27', depends=['python <3'])
+        self.index.add_pkg('python', '2.7.2')
+        self.index.add_pkg('python', '3.5.0')
+
+    # Metas are used as keys, so the dummy packages are given hashable
+    # (tuple) requirements.
+    def test_matrices(self):
+        metas = [DummyPackage('pkgA', ('python',)),
+                 DummyPackage('pkgB', ('python', 'oldschool')),
+                 DummyPackage('pkgC', ('python <3',)),
+                 DummyPackage('pkgD', ('oldschool',))]
+        r = special_case_version_matrices(metas, self.index)
+        self.assertEqual(r, {meta: special_case_version_matrix(meta,
+                                                               self.index)
+                             for meta in metas})
+
+    def test_shared_signature(self):
+        metas = [DummyPackage('pkgA', ('python',)),
+                 DummyPackage('pkgB', ('python  ',)),
+                 DummyPackage('pkgC', ('python',))]
+        r = special_case_version_matrices(metas, self.index)
+        expected = set([(('python', '2.7'),), (('python', '3.5'),)])
+        self.assertEqual(r, {meta: expected for meta in metas})
+        # Each meta has its own matrix, even though it was only computed
+        # once.
+        r[metas[0]].clear()
+        self.assertEqual(r[metas[1]], expected)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,300 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import conda.install
+
+import conda_manifest.deploy as deploy
+from conda_manifest.deploy import (DeployJournal, DeployPlan, extract_dist,
+                                   extract_distributions, link_batches,
+                                   plan_deploy, read_manifest, rollback)
+from conda_manifest.tests import write_dist
+
+
+class Test_read_manifest(unittest.TestCase):
+    def test_read(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.manifest',
+                                         delete=False) as fh:
+            fh.write('a     1.0    py27_0    src1\n'
+                     'b     2.0    0         src2\n'
+                     'c     3.0    0         src1')
+        try:
+            self.assertEqual(read_manifest(fh.name),
+                             {'src1': ['a-1.0-py27_0', 'c-3.0-0'],
+                              'src2': ['b-2.0-0']})
+        finally:
+            os.remove(fh.name)
+
+
+class Test_extract_dist(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pkgs_dir = os.path.join(self.tmpdir, 'pkgs')
+        os.makedirs(self.pkgs_dir)
+        self.tarball = write_dist(self.tmpdir, 'a', '1.0',
+                                  {'lib/a.txt': b'hello'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_extract(self):
+        extract_dist(self.tarball, self.pkgs_dir, 'a-1.0-0')
+        self.assertTrue(conda.install.is_extracted(self.pkgs_dir, 'a-1.0-0'))
+        with open(os.path.join(self.pkgs_dir, 'a-1.0-0', 'lib',
+                               'a.txt')) as fh:
+            self.assertEqual(fh.read(), 'hello')
+        # Only the extracted distribution remains, with no copy of the
+        # tarball or temporary directory.
+        self.assertEqual(os.listdir(self.pkgs_dir), ['a-1.0-0'])
+
+    def test_partial_extraction_replaced(self):
+        os.makedirs(os.path.join(self.pkgs_dir, 'a-1.0-0', 'junk'))
+        extract_dist(self.tarball, self.pkgs_dir, 'a-1.0-0')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.pkgs_dir,
+                                                        'a-1.0-0'))),
+                         ['info', 'lib'])
+
+
+class DistsTestCase(unittest.TestCase):
+    """
+    Provides a directory of distributions (the same for every source), and
+    a package cache.
+
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pkgs_dir = os.path.join(self.tmpdir, 'pkgs')
+        self.dists_dir = os.path.join(self.tmpdir, 'dists')
+        os.makedirs(self.dists_dir)
+        for name in 'abc':
+            write_dist(self.dists_dir, name, '1.0',
+                       {'lib/{}.txt'.format(name): b'hello'})
+        orig_dist_tarball = deploy.dist_tarball
+        deploy.dist_tarball = lambda source_name, dist: os.path.join(
+            self.dists_dir, dist + '.tar.bz2')
+
+        def restore():
+            deploy.dist_tarball = orig_dist_tarball
+        self.addCleanup(restore)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class Test_extract_distributions(DistsTestCase):
+    def check(self, processes):
+        packages = {'src': ['a-1.0-0', 'b-1.0-0', 'c-1.0-0']}
+        extracted = extract_distributions(packages, self.pkgs_dir,
+                                          processes=processes)
+        self.assertEqual(sorted(extracted), packages['src'])
+        for dist in packages['src']:
+            self.assertTrue(conda.install.is_extracted(
+                os.path.join(self.pkgs_dir, 'src'), dist))
+        # Nothing more to extract.
+        self.assertEqual(extract_distributions(packages, self.pkgs_dir,
+                                               processes=processes), [])
+
+    def test_serial(self):
+        self.check(processes=1)
+
+    def test_pool(self):
+        self.check(processes=3)
+
+    def test_shared_store(self):
+        packages = {'src1': ['a-1.0-0', 'b-1.0-0'], 'src2': ['a-1.0-0']}
+        extract_distributions(packages, self.pkgs_dir)
+        inodes = [os.stat(os.path.join(self.pkgs_dir, source_name, dist,
+                                       'lib', fname)).st_ino
+                  for source_name, dist, fname in
+                  [('src1', 'a-1.0-0', 'a.txt'), ('src1', 'b-1.0-0', 'b.txt'),
+                   ('src2', 'a-1.0-0', 'a.txt')]]
+        # The content of each file is the same, so it is stored once.
+        self.assertEqual(len(set(inodes)), 1)
+
+    def test_no_store(self):
+        extract_distributions({'src': ['a-1.0-0']}, self.pkgs_dir,
+                              use_store=False)
+        self.assertEqual(os.listdir(self.pkgs_dir), ['src'])
+
+
+class Test_plan_deploy(unittest.TestCase):
+    def test_plan(self):
+        plan = plan_deploy({'src1': ['a-1.0-0', 'b-2.0-0'],
+                            'src2': ['c-1.0-0']},
+                           ['a-1.0-0', 'b-1.0-0', 'd-1.0-0'])
+        self.assertEqual(plan, DeployPlan({'b-2.0-0': 'src1',
+                                           'c-1.0-0': 'src2'},
+                                          set(['b-1.0-0', 'd-1.0-0']),
+                                          set(['a-1.0-0'])))
+
+
+class Test_link_batches(unittest.TestCase):
+    def test_disjoint(self):
+        files = {'a-1-0': ['lib/a'], 'b-1-0': ['lib/b', 'lib/shared'],
+                 'c-1-0': ['lib/c', 'lib/shared'], 'd-1-0': ['lib/d']}
+        self.assertEqual(link_batches(sorted(files), files),
+                         [['a-1-0', 'b-1-0', 'd-1-0'], ['c-1-0']])
+
+    def test_link_scripts(self):
+        files = {'a-1-0': ['lib/a'], 'b-1-0': ['bin/.b-post-link.sh'],
+                 'c-1-0': ['lib/c']}
+        self.assertEqual(link_batches(sorted(files), files),
+                         [['a-1-0', 'c-1-0'], ['b-1-0']])
+
+
+class Test_deploy(DistsTestCase):
+    def setUp(self):
+        super(Test_deploy, self).setUp()
+        self.prefix = os.path.join(self.tmpdir, 'env')
+
+    def linked_files(self):
+        return sorted(os.listdir(os.path.join(self.prefix, 'lib')))
+
+    def test_differential(self):
+        deploy.deploy({'src': ['a-1.0-0', 'b-1.0-0']}, self.prefix,
+                      self.pkgs_dir)
+        self.assertEqual(self.linked_files(), ['a.txt', 'b.txt'])
+        plan = deploy.deploy({'src': ['b-1.0-0', 'c-1.0-0']}, self.prefix,
+                             self.pkgs_dir)
+        self.assertEqual(plan, DeployPlan({'c-1.0-0': 'src'},
+                                          set(['a-1.0-0']),
+                                          set(['b-1.0-0'])))
+        self.assertEqual(self.linked_files(), ['b.txt', 'c.txt'])
+        self.assertFalse(DeployJournal(self.prefix).exists())
+
+    def interrupted_deploy(self):
+        deploy.deploy({'src': ['a-1.0-0']}, self.prefix, self.pkgs_dir)
+        # Simulate a deploy which was interrupted while linking c.
+        extract_distributions({'src': ['b-1.0-0', 'c-1.0-0']},
+                              self.pkgs_dir)
+        journal = DeployJournal(self.prefix)
+        journal.start(DeployPlan({'b-1.0-0': 'src', 'c-1.0-0': 'src'},
+                                 set(['a-1.0-0']), set()))
+        journal.record('unlink', 'a-1.0-0', None, 'begin')
+        conda.install.unlink(self.prefix, 'a-1.0-0')
+        journal.record('unlink', 'a-1.0-0', None, 'done')
+        src_pkgs = os.path.join(self.pkgs_dir, 'src')
+        for dist in ['b-1.0-0', 'c-1.0-0']:
+            journal.record('link', dist, 'src', 'begin')
+            conda.install.link(src_pkgs, self.prefix, dist)
+        journal.record('link', 'b-1.0-0', 'src', 'done')
+        os.remove(os.path.join(self.prefix, 'conda-meta', 'c-1.0-0.json'))
+        return journal
+
+    def test_resume(self):
+        self.interrupted_deploy()
+        plan = deploy.deploy({'src': ['b-1.0-0']}, self.prefix,
+                             self.pkgs_dir)
+        self.assertEqual(plan, DeployPlan({}, set(), set(['b-1.0-0'])))
+        # The partially linked c has been removed.
+        self.assertEqual(self.linked_files(), ['b.txt'])
+
+    def test_rollback(self):
+        journal = self.interrupted_deploy()
+        rollback(self.prefix, self.pkgs_dir)
+        self.assertEqual(self.linked_files(), ['a.txt'])
+        self.assertEqual(conda.install.linked(self.prefix),
+                         set(['a-1.0-0']))
+        self.assertFalse(journal.exists())
+
+    def test_rollback_nothing_interrupted(self):
+        deploy.deploy({'src': ['a-1.0-0']}, self.prefix, self.pkgs_dir)
+        rollback(self.prefix, self.pkgs_dir)
+        self.assertEqual(self.linked_files(), ['a.txt'])
+
+    def test_padding_error(self):
+        # Binary files whose placeholder is shorter than the prefix can't
+        # be relocated, which conda reports with sys.exit.
+        placeholder = b'/opt/anaconda1anaconda2anaconda3'
+        for name in 'pq':
+            fname = 'lib/{}.bin'.format(name)
+            write_dist(self.dists_dir, name, '1.0',
+                       {fname: placeholder + b'\0'},
+                       info_files={'info/has_prefix': placeholder +
+                                   ' binary {}\n'.format(fname).encode('utf-8')})
+        self.prefix = os.path.join(self.tmpdir, 'env' + 'x' * 40)
+        with self.assertRaises(RuntimeError):
+            deploy.deploy({'src': ['p-1.0-0', 'q-1.0-0']}, self.prefix,
+                          self.pkgs_dir, threads=2)
+        self.assertTrue(DeployJournal(self.prefix).exists())
+        rollback(self.prefix, self.pkgs_dir)
+        self.assertEqual(conda.install.linked(self.prefix), set())
+        self.assertFalse(DeployJournal(self.prefix).exists())
+
+
+class Test_deploy_prefixes(DistsTestCase):
+    def test_fan_out(self):
+        prefixes = [os.path.join(self.tmpdir, 'env{}'.format(i))
+                    for i in range(3)]
+        deploy.deploy({'src': ['a-1.0-0']}, prefixes[0], self.pkgs_dir)
+        # A prefix which can't be deployed to.
+        with open(prefixes[2], 'w'):
+            pass
+        results = deploy.deploy_prefixes({'src': ['b-1.0-0']}, prefixes,
+                                         self.pkgs_dir)
+        self.assertEqual([result.prefix for result in results], prefixes)
+        self.assertEqual(results[0].plan,
+                         DeployPlan({'b-1.0-0': 'src'}, set(['a-1.0-0']),
+                                    set()))
+        self.assertEqual(results[1].plan,
+                         DeployPlan({'b-1.0-0': 'src'}, set(), set()))
+        self.assertIsNone(results[1].error)
+        self.assertIsNone(results[2].plan)
+        self.assertIsNotNone(results[2].error)
+        for prefix in prefixes[:2]:
+            self.assertEqual(conda.install.linked(prefix), set(['b-1.0-0']))
+
+    def test_link_scripts(self):
+        # conda sets the environment of link scripts in os.environ, so the
+        # scripts of the prefixes being deployed to must not race.
+        for name in ['s', 't']:
+            script = 'echo "$PREFIX $PKG_NAME" > "$PREFIX/{}.txt"\n'.format(
+                name)
+            write_dist(self.dists_dir, name, '1.0',
+                       {'bin/.{}-post-link.sh'.format(name):
+                        script.encode('utf-8')})
+        # Widen the window between conda setting a script's environment and
+        # running it.
+        orig_check_call = subprocess.check_call
+
+        def check_call(*args, **kwargs):
+            time.sleep(0.05)
+            return orig_check_call(*args, **kwargs)
+        subprocess.check_call = check_call
+
+        def restore():
+            subprocess.check_call = orig_check_call
+        self.addCleanup(restore)
+
+        prefixes = [os.path.join(self.tmpdir, 'env{}'.format(i))
+                    for i in range(4)]
+        packages = {'src': ['s-1.0-0', 't-1.0-0']}
+        results = deploy.deploy_prefixes(packages, prefixes, self.pkgs_dir)
+        self.assertEqual([result.error for result in results],
+                         [None] * len(prefixes))
+        for prefix in prefixes:
+            for name in ['s', 't']:
+                with open(os.path.join(prefix, name + '.txt')) as fh:
+                    self.assertEqual(fh.read(),
+                                     '{} {}\n'.format(prefix, name))
+
+    def test_failing_link_script(self):
+        write_dist(self.dists_dir, 'f', '1.0',
+                   {'bin/.f-post-link.sh': b'exit 1\n'})
+        prefixes = [os.path.join(self.tmpdir, 'env{}'.format(i))
+                    for i in range(2)]
+        packages = {'src': ['a-1.0-0', 'f-1.0-0']}
+        results = deploy.deploy_prefixes(packages, prefixes, self.pkgs_dir)
+        self.assertEqual([result.prefix for result in results], prefixes)
+        for result in results:
+            self.assertIsNone(result.plan)
+            self.assertIn('post-link failed', result.error)
+            # The journal is kept, to resume or roll back the deploy.
+            self.assertTrue(DeployJournal(result.prefix).exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,12 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from conda_manifest.filter_recipes import filter_packages
+import conda_manifest.config
+from conda_manifest.env_recipes import (filter_packages, RecipeIndex,
+                                        create_env_recipes, load_env_recipes,
+                                        source_metas)
 from conda_manifest.tests import DummyPackage
 
 
@@ -62,5 +68,162 @@ class Test_resolve_recipes(unittest.TestCase):
         self.assertEqual(r, {'a': [('ab', a)]})
 
 
+class Test_RecipeClosure(unittest.TestCase):
+    def setUp(self):
+        self.pkgs = {'a': DummyPackage('a', [], ['b']),
+                     'b': DummyPackage('b', ['c']),
+                     'c': DummyPackage('c'),
+                     'd': DummyPackage('d', ['c', 'e']),
+                     'e': DummyPackage('e', [], ['e'])}
+
+    def test_layered_sources(self):
+        a, a_base = DummyPackage('a', [], ['b', 'x']), DummyPackage('a')
+        b, b_mid = DummyPackage('b', ['c >1']), DummyPackage('b', ['e'])
+        c1, c2 = DummyPackage('c', ['d']), DummyPackage('c', ['d', 'e'])
+        d, d_base = DummyPackage('d'), DummyPackage('d', ['e'])
+        e = DummyPackage('e')
+        src_metas = {'top': [a, b], 'mid1': [b_mid, c1], 'mid2': [c2, d],
+                     'base': [a_base, d_base, e]}
+        env_sources = [['top'], ['mid1', 'mid2'], ['base']]
+        # Packages come from the first level which provides them, from
+        # every source of that level, and x (which no source provides) is
+        # left out.
+        expected = {'a': [('top', a)],
+                    'b': [('top', b)],
+                    'c': [('mid1', c1), ('mid2', c2)],
+                    'd': [('mid2', d)],
+                    'e': [('base', e)]}
+        self.assertEqual(filter_packages(env_sources, ['a'], src_metas),
+                         expected)
+        closure = RecipeIndex(src_metas).closure(env_sources, ['a'])
+        self.assertEqual(closure.where_from, expected)
+
+    def test_reverse_dependencies(self):
+        src_metas = {'src': list(self.pkgs.values())}
+        closure = RecipeIndex(src_metas).closure([['src']], ['a', 'd'])
+        self.assertEqual(closure.dependencies['a'], set(['b']))
+        self.assertEqual(closure.reverse_dependencies['c'], set(['b', 'd']))
+        self.assertEqual(closure.reverse_dependencies['e'], set(['d', 'e']))
+        self.assertEqual(closure.dependents('c'), set(['a', 'b', 'd']))
+        self.assertEqual(closure.dependents('a'), set())
+
+    def test_self_dependency(self):
+        e = self.pkgs['e']
+        r = filter_packages(env_sources=[['src']], env_specs=['e'],
+                            source_metas={'src': [e]})
+        self.assertEqual(r, {'e': [('src', e)]})
+
+
+class DummyRecipe(DummyPackage):
+    # A DummyPackage which lives in a recipe directory.
+    def __new__(cls, name, path):
+        self = super(DummyRecipe, cls).__new__(cls, name)
+        self.path = path
+        return self
+
+
+class Test_create_env_recipes(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmpdir, 'env_recipes')
+        self.recipes = {}
+        for name in ['a', 'b', 'c']:
+            path = os.path.join(self.tmpdir, 'src', name)
+            os.makedirs(path)
+            self.recipes[name] = DummyRecipe(name, path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pkgs(self, names, source='src'):
+        return {name: [(source, self.recipes[name])] for name in names}
+
+    def test_fresh(self):
+        changes = create_env_recipes(self.pkgs('ab'), self.location)
+        self.assertEqual(changes.added, ['src_a-0.0-0', 'src_b-0.0-0'])
+        self.assertEqual(sorted(os.listdir(self.location)),
+                         ['env_recipes.json', 'src_a-0.0-0', 'src_b-0.0-0'])
+        # Nothing is written into the recipes themselves.
+        self.assertEqual(os.listdir(self.recipes['a'].path), [])
+        state = load_env_recipes(self.location)
+        self.assertEqual(state['recipes']['src_a-0.0-0'],
+                         {'source': 'src', 'path': self.recipes['a'].path})
+        self.assertEqual(state['changed'], ['src_a-0.0-0', 'src_b-0.0-0'])
+
+    def test_differential(self):
+        create_env_recipes(self.pkgs('ab'), self.location)
+        link = os.path.join(self.location, 'src_a-0.0-0')
+        orig_mtime = os.lstat(link).st_mtime
+        self.recipes['b'] = DummyRecipe('b', self.recipes['c'].path)
+        changes = create_env_recipes(self.pkgs('ab'), self.location)
+        self.assertEqual(changes.unchanged, ['src_a-0.0-0'])
+        self.assertEqual(changes.retargeted, ['src_b-0.0-0'])
+        self.assertEqual(os.lstat(link).st_mtime, orig_mtime)
+        self.assertEqual(os.readlink(os.path.join(self.location,
+                                                  'src_b-0.0-0')),
+                         self.recipes['c'].path)
+        self.assertEqual(load_env_recipes(self.location)['changed'],
+                         ['src_b-0.0-0'])
+
+    def test_removed(self):
+        create_env_recipes(self.pkgs('ab'), self.location)
+        changes = create_env_recipes(self.pkgs('a'), self.location)
+        self.assertEqual(changes.removed, ['src_b-0.0-0'])
+        self.assertEqual(changes.added, [])
+        self.assertEqual(sorted(os.listdir(self.location)),
+                         ['env_recipes.json', 'src_a-0.0-0'])
+        # The recipe itself must not have been removed.
+        self.assertTrue(os.path.isdir(self.recipes['b'].path))
+
+    def test_duplicate(self):
+        pkgs = {'a': [('src', self.recipes['a']), ('src', self.recipes['a'])]}
+        with self.assertRaises(ValueError):
+            create_env_recipes(pkgs, self.location)
+
+
+
+class Test_source_metas(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.build_root = os.path.join(self.tmpdir, 'recipe_sources')
+        self.sources = {}
+        for source_name, names in [('src1', ['a', 'b']), ('src2', ['a']),
+                                   ('src3', ['c', 'd', 'e'])]:
+            self.sources[source_name] = {}
+            for name in names:
+                recipe_dir = os.path.join(self.build_root, source_name, name)
+                os.makedirs(recipe_dir)
+                with open(os.path.join(recipe_dir, 'meta.yaml'), 'w') as fh:
+                    fh.write('package:\n  name: {}\n  version: 1.0\n'
+                             ''.format(name))
+        orig = (conda_manifest.config.build_root,
+                conda_manifest.config.RECIPE_CACHE)
+
+        def restore():
+            (conda_manifest.config.build_root,
+             conda_manifest.config.RECIPE_CACHE) = orig
+        self.addCleanup(restore)
+        conda_manifest.config.build_root = self.build_root
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def scan(self, jobs):
+        # A separate recipe cache for each scan, so that both parse the
+        # recipes.
+        conda_manifest.config.RECIPE_CACHE = os.path.join(
+            self.tmpdir, 'recipe_cache_{}'.format(jobs))
+        return {source_name: [(meta.name(), meta.path) for meta in metas]
+                for source_name, metas in source_metas(self.sources,
+                                                       jobs=jobs).items()}
+
+    def test_pool_same_as_serial(self):
+        serial = self.scan(jobs=1)
+        self.assertEqual(sorted(serial), ['src1', 'src2', 'src3'])
+        self.assertEqual([name for name, _ in serial['src3']],
+                         ['c', 'd', 'e'])
+        self.assertEqual(self.scan(jobs=2), serial)
+
+
 if __name__ == '__main__':
     unittest.main()
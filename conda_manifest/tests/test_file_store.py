@@ -0,0 +1,174 @@
+from contextlib import closing
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import conda_manifest.file_store
+from conda_manifest.file_store import FileStore
+from conda_manifest.tests import write_dist
+
+
+class CountingStore(FileStore):
+    """Counts the tarballs which are decompressed."""
+    def __init__(self, root):
+        super(CountingStore, self).__init__(root)
+        self.decompressed = 0
+
+    def _extract(self, tarball, target):
+        self.decompressed += 1
+        return super(CountingStore, self)._extract(tarball, target)
+
+
+class Test_FileStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = CountingStore(os.path.join(self.tmpdir, 'store'))
+        self.tarball_a = write_dist(self.tmpdir, 'a', '1.0',
+                                    {'lib/shared.txt': b'shared',
+                                     'lib/a.txt': b'a'})
+        self.tarball_b = write_dist(self.tmpdir, 'b', '1.0',
+                                    {'lib/shared.txt': b'shared',
+                                     'lib/b.txt': b'b'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def target(self, name):
+        target = os.path.join(self.tmpdir, name)
+        os.makedirs(target)
+        return target
+
+    def read(self, *path):
+        with open(os.path.join(self.tmpdir, *path), 'rb') as fh:
+            return fh.read()
+
+    def inode(self, *path):
+        return os.stat(os.path.join(self.tmpdir, *path)).st_ino
+
+    def test_add(self):
+        sha256, path = self.store.add(io.BytesIO(b'content'), 0o644, 0)
+        self.assertEqual(self.store.add(io.BytesIO(b'content'), 0o644, 0),
+                         (sha256, path))
+        # The mode, and a modification time where one is given, are part
+        # of a stored file's identity.
+        self.assertNotEqual(self.store.add(io.BytesIO(b'content'), 0o755, 0),
+                            (sha256, path))
+        self.assertNotEqual(self.store.add(io.BytesIO(b'content'), 0o644, 1),
+                            (sha256, path))
+        self.assertNotEqual(self.store.add(io.BytesIO(b'content'), 0o644),
+                            (sha256, path))
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), b'content')
+
+    def test_add_streamed(self):
+        orig_chunk_size = conda_manifest.file_store.CHUNK_SIZE
+        conda_manifest.file_store.CHUNK_SIZE = 3
+        try:
+            streamed = self.store.add(io.BytesIO(b'1234567'), 0o644, 0)
+        finally:
+            conda_manifest.file_store.CHUNK_SIZE = orig_chunk_size
+        self.assertEqual(self.store.add(io.BytesIO(b'1234567'), 0o644, 0),
+                         streamed)
+        with open(streamed[1], 'rb') as fh:
+            self.assertEqual(fh.read(), b'1234567')
+        self.assertEqual(os.listdir(os.path.join(self.store.root, 'tmp')),
+                         [])
+
+    def test_shared_files(self):
+        self.assertTrue(self.store.extract(self.tarball_a, self.target('a')))
+        self.assertTrue(self.store.extract(self.tarball_b, self.target('b')))
+        self.assertEqual(self.read('a', 'lib', 'a.txt'), b'a')
+        self.assertEqual(self.read('b', 'lib', 'b.txt'), b'b')
+        self.assertEqual(self.read('b', 'info', 'files'),
+                         b'lib/b.txt\nlib/shared.txt')
+        self.assertEqual(self.inode('a', 'lib', 'shared.txt'),
+                         self.inode('b', 'lib', 'shared.txt'))
+        self.assertNotEqual(self.inode('a', 'lib', 'a.txt'),
+                            self.inode('b', 'lib', 'b.txt'))
+
+    def test_extracted_tarball(self):
+        self.store.extract(self.tarball_a, self.target('src1'))
+        self.assertFalse(self.store.extract(self.tarball_a,
+                                            self.target('src2')))
+        self.assertEqual(self.store.decompressed, 1)
+        self.assertEqual(self.read('src2', 'lib', 'a.txt'), b'a')
+        self.assertEqual(self.inode('src1', 'lib', 'a.txt'),
+                         self.inode('src2', 'lib', 'a.txt'))
+
+    def write_tarball(self, name, members):
+        # Members are (name, mtime, content), with None content for a
+        # directory.
+        tarball = os.path.join(self.tmpdir, name + '.tar.bz2')
+        with closing(tarfile.open(tarball, 'w:bz2')) as tar:
+            for name, mtime, content in members:
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.mtime = mtime
+                if content is None:
+                    tarinfo.type = tarfile.DIRTYPE
+                    tarinfo.mode = 0o755
+                    tar.addfile(tarinfo)
+                else:
+                    tarinfo.size = len(content)
+                    tar.addfile(tarinfo, io.BytesIO(content))
+        return tarball
+
+    def mtime(self, *path):
+        return os.stat(os.path.join(self.tmpdir, *path)).st_mtime
+
+    def test_mtimes(self):
+        # Directories and Python source files have the modification times
+        # of the tarball's members, as when it is extracted by tarfile.
+        tarball = self.write_tarball('mtimes', [
+            ('lib', 1300000000, None),
+            ('lib/a.py', 1400000000, b'1'),
+            ('lib/a.pyc', 1400000001, b'1')])
+        with closing(tarfile.open(tarball, 'r:bz2')) as tar:
+            tar.extractall(self.target('plain'))
+        self.store.extract(tarball, self.target('src1'))
+        self.store.extract(tarball, self.target('src2'))
+        for path in ['lib', 'lib/a.py']:
+            for target in ['src1', 'src2']:
+                self.assertEqual(self.mtime(target, path),
+                                 self.mtime('plain', path))
+        self.assertEqual(self.mtime('src1', 'lib', 'a.py'), 1400000000)
+        # The content is the same, but only the source's modification time
+        # is kept.
+        self.assertNotEqual(self.inode('src1', 'lib', 'a.py'),
+                            self.inode('src1', 'lib', 'a.pyc'))
+        self.assertEqual(self.inode('src1', 'lib', 'a.py'),
+                         self.inode('src2', 'lib', 'a.py'))
+
+    def test_shared_across_builds(self):
+        # Each build gives its files new modification times, but files
+        # which are otherwise identical are still shared.
+        for version, mtime in [('1.0', 1400000000), ('1.1', 1500000000)]:
+            tarball = self.write_tarball('a-' + version, [
+                ('lib/data.txt', mtime, b'data'),
+                ('lib/a.py', mtime, b'a'),
+                ('lib/version.txt', mtime, version.encode('ascii'))])
+            self.store.extract(tarball, self.target(version))
+        self.assertEqual(self.inode('1.0', 'lib', 'data.txt'),
+                         self.inode('1.1', 'lib', 'data.txt'))
+        self.assertEqual(os.stat(os.path.join(self.tmpdir, '1.0', 'lib',
+                                              'data.txt')).st_nlink, 3)
+        self.assertNotEqual(self.inode('1.0', 'lib', 'a.py'),
+                            self.inode('1.1', 'lib', 'a.py'))
+        self.assertEqual(self.mtime('1.1', 'lib', 'a.py'), 1500000000)
+
+    def test_pruned(self):
+        self.store.extract(self.tarball_a, self.target('src1'))
+        shutil.rmtree(os.path.join(self.tmpdir, 'src1'))
+        self.assertEqual(self.store.prune(), 4)
+        # The stored files have gone, so the tarball is extracted again.
+        self.assertTrue(self.store.extract(self.tarball_a,
+                                           self.target('src2')))
+        self.assertEqual(self.store.decompressed, 2)
+        self.assertEqual(self.read('src2', 'lib', 'a.txt'), b'a')
+        self.assertEqual(self.store.prune(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from conda_manifest.fingerprints import build_fingerprint, FingerprintStore
+
+
+class Test_build_fingerprint(unittest.TestCase):
+    def setUp(self):
+        self.inputs = dict(recipe_hash='abc', source_name='src',
+                           case=(('python', '2.7'), ('numpy', '1.9')),
+                           build_dists=['python-2.7.10-0.tar.bz2',
+                                        'numpy-1.9.2-py27_0.tar.bz2'])
+        self.fingerprint = build_fingerprint(**self.inputs)
+
+    def changed(self, **kwargs):
+        inputs = self.inputs.copy()
+        inputs.update(kwargs)
+        return build_fingerprint(**inputs)
+
+    def test_order_independent(self):
+        self.assertEqual(self.changed(build_dists=self.inputs['build_dists'][::-1],
+                                      case=self.inputs['case'][::-1]),
+                         self.fingerprint)
+
+    def test_changed_inputs(self):
+        for kwargs in [{'recipe_hash': 'def'},
+                       {'source_name': 'other'},
+                       {'case': (('python', '3.5'), ('numpy', '1.9'))},
+                       {'build_dists': ['python-2.7.10-0.tar.bz2']}]:
+            self.assertNotEqual(self.changed(**kwargs), self.fingerprint)
+
+
+class Test_FingerprintStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'cache', 'fingerprints.json')
+        self.dist = os.path.join(self.tmpdir, 'a-1.0-0.tar.bz2')
+        with open(self.dist, 'w') as fh:
+            fh.write('dist')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record(self):
+        store = FingerprintStore(self.fname)
+        self.assertIsNone(store.lookup('abc'))
+        store.record('abc', self.dist)
+        self.assertEqual(FingerprintStore(self.fname).lookup('abc'), self.dist)
+
+    def test_missing_artefact(self):
+        FingerprintStore(self.fname).record('abc', self.dist)
+        os.remove(self.dist)
+        self.assertIsNone(FingerprintStore(self.fname).lookup('abc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
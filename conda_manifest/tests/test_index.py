@@ -0,0 +1,251 @@
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from conda_manifest.index import (LayeredIndex, SourcedPackageInfo,
+                                  SourceIndexCache, index_by_name,
+                                  index_digest, prune_index)
+from conda_manifest.tests import DummyIndex, write_dist
+
+
+class Test_SourcedPackageInfo(unittest.TestCase):
+    def setUp(self):
+        self.info = {'name': 'a', 'version': '1.0'}
+        self.view = SourcedPackageInfo(self.info, 'src')
+
+    def test_view(self):
+        self.assertEqual(self.view, {'name': 'a', 'version': '1.0',
+                                     'source': 'src'})
+        self.assertEqual(self.view.source, 'src')
+        self.assertEqual(self.info, {'name': 'a', 'version': '1.0'})
+
+    def test_modification_not_written_through(self):
+        self.view['features'] = 'mkl'
+        del self.view['version']
+        self.assertEqual(self.view.copy(), {'name': 'a', 'source': 'src',
+                                            'features': 'mkl'})
+        self.assertEqual(self.info, {'name': 'a', 'version': '1.0'})
+        with self.assertRaises(KeyError):
+            self.view['version']
+
+    def test_pickle(self):
+        self.view['features'] = 'mkl'
+        self.assertEqual(pickle.loads(pickle.dumps(self.view)), self.view)
+
+    def test_no_dict(self):
+        with self.assertRaises(AttributeError):
+            self.view.__dict__
+
+    def test_mapping(self):
+        self.assertIsInstance(self.view, MutableMapping)
+        self.assertEqual(sorted(self.view.keys()),
+                         ['name', 'source', 'version'])
+        self.assertEqual(self.view.get('features', 'none'), 'none')
+        self.assertIn('source', self.view)
+
+
+class Test_LayeredIndex(unittest.TestCase):
+    def test_no_copy(self):
+        src_index = DummyIndex()
+        src_index.add_pkg('a', '1.0')
+        index = LayeredIndex({'src': src_index}, [['src']])
+        [(tar_name, info)] = index.items()
+        self.assertIs(info.info, src_index[tar_name])
+
+    def test_shadowing(self):
+        upper, lower = DummyIndex(), DummyIndex()
+        upper.add_pkg('a', '1.0')
+        lower.add_pkg('a', '2.0')
+        lower.add_pkg('b', '2.0')
+        index = LayeredIndex({'upper': upper, 'lower': lower},
+                             [['upper'], ['lower']])
+        self.assertEqual(sorted(index), ['a-1.0-0.tar.bz2', 'b-2.0-0.tar.bz2'])
+        self.assertEqual(index['b-2.0-0.tar.bz2']['source'], 'lower')
+
+    def test_to_dict(self):
+        src_index = DummyIndex()
+        src_index.add_pkg('a', '1.0')
+        index = LayeredIndex({'src': src_index}, [['src']])
+        result = index.to_dict()
+        self.assertIs(type(result['a-1.0-0.tar.bz2']), dict)
+        self.assertEqual(result['a-1.0-0.tar.bz2']['source'], 'src')
+
+
+class Test_LayeredIndex_insert(unittest.TestCase):
+    def setUp(self):
+        self.upper, self.lower = DummyIndex(), DummyIndex()
+        self.upper.add_pkg('a', '1.0')
+        self.lower.add_pkg('b', '1.0')
+        self.index = LayeredIndex({'upper': self.upper, 'lower': self.lower},
+                                  [['upper'], ['lower']])
+
+    def test_new_package(self):
+        self.assertTrue(self.index.insert('c-1.0-0.tar.bz2',
+                                          {'name': 'c', 'version': '1.0'},
+                                          'lower'))
+        self.assertEqual(self.index['c-1.0-0.tar.bz2']['source'], 'lower')
+
+    def test_shadowed(self):
+        self.assertFalse(self.index.insert('a-2.0-0.tar.bz2',
+                                           {'name': 'a', 'version': '2.0'},
+                                           'lower'))
+        self.assertEqual(sorted(self.index),
+                         ['a-1.0-0.tar.bz2', 'b-1.0-0.tar.bz2'])
+
+    def test_shadowing(self):
+        self.assertTrue(self.index.insert('b-2.0-0.tar.bz2',
+                                          {'name': 'b', 'version': '2.0'},
+                                          'upper'))
+        self.assertEqual(sorted(self.index),
+                         ['a-1.0-0.tar.bz2', 'b-2.0-0.tar.bz2'])
+        # Further packages from the lower level are now shadowed.
+        self.assertFalse(self.index.insert('b-3.0-0.tar.bz2',
+                                           {'name': 'b', 'version': '3.0'},
+                                           'lower'))
+
+    def test_same_as_rebuilt(self):
+        self.lower.add_pkg('c', '1.0')
+        self.index.insert('c-1.0-0.tar.bz2', self.lower['c-1.0-0.tar.bz2'],
+                          'lower')
+        self.assertEqual(self.index,
+                         LayeredIndex({'upper': self.upper,
+                                       'lower': self.lower},
+                                      [['upper'], ['lower']]))
+
+    def test_maintained_views(self):
+        self.index.insert('c-1.0-0.tar.bz2', {'name': 'c', 'version': '1.0'},
+                          'lower')
+        self.index.insert('b-2.0-0.tar.bz2', {'name': 'b', 'version': '2.0'},
+                          'upper')
+        self.index.insert('b-2.0-0.tar.bz2', {'name': 'b', 'version': '2.0',
+                                              'md5': 'abc'}, 'upper')
+        self.assertEqual(self.index.digest, index_digest(dict(self.index)))
+        self.assertEqual(self.index.by_name,
+                         {name: set(tar_names) for name, tar_names
+                          in index_by_name(self.index).items()})
+        restored = pickle.loads(pickle.dumps(self.index))
+        self.assertEqual(restored, self.index)
+        self.assertEqual(restored.digest, self.index.digest)
+        self.assertEqual(restored.by_name, self.index.by_name)
+
+    def test_conflict(self):
+        index = LayeredIndex({'s1': DummyIndex(), 's2': DummyIndex()},
+                             [['s1', 's2']])
+        index.insert('a-1.0-0.tar.bz2', {'name': 'a', 'version': '1.0'}, 's1')
+        with self.assertRaises(ValueError):
+            index.insert('a-1.0-0.tar.bz2', {'name': 'a', 'version': '1.0'},
+                         's2')
+
+
+class Test_prune_index(unittest.TestCase):
+    def setUp(self):
+        self.index = DummyIndex()
+        self.index.add_pkg('a', '1.0', depends=['b >1'])
+        self.index.add_pkg('a', '2.0', depends=['c'])
+        self.index.add_pkg('b', '1.0')
+        self.index.add_pkg('b', '2.0', depends=['a'])
+        self.index.add_pkg('c', '1.0')
+        self.index.add_pkg('d', '1.0', depends=['a'])
+        self.index.add_pkg('e', '1.0',
+                           with_features_depends={'mkl': ['f']})
+        self.index.add_pkg('f', '1.0')
+
+    def test_closure(self):
+        pruned = prune_index(self.index, ['a 1.0'])
+        # All versions of each reachable name are kept, whatever the spec.
+        self.assertEqual(sorted(pruned),
+                         ['a-1.0-0.tar.bz2', 'a-2.0-0.tar.bz2',
+                          'b-1.0-0.tar.bz2', 'b-2.0-0.tar.bz2',
+                          'c-1.0-0.tar.bz2'])
+        self.assertIs(pruned['a-1.0-0.tar.bz2'],
+                      self.index['a-1.0-0.tar.bz2'])
+
+    def test_features(self):
+        self.assertEqual(sorted(prune_index(self.index, ['e'])),
+                         ['e-1.0-0.tar.bz2', 'f-1.0-0.tar.bz2'])
+
+    def test_missing(self):
+        self.assertEqual(prune_index(self.index, ['missing']), {})
+
+
+class DirSourceIndexCache(SourceIndexCache):
+    def __init__(self, cache_dir, root):
+        super(DirSourceIndexCache, self).__init__(cache_dir)
+        self.root = root
+        self.read = []
+
+    def source_dir(self, source_name):
+        return os.path.join(self.root, source_name)
+
+    def _entry(self, tarball):
+        self.read.append(os.path.basename(tarball))
+        return super(DirSourceIndexCache, self)._entry(tarball)
+
+
+class Test_SourceIndexCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.src_dir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(self.src_dir)
+        write_dist(self.src_dir, 'a', '1.0')
+        write_dist(self.src_dir, 'b', '1.0')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def cache(self):
+        return DirSourceIndexCache(self.cache_dir, self.tmpdir)
+
+    def test_index(self):
+        index = self.cache().get('src')
+        self.assertEqual(sorted(index), ['a-1.0-0.tar.bz2', 'b-1.0-0.tar.bz2'])
+        info = index['a-1.0-0.tar.bz2']
+        self.assertEqual(info['name'], 'a')
+        self.assertIn('md5', info)
+        self.assertEqual(info['channel'], 'file://' + self.src_dir + '/')
+
+    def test_missing_source(self):
+        self.assertEqual(self.cache().get('missing'), {})
+
+    def test_persistent(self):
+        self.cache().get('src')
+        cache = self.cache()
+        index = cache.get('src')
+        self.assertEqual(len(index), 2)
+        self.assertEqual(cache.read, [])
+
+    def test_incremental(self):
+        cache = self.cache()
+        cache.get('src')
+        cache.read = []
+        os.remove(os.path.join(self.src_dir, 'b-1.0-0.tar.bz2'))
+        write_dist(self.src_dir, 'c', '1.0')
+        index = self.cache().get('src')
+        self.assertEqual(sorted(index), ['a-1.0-0.tar.bz2', 'c-1.0-0.tar.bz2'])
+        index = cache.get('src')
+        self.assertEqual(sorted(index), ['a-1.0-0.tar.bz2', 'c-1.0-0.tar.bz2'])
+        self.assertEqual(cache.read, ['c-1.0-0.tar.bz2'])
+
+    def test_add(self):
+        cache = self.cache()
+        cache.get('src')
+        cache.read = []
+        tarball = write_dist(self.src_dir, 'c', '1.0')
+        info = cache.add('src', tarball)
+        self.assertEqual(info['name'], 'c')
+        self.assertEqual(cache.read, ['c-1.0-0.tar.bz2'])
+        # The addition is persisted, and is not read again.
+        cache = self.cache()
+        self.assertEqual(len(cache.get('src')), 3)
+        self.assertEqual(cache.read, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
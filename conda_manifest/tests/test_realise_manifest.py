@@ -0,0 +1,61 @@
+import unittest
+
+from conda_manifest.realise_manifest import shared_indices, solve_envs
+from conda_manifest.tests import DummyIndex
+
+
+class CountingCache(object):
+    """A source index cache which counts the indices it loads."""
+    def __init__(self, src_indices):
+        self.src_indices = src_indices
+        self.loaded = []
+
+    def get(self, source_name):
+        self.loaded.append(source_name)
+        return self.src_indices[source_name]
+
+
+class Test_shared_indices(unittest.TestCase):
+    def setUp(self):
+        self.src_indices = {'s1': DummyIndex(), 's2': DummyIndex()}
+        self.src_indices['s1'].add_pkg('a', '1.0')
+        self.src_indices['s2'].add_pkg('a', '2.0')
+        self.cache = CountingCache(self.src_indices)
+
+    def test_shared(self):
+        envs = [{'sources': [['s1'], ['s2']]},
+                {'sources': [['s1'], ['s2']]},
+                {'sources': [['s2'], ['s1']]}]
+        indices = shared_indices(envs, cache=self.cache)
+        self.assertIs(indices[0], indices[1])
+        self.assertEqual(sorted(indices[0]), ['a-1.0-0.tar.bz2'])
+        self.assertEqual(sorted(indices[2]), ['a-2.0-0.tar.bz2'])
+        self.assertEqual(sorted(self.cache.loaded), ['s1', 's2'])
+
+
+class Test_solve_envs(unittest.TestCase):
+    def setUp(self):
+        self.index = DummyIndex()
+        self.index.add_pkg('a', '1.0', depends=['b'])
+        self.index.add_pkg('b', '1.0')
+
+    def check(self, processes):
+        envs = [{'packages': ['a']}, {'packages': ['b']},
+                {'packages': ['missing']}]
+        results = solve_envs(envs, [self.index] * 3, processes=processes)
+        self.assertEqual(results[0], (['a-1.0-0.tar.bz2', 'b-1.0-0.tar.bz2'],
+                                      None))
+        self.assertEqual(results[1], (['b-1.0-0.tar.bz2'], None))
+        dists, error = results[2]
+        self.assertIsNone(dists)
+        self.assertIsNotNone(error)
+
+    def test_serial(self):
+        self.check(processes=1)
+
+    def test_pool(self):
+        self.check(processes=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
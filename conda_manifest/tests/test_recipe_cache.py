@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from conda_manifest.recipe_cache import RecipeCache, recipe_hash
+from conda_manifest.tests import DummyPackage
+
+
+class Test_RecipeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.recipes = os.path.join(self.tmpdir, 'recipes')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.loaded = []
+        for name in ['a', 'b']:
+            self.write_recipe(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_recipe(self, name, content='package: {}'):
+        recipe_dir = os.path.join(self.recipes, name)
+        if not os.path.exists(recipe_dir):
+            os.makedirs(recipe_dir)
+        with open(os.path.join(recipe_dir, 'meta.yaml'), 'w') as fh:
+            fh.write(content)
+
+    def loader(self, recipe_dir):
+        self.loaded.append(os.path.basename(recipe_dir))
+        return DummyPackage(os.path.basename(recipe_dir))
+
+    def cache(self, context=('linux-64', 27, 19)):
+        return RecipeCache(self.cache_dir, loader=self.loader,
+                           context=context)
+
+    def names(self, metas):
+        return sorted(meta.name() for meta in metas)
+
+    def test_first_run(self):
+        metas = self.cache().find_all_recipes(self.recipes)
+        self.assertEqual(self.names(metas), ['a', 'b'])
+        self.assertEqual(sorted(self.loaded), ['a', 'b'])
+
+    def test_unchanged(self):
+        self.cache().find_all_recipes(self.recipes)
+        self.loaded = []
+        metas = self.cache().find_all_recipes(self.recipes)
+        self.assertEqual(self.names(metas), ['a', 'b'])
+        self.assertEqual(self.loaded, [])
+
+    def test_changed_recipe(self):
+        self.cache().find_all_recipes(self.recipes)
+        self.loaded = []
+        self.write_recipe('b', 'package: changed')
+        self.write_recipe('c')
+        metas = self.cache().find_all_recipes(self.recipes)
+        self.assertEqual(self.names(metas), ['a', 'b', 'c'])
+        self.assertEqual(sorted(self.loaded), ['b', 'c'])
+
+    def test_removed_recipe_evicted(self):
+        cache = self.cache()
+        cache.find_all_recipes(self.recipes)
+        shutil.rmtree(os.path.join(self.recipes, 'b'))
+        metas = cache.find_all_recipes(self.recipes)
+        self.assertEqual(self.names(metas), ['a'])
+        self.assertEqual(list(cache._read(cache.cache_fname(self.recipes))),
+                         [os.path.join(self.recipes, 'a')])
+
+    def test_context_change(self):
+        self.cache().find_all_recipes(self.recipes)
+        self.loaded = []
+        self.cache(context=('linux-64', 35, 19)).find_all_recipes(self.recipes)
+        self.assertEqual(sorted(self.loaded), ['a', 'b'])
+
+
+class Test_recipe_hash(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, fname, content):
+        fname = os.path.join(self.tmpdir, fname)
+        if not os.path.exists(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        with open(fname, 'w') as fh:
+            fh.write(content)
+
+    def test_ignored_files(self):
+        self.write('meta.yaml', 'package: a')
+        orig = recipe_hash(self.tmpdir)
+        self.write('source.json', '{}')
+        self.write('build.linux-64.log', 'Building...')
+        self.write('nested/meta.yaml', 'package: nested')
+        self.assertEqual(recipe_hash(self.tmpdir), orig)
+
+    def test_patch_changed(self):
+        self.write('meta.yaml', 'package: a')
+        self.write('patches/fix.patch', 'a')
+        orig = recipe_hash(self.tmpdir)
+        self.write('patches/fix.patch', 'b')
+        self.assertNotEqual(recipe_hash(self.tmpdir), orig)
+
+
+if __name__ == '__main__':
+    unittest.main()
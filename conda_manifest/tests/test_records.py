@@ -0,0 +1,76 @@
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+import json
+import pickle
+import unittest
+
+from conda_manifest.records import PackageRecord, match_spec
+
+
+class Test_match_spec(unittest.TestCase):
+    def test_memoized(self):
+        spec = match_spec('numpy >=1.8')
+        self.assertEqual(spec.name, 'numpy')
+        self.assertIs(match_spec('numpy >=1.8'), spec)
+
+
+class Test_PackageRecord(unittest.TestCase):
+    def setUp(self):
+        self.info = {'name': 'a', 'version': '1.0', 'build': 'py27_0',
+                     'build_number': 0, 'depends': ['python 2.7*'],
+                     'md5': 'abc', 'channel': 'file:///dists/'}
+        self.record = PackageRecord(self.info)
+
+    def test_mapping(self):
+        expected = dict(self.info, depends=('python 2.7*',))
+        self.assertEqual(dict(self.record), expected)
+        self.assertEqual(self.record, expected)
+        self.assertEqual(self.record['name'], 'a')
+        self.assertEqual(self.record.get('features'), None)
+        self.assertEqual(len(self.record), 7)
+
+    def test_missing_field(self):
+        record = PackageRecord({'name': 'a'})
+        self.assertEqual(dict(record), {'name': 'a'})
+        with self.assertRaises(KeyError):
+            record['version']
+        self.assertNotIn('version', record)
+
+    def test_modify(self):
+        self.record['features'] = 'mkl'
+        del self.record['md5']
+        del self.record['build']
+        self.assertEqual(self.record['features'], 'mkl')
+        self.assertNotIn('md5', self.record)
+        self.assertNotIn('build', self.record)
+
+    def test_shared_strings(self):
+        other = PackageRecord(json.loads(json.dumps(self.info)))
+        self.assertIs(other['version'], self.record['version'])
+        self.assertIs(other['depends'][0], self.record['depends'][0])
+        self.assertIs(other['channel'], self.record['channel'])
+
+    def test_no_dict(self):
+        with self.assertRaises(AttributeError):
+            self.record.__dict__
+
+    def test_mutable_mapping(self):
+        self.assertIsInstance(self.record, MutableMapping)
+        self.record.update({'features': 'mkl'}, md5='def')
+        self.assertEqual(self.record.pop('features'), 'mkl')
+        self.assertEqual(self.record.pop('features', None), None)
+        self.assertEqual(self.record.setdefault('md5'), 'def')
+        self.assertNotEqual(self.record, dict(self.info))
+
+    def test_pickle(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.record)), self.record)
+
+    def test_json(self):
+        self.assertEqual(json.loads(json.dumps(self.record, default=dict)),
+                         dict(self.info))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import conda.install
+
+from conda_manifest.deploy import extract_dist
+from conda_manifest.relocate import link_dist, relocate
+from conda_manifest.tests import write_dist
+
+
+PLACEHOLDER = '/opt/anaconda1anaconda2anaconda3'
+
+
+class Test_relocate(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_as_conda(self, content, new_prefix, mode):
+        with open(self.src, 'wb') as fh:
+            fh.write(content)
+        os.chmod(self.src, 0o755)
+        expected = os.path.join(self.tmpdir, 'expected')
+        shutil.copy2(self.src, expected)
+        conda.install.update_prefix(expected, new_prefix, PLACEHOLDER, mode)
+        dst = os.path.join(self.tmpdir, 'dst')
+        self.assertTrue(relocate(self.src, dst, PLACEHOLDER, new_prefix,
+                                 mode))
+        with open(expected, 'rb') as fh:
+            expected_content = fh.read()
+        with open(dst, 'rb') as fh:
+            self.assertEqual(fh.read(), expected_content)
+        self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode), 0o755)
+        self.assertNotEqual(os.stat(dst).st_ino, os.stat(self.src).st_ino)
+
+    def test_text(self):
+        self.check_as_conda(b'#!' + PLACEHOLDER.encode() + b'/bin/python\n'
+                            b'prefix = "' + PLACEHOLDER.encode() + b'"\n',
+                            '/a/prefix/which/is/longer/than/the/placeholder',
+                            'text')
+
+    def test_binary(self):
+        content = (b'\x7fELF\0\0' + PLACEHOLDER.encode() + b'/lib\0\0' +
+                   PLACEHOLDER.encode() + b':' + PLACEHOLDER.encode() +
+                   b'/lib64\0' + PLACEHOLDER.encode())
+        self.check_as_conda(content, '/short/prefix', 'binary')
+
+    def test_binary_padding_error(self):
+        with open(self.src, 'wb') as fh:
+            fh.write(PLACEHOLDER.encode() + b'\0')
+        dst = os.path.join(self.tmpdir, 'dst')
+        with self.assertRaises(conda.install.PaddingError):
+            relocate(self.src, dst, PLACEHOLDER, PLACEHOLDER + '/longer',
+                     'binary')
+        self.assertFalse(os.path.exists(dst))
+
+    def test_no_placeholder_hardlinked(self):
+        for content in [b'nothing to see here', b'']:
+            with open(self.src, 'wb') as fh:
+                fh.write(content)
+            dst = os.path.join(self.tmpdir, 'dst')
+            self.assertFalse(relocate(self.src, dst, PLACEHOLDER,
+                                      '/new/prefix', 'text'))
+            self.assertEqual(os.stat(dst).st_ino, os.stat(self.src).st_ino)
+            os.remove(dst)
+
+
+class Test_link_dist(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pkgs_dir = os.path.join(self.tmpdir, 'pkgs')
+        os.makedirs(self.pkgs_dir)
+        files = {'bin/script': b'#!' + PLACEHOLDER.encode() + b'/bin/sh\n',
+                 'lib/libx.so': b'\0' + PLACEHOLDER.encode() + b'/lib\0',
+                 'lib/plain.txt': b'plain'}
+        has_prefix = (PLACEHOLDER.encode() + b' binary lib/libx.so\n' +
+                      b'bin/script\n')
+        tarball = write_dist(self.tmpdir, 'a', '1.0', files,
+                             info_files={'info/has_prefix': has_prefix})
+        extract_dist(tarball, self.pkgs_dir, 'a-1.0-0')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def contents(self, prefix):
+        result = {}
+        for fname in ['bin/script', 'lib/libx.so', 'lib/plain.txt']:
+            with open(os.path.join(prefix, fname), 'rb') as fh:
+                result[fname] = fh.read()
+        return result
+
+    def test_as_conda(self):
+        expected_prefix = os.path.join(self.tmpdir, 'prefix_a')
+        conda.install.link(self.pkgs_dir, expected_prefix, 'a-1.0-0')
+        prefix = os.path.join(self.tmpdir, 'prefix_b')
+        link_dist(self.pkgs_dir, prefix, 'a-1.0-0')
+        # The prefixes are the same length, so the content is comparable.
+        expected = self.contents(expected_prefix)
+        for fname, content in expected.items():
+            expected[fname] = content.replace(expected_prefix.encode(),
+                                              prefix.encode())
+        self.assertEqual(self.contents(prefix), expected)
+        self.assertEqual(conda.install.linked(prefix), set(['a-1.0-0']))
+        src = os.path.join(self.pkgs_dir, 'a-1.0-0', 'lib', 'plain.txt')
+        self.assertEqual(os.stat(os.path.join(prefix, 'lib',
+                                              'plain.txt')).st_ino,
+                         os.stat(src).st_ino)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+
+from conda_manifest.index import LayeredIndex
+from conda_manifest.solver import LRUCache, Solver, index_digest
+from conda_manifest.tests import DummyIndex
+
+
+class CountingSolver(Solver):
+    """A solver which counts the (unmemoized) calls made to conda."""
+    def __init__(self, index, cache=None):
+        super(CountingSolver, self).__init__(index, cache=cache)
+        self.calls = []
+
+    def _get_pkgs(self, spec):
+        self.calls.append(('get_pkgs', spec))
+        return super(CountingSolver, self)._get_pkgs(spec)
+
+    def _solve(self, specs):
+        self.calls.append(('solve', sorted(specs)))
+        return super(CountingSolver, self)._solve(specs)
+
+
+class Test_LRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+
+class Test_index_digest(unittest.TestCase):
+    def test_content(self):
+        index1, index2 = DummyIndex(), DummyIndex()
+        index1.add_pkg('a', '1.0')
+        index2.add_pkg('a', '1.0')
+        self.assertEqual(index_digest(index1), index_digest(index2))
+        index2.add_pkg('b', '1.0')
+        self.assertNotEqual(index_digest(index1), index_digest(index2))
+
+    def test_order(self):
+        index = DummyIndex()
+        index.add_pkg('a', '1.0')
+        index.add_pkg('b', '1.0')
+        reordered = dict(reversed(list(index.items())))
+        self.assertEqual(index_digest(index), index_digest(reordered))
+
+    def test_md5(self):
+        index1, index2 = DummyIndex(), DummyIndex()
+        index1.add_pkg('a', '1.0', md5='abc')
+        index2.add_pkg('a', '1.0', md5='abd')
+        self.assertNotEqual(index_digest(index1), index_digest(index2))
+
+
+class Test_Solver(unittest.TestCase):
+    def setUp(self):
+        self.index = DummyIndex()
+        self.index.add_pkg('python', '2.7.2')
+        self.index.add_pkg('python', '3.5.0')
+        self.index.add_pkg('a', '1.0', depends=['python <3'])
+        self.cache = LRUCache()
+
+    def solver(self):
+        return CountingSolver(self.index, cache=self.cache)
+
+    def test_get_pkgs(self):
+        solver = self.solver()
+        pkgs = solver.get_pkgs('python')
+        self.assertEqual(sorted(pkg.fn for pkg in pkgs),
+                         ['python-2.7.2-0.tar.bz2', 'python-3.5.0-0.tar.bz2'])
+        self.assertEqual(solver.get_pkgs('python'), pkgs)
+        self.assertEqual(solver.calls, [('get_pkgs', 'python')])
+
+    def test_solve(self):
+        solver = self.solver()
+        result = solver.solve(['a', 'python'])
+        self.assertEqual(sorted(result),
+                         ['a-1.0-0.tar.bz2', 'python-2.7.2-0.tar.bz2'])
+        self.assertEqual(sorted(solver.solve(['python', 'a'])),
+                         sorted(result))
+        self.assertEqual(len(solver.calls), 1)
+
+    def test_solve_unrelated_packages(self):
+        self.index.add_pkg('b', '1.0', depends=['python >=3'])
+        solver = self.solver()
+        self.assertEqual(sorted(solver.solve(['a'])),
+                         ['a-1.0-0.tar.bz2', 'python-2.7.2-0.tar.bz2'])
+
+    def test_unsatisfiable(self):
+        solver = self.solver()
+        for _ in range(2):
+            with self.assertRaises(SystemExit):
+                solver.solve(['a', 'python >=3'])
+        self.assertEqual(len(solver.calls), 1)
+
+    def test_layered_index(self):
+        # The solver of a layered index uses its maintained digest and
+        # name-keyed view, so a new solver is cheap after an insertion.
+        index = LayeredIndex({'src': self.index}, [['src']])
+        solver = CountingSolver(index, cache=self.cache)
+        self.assertEqual(solver.digest, index_digest(index))
+        self.assertEqual(len(solver.get_pkgs('python')), 2)
+        built = DummyIndex()
+        built.add_pkg('python', '3.6.0')
+        index.insert('python-3.6.0-0.tar.bz2',
+                     built['python-3.6.0-0.tar.bz2'], 'src')
+        solver = CountingSolver(index, cache=self.cache)
+        self.assertEqual(solver.digest, index_digest(index))
+        self.assertEqual(len(solver.get_pkgs('python')), 3)
+
+    def test_shared_between_identical_indices(self):
+        self.solver().solve(['a'])
+        solver = self.solver()
+        solver.solve(['a'])
+        self.assertEqual(solver.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
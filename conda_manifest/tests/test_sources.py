@@ -0,0 +1,341 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import conda_manifest.config
+from conda_manifest.sources import (fetch_sources, git_cache_repo,
+                                    git_source, is_git_checkout_of,
+                                    load_fingerprints, refresh_git_checkout,
+                                    source_fingerprint, sync_tree)
+
+
+def write_file(path, content, mtime=1400000000):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as fh:
+        fh.write(content)
+    os.utime(path, (mtime, mtime))
+
+
+class Test_sync_tree(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'source')
+        self.target = os.path.join(self.tmpdir, 'target')
+        write_file(os.path.join(self.source, 'a.txt'), 'a')
+        write_file(os.path.join(self.source, 'sub', 'b.txt'), 'b')
+        sync_tree(self.source, self.target)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def target_path(self, *path):
+        return os.path.join(self.target, *path)
+
+    def tree(self, directory):
+        tree = {}
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                with open(path) as fh:
+                    tree[os.path.relpath(path, directory)] = fh.read()
+        return tree
+
+    def test_copy(self):
+        self.assertEqual(self.tree(self.target),
+                         {'a.txt': 'a', os.path.join('sub', 'b.txt'): 'b'})
+        self.assertEqual(os.stat(self.target_path('a.txt')).st_mtime,
+                         1400000000)
+
+    def test_unchanged(self):
+        inode = os.stat(self.target_path('a.txt')).st_ino
+        self.assertFalse(sync_tree(self.source, self.target))
+        self.assertEqual(os.stat(self.target_path('a.txt')).st_ino, inode)
+
+    def test_modified(self):
+        inode = os.stat(self.target_path('sub', 'b.txt')).st_ino
+        write_file(os.path.join(self.source, 'a.txt'), 'changed',
+                   mtime=1400000001)
+        self.assertTrue(sync_tree(self.source, self.target))
+        self.assertEqual(self.tree(self.target)['a.txt'], 'changed')
+        # Unchanged files aren't rewritten.
+        self.assertEqual(os.stat(self.target_path('sub', 'b.txt')).st_ino,
+                         inode)
+
+    def test_deleted(self):
+        os.remove(os.path.join(self.source, 'a.txt'))
+        shutil.rmtree(os.path.join(self.source, 'sub'))
+        self.assertTrue(sync_tree(self.source, self.target))
+        self.assertEqual(os.listdir(self.target), [])
+
+    def test_replaced(self):
+        # A file replaced by a directory, and a directory by a file.
+        os.remove(os.path.join(self.source, 'a.txt'))
+        write_file(os.path.join(self.source, 'a.txt', 'c.txt'), 'c')
+        shutil.rmtree(os.path.join(self.source, 'sub'))
+        write_file(os.path.join(self.source, 'sub'), 'sub')
+        self.assertTrue(sync_tree(self.source, self.target))
+        self.assertEqual(self.tree(self.target),
+                         self.tree(self.source))
+
+
+class Test_fetch_sources(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sources_root = os.path.join(self.tmpdir, 'sources')
+        self.sources = {}
+        for name in ['src1', 'src2']:
+            directory = os.path.join(self.tmpdir, name)
+            write_file(os.path.join(directory, 'recipe', 'meta.yaml'), name)
+            self.sources[name] = {'fn': directory}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def changed(self, **kwargs):
+        results = fetch_sources(self.sources, self.sources_root, **kwargs)
+        self.assertEqual([result.error for result in results.values()],
+                         [None] * len(results))
+        return {name: result.changed for name, result in results.items()}
+
+    def test_changed(self):
+        self.assertEqual(self.changed(), {'src1': True, 'src2': True})
+        self.assertEqual(self.changed(), {'src1': False, 'src2': False})
+        write_file(os.path.join(self.tmpdir, 'src2', 'recipe', 'meta.yaml'),
+                   'changed', mtime=1400000001)
+        self.assertEqual(self.changed(), {'src1': False, 'src2': True})
+
+    def test_fingerprint(self):
+        target = os.path.join(self.tmpdir, 'src1')
+        fingerprint = source_fingerprint(self.sources['src1'], target)
+        self.assertEqual(source_fingerprint(self.sources['src1'], target),
+                         fingerprint)
+        os.utime(os.path.join(target, 'recipe', 'meta.yaml'),
+                 (1400000001, 1400000001))
+        self.assertNotEqual(source_fingerprint(self.sources['src1'], target),
+                            fingerprint)
+
+    def test_missing_source(self):
+        self.sources['missing'] = {'fn': os.path.join(self.tmpdir, 'none')}
+        results = fetch_sources(self.sources, self.sources_root)
+        self.assertIsInstance(results['missing'].error, IOError)
+        self.assertFalse(results['missing'].changed)
+        # The other sources are still fetched.
+        for name in ['src1', 'src2']:
+            self.assertIsNone(results[name].error)
+            self.assertTrue(results[name].changed)
+        self.assertEqual(sorted(load_fingerprints(self.sources_root)),
+                         ['src1', 'src2'])
+
+
+class GitTestCase(unittest.TestCase):
+    """
+    Provides an upstream git repository (with ``master`` and ``feature``
+    branches), reached through a ``file://`` URL, and a private git cache.
+
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sources_root = os.path.join(self.tmpdir, 'sources')
+        self.upstream = os.path.join(self.tmpdir, 'upstream')
+        self.git_url = 'file://' + self.upstream
+        os.makedirs(self.upstream)
+        self.git('init', '-q')
+        self.git('symbolic-ref', 'HEAD', 'refs/heads/master')
+        self.git('config', 'uploadpack.allowFilter', 'true')
+        self.commit({'recipe/meta.yaml': 'master',
+                     'other/notes.txt': 'notes'})
+        self.git('checkout', '-q', '-b', 'feature')
+        self.commit({'recipe/meta.yaml': 'feature'})
+        self.git('checkout', '-q', 'master')
+
+        self.git_cache = os.path.join(self.tmpdir, 'git_cache')
+        orig_git_cache = conda_manifest.config.GIT_CACHE
+
+        def restore():
+            conda_manifest.config.GIT_CACHE = orig_git_cache
+        self.addCleanup(restore)
+        conda_manifest.config.GIT_CACHE = self.git_cache
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def git(self, *args, **kwargs):
+        env = dict(os.environ, GIT_AUTHOR_NAME='test',
+                   GIT_AUTHOR_EMAIL='test@example.com',
+                   GIT_COMMITTER_NAME='test',
+                   GIT_COMMITTER_EMAIL='test@example.com')
+        output = subprocess.check_output(
+            ['git'] + list(args), cwd=kwargs.get('cwd', self.upstream),
+            env=env)
+        return output.decode('utf-8').strip()
+
+    def commit(self, files):
+        for path, content in files.items():
+            write_file(os.path.join(self.upstream, path), content)
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', 'Update.')
+        return self.git('rev-parse', 'HEAD')
+
+    def fetch(self, sources, jobs=1):
+        results = fetch_sources(sources, self.sources_root, jobs=jobs)
+        self.assertEqual({name: result.error
+                          for name, result in results.items()},
+                         {name: None for name in sources})
+        return results
+
+    def read(self, source_name, *path):
+        with open(os.path.join(self.sources_root, source_name,
+                               *path)) as fh:
+            return fh.read()
+
+
+class Test_git_cache(GitTestCase):
+    def test_shared_mirror(self):
+        sources = {'a': {'git_url': self.git_url, 'git_rev': 'master'},
+                   'b': {'git_url': self.git_url, 'git_rev': 'feature'}}
+        self.fetch(sources, jobs=2)
+        mirror = git_cache_repo(self.git_url, self.git_cache)
+        self.assertEqual(os.listdir(self.git_cache),
+                         [os.path.basename(mirror)])
+        for name, content in [('a', 'master'), ('b', 'feature')]:
+            self.assertEqual(self.read(name, 'recipe', 'meta.yaml'), content)
+            self.assertTrue(is_git_checkout_of(
+                os.path.join(self.sources_root, name), mirror))
+
+    def test_new_commits(self):
+        sources = {'a': {'git_url': self.git_url, 'git_rev': 'master'},
+                   'b': {'git_url': self.git_url, 'git_rev': 'feature'}}
+        self.fetch(sources)
+        self.commit({'recipe/meta.yaml': 'updated'})
+        results = self.fetch(sources)
+        self.assertEqual(self.read('a', 'recipe', 'meta.yaml'), 'updated')
+        self.assertTrue(results['a'].changed)
+        self.assertFalse(results['b'].changed)
+
+    def test_bypassed(self):
+        sources = {'depth': {'git_url': self.git_url, 'git_rev': 'master',
+                             'git_depth': 1},
+                   'filter': {'git_url': self.git_url,
+                              'git_filter': 'blob:none'},
+                   'sparse': {'git_url': self.git_url,
+                              'git_sparse': ['recipe']}}
+        self.fetch(sources)
+        self.assertFalse(os.path.exists(self.git_cache))
+        for name in sources:
+            self.assertTrue(is_git_checkout_of(
+                os.path.join(self.sources_root, name), self.git_url))
+            self.assertEqual(self.read(name, 'recipe', 'meta.yaml'),
+                             'master')
+        self.assertFalse(os.path.exists(os.path.join(self.sources_root,
+                                                     'sparse', 'other')))
+        # Refreshing the bypassing sources doesn't use the cache either.
+        self.commit({'recipe/meta.yaml': 'updated'})
+        self.fetch(sources)
+        self.assertFalse(os.path.exists(self.git_cache))
+        for name in sources:
+            self.assertEqual(self.read(name, 'recipe', 'meta.yaml'),
+                             'updated')
+
+
+
+class Test_fetch_sources_concurrently(GitTestCase):
+    def test_errors_isolated(self):
+        fn_source = os.path.join(self.tmpdir, 'fn_source')
+        write_file(os.path.join(fn_source, 'recipe', 'meta.yaml'), 'fn')
+        sources = {'a': {'git_url': self.git_url, 'git_rev': 'master'},
+                   'b': {'git_url': self.git_url, 'git_rev': 'feature'},
+                   'c': {'fn': fn_source},
+                   'missing': {'git_url': 'file://' + os.path.join(
+                       self.tmpdir, 'missing')}}
+        mirror = git_cache_repo(self.git_url, self.git_cache)
+        mirror_updates = []
+        orig_check_call = subprocess.check_call
+
+        def check_call(cmd, **kwargs):
+            if ((cmd[1:3] == ['clone', '--mirror'] and mirror in cmd) or
+                    kwargs.get('cwd') == mirror):
+                mirror_updates.append(cmd)
+            return orig_check_call(cmd, **kwargs)
+        subprocess.check_call = check_call
+
+        def restore():
+            subprocess.check_call = orig_check_call
+        self.addCleanup(restore)
+
+        results = fetch_sources(sources, self.sources_root, jobs=4)
+        self.assertIsNotNone(results['missing'].error)
+        for name in ['a', 'b', 'c']:
+            self.assertIsNone(results[name].error)
+        self.assertEqual(self.read('b', 'recipe', 'meta.yaml'), 'feature')
+        self.assertEqual(self.read('c', 'recipe', 'meta.yaml'), 'fn')
+        # The sources sharing the mirror updated it only once.
+        self.assertEqual(len(mirror_updates), 1)
+
+
+
+class Test_refresh_git_checkout(GitTestCase):
+    def setUp(self):
+        super(Test_refresh_git_checkout, self).setUp()
+        self.target = os.path.join(self.sources_root, 'src')
+
+    def clone(self, **kwargs):
+        git_source(self.git_url, self.git_cache, self.target, **kwargs)
+
+    def test_is_git_checkout_of(self):
+        self.clone(git_rev='master')
+        mirror = git_cache_repo(self.git_url, self.git_cache)
+        self.assertTrue(is_git_checkout_of(self.target, mirror))
+        self.assertFalse(is_git_checkout_of(self.target, self.git_url))
+        self.assertFalse(is_git_checkout_of(self.upstream + '_missing',
+                                            mirror))
+        os.makedirs(os.path.join(self.tmpdir, 'not_git'))
+        self.assertFalse(is_git_checkout_of(os.path.join(self.tmpdir,
+                                                         'not_git'),
+                                            mirror))
+
+    def test_branch(self):
+        self.clone(git_rev='master', depth=1)
+        write_file(os.path.join(self.target, 'recipe', 'meta.yaml'), 'local')
+        self.commit({'recipe/meta.yaml': 'updated'})
+        refresh_git_checkout(self.target, git_rev='master', depth=1)
+        # Local modifications are discarded, and the history stays shallow.
+        self.assertEqual(self.read('src', 'recipe', 'meta.yaml'), 'updated')
+        self.assertEqual(self.git('rev-list', '--count', 'HEAD',
+                                  cwd=self.target), '1')
+
+    def test_switch_branch(self):
+        self.clone(git_rev='master', filter_spec='blob:none')
+        refresh_git_checkout(self.target, git_rev='feature')
+        self.assertEqual(self.read('src', 'recipe', 'meta.yaml'), 'feature')
+
+    def test_tag_and_commit(self):
+        self.git('tag', 'v1')
+        first = self.git('rev-parse', 'HEAD')
+        self.clone(filter_spec='blob:none')
+        self.commit({'recipe/meta.yaml': 'updated'})
+        refresh_git_checkout(self.target)
+        self.assertEqual(self.read('src', 'recipe', 'meta.yaml'), 'updated')
+        refresh_git_checkout(self.target, git_rev='v1')
+        self.assertEqual(self.read('src', 'recipe', 'meta.yaml'), 'master')
+        refresh_git_checkout(self.target, git_rev='feature')
+        refresh_git_checkout(self.target, git_rev=first)
+        self.assertEqual(self.git('rev-parse', 'HEAD', cwd=self.target),
+                         first)
+
+    def test_sparse(self):
+        self.clone(sparse_paths=['recipe'])
+        other = os.path.join(self.target, 'other')
+        self.assertFalse(os.path.exists(other))
+        # Sparse checkout is disabled when no longer wanted.
+        refresh_git_checkout(self.target)
+        self.assertTrue(os.path.exists(other))
+        refresh_git_checkout(self.target, sparse_paths=['recipe'])
+        self.assertFalse(os.path.exists(other))
+
+
+if __name__ == '__main__':
+    unittest.main()